@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import os,sys,time,threading
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import Tomcat, TomcatCluster
+from tomcat.asyncclient import AsyncTomcat, AsyncTomcatCluster
+from jmxstub import JMXStubServer
+
+def bench(name, c, command, args=()):
+    start = time.time()
+    rv = c.run_command(command, *args)
+    elapsed = time.time() - start
+    assert not rv.has_failures, rv.failures
+    print '{0:<40} {1:>8.2f}s'.format(name, elapsed)
+    return rv.results
+
+if __name__ == '__main__':
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    response = "OK - Attribute get 'Catalina:type=Server' - stateName = STARTED\n"
+    webapps = open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'testdata', 'test1.txt')).read()
+    fleet = [ JMXStubServer({ 'get': response, 'qry': webapps }, delay=latency)
+              for i in xrange(nodes) ]
+
+    threaded = TomcatCluster()
+    async = AsyncTomcatCluster()
+    for s in fleet:
+        threaded.add_member(Tomcat('127.0.0.1', port=s.port))
+        async.add_member(AsyncTomcat('127.0.0.1', port=s.port, loop=async.loop))
+
+    print 'Simulated fleet: {0} nodes, {1}ms latency'.format(nodes, latency * 1000)
+    for command, args in [ ('server_status', ()),
+                           ('list_webapps', ('*', '*', Tomcat.webapp_attributes)) ]:
+        print command
+        a = bench('  TomcatCluster ({0} threads)'.format(TomcatCluster.max_threads),
+                  threaded, command, args)
+        b = bench('  AsyncTomcatCluster', async, command, args)
+        assert a == b
+
+    for t in threaded.members.values():
+        t.pool.close()
+    # shutdown() waits for up to half a second, stop the servers in parallel
+    stopping = [ threading.Thread(target=s.shutdown) for s in fleet ]
+    for t in stopping:
+        t.start()
+    for t in stopping:
+        t.join()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import os,sys,time,threading
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat.cache import ResultCache, SingleFlight
+from tomcat.jmxproxy import JMXProxyConnection
+from jmxstub import JMXStubServer
+
+c = ResultCache(ttl=60, max_entries=2)
+assert c.get('a') is None
+c.put('a', 1)
+c.put('b', 2)
+assert c.get('a') == 1
+c.put('c', 3) # evicts 'b', the least recently used entry
+assert c.get('b') is None and c.get('a') == 1 and c.get('c') == 3
+assert c.stats == { 'hits': 3, 'misses': 2, 'entries': 2 }
+
+# values fetched before an invalidation must not be stored
+generation = c.generation
+c.invalidate()
+c.put('a', 'stale', generation)
+assert c.get('a') is None and len(c) == 0
+
+c = ResultCache(ttl=0.01)
+c.put('a', 1)
+time.sleep(0.02)
+assert c.get('a') is None
+
+# concurrent identical calls share the leader's result
+f = SingleFlight()
+leader = f.join('a')
+assert leader.leader
+followers = [ f.join('a') for i in range(3) ]
+assert not any(c.leader for c in followers)
+results = []
+threads = [ threading.Thread(target=lambda c=c: results.append(c.wait(5)))
+            for c in followers ]
+for t in threads:
+    t.start()
+f.finish(leader, 42)
+for t in threads:
+    t.join()
+assert results == [ 42, 42, 42 ]
+assert f.stats == { 'executed': 1, 'deduplicated': 3 }
+assert f.join('a').leader # finished calls are not shared
+
+# followers see the leader's error, or None if it gave up
+f = SingleFlight()
+(leader, follower) = (f.join('b'), f.join('b'))
+f.finish(leader, error=ValueError('boom'))
+try:
+    follower.wait(5)
+    assert False
+except ValueError:
+    pass
+(leader, follower) = (f.join('c'), f.join('c'))
+assert follower.wait(0.01) is None
+f.finish(leader)
+assert follower.wait(5) is None
+
+leader = f.join('d')
+f.forget()
+assert f.join('d').leader
+f.finish(leader, 1)
+
+# a leader nobody waits for keeps its outcome, later callers go alone
+f = SingleFlight()
+leader = f.join('e')
+assert f.stream(leader)
+other = f.join('e')
+assert other.leader and other is not leader
+f.finish(other)
+f.finish(leader)
+assert f.stats == { 'executed': 2, 'deduplicated': 0 }
+(leader, follower) = (f.join('g'), f.join('g'))
+assert not f.stream(leader)
+f.finish(leader, 1)
+assert follower.wait(5) == 1
+
+# streamed responses are not collected unless a cache or a caller needs them
+class Line(str):
+    live = 0
+    def __new__(cls, s):
+        Line.live += 1
+        return str.__new__(cls, s)
+    def __del__(self):
+        Line.live -= 1
+
+beans = ''.join('Name: Catalina:type=Manager,context=/app{0},host=localhost\n'
+                'activeSessions: {0}\n\n'.format(i) for i in range(1000))
+s = JMXStubServer({ 'qry': 'OK - Number of results: 1000\n\n' + beans })
+jmx = JMXProxyConnection('127.0.0.1', port=s.port)
+iter_lines = jmx._iter_lines
+jmx._iter_lines = lambda *args: (Line(l) for l in iter_lines(*args))
+most = 0
+for name, attrs in jmx.iter_query('Catalina:type=Manager,*'):
+    most = max(most, Line.live)
+assert attrs['activeSessions'] == 999 and most <= 4, most
+jmx.enable_cache()
+assert len(jmx.query('Catalina:type=Manager,*')) == 1000
+assert Line.live > 3000
+jmx.disable_cache()
+jmx.pool.close()
+s.shutdown()
+
+print "Selftest OK"
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import os,sys,time,threading,logging
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import TomcatCluster, TomcatError
+
+class FakeTomcat:
+    def __init__(self, host, delay):
+        (self.host, self.port, self.delay) = (host, 8080, delay)
+
+    def set_progress_callback(self, callback):
+        pass
+
+    def server_status(self):
+        time.sleep(self.delay)
+        return 'STARTED'
+
+logging.getLogger('pytomcat').addHandler(logging.NullHandler())
+
+c = TomcatCluster()
+for i in range(8):
+    c.add_member(FakeTomcat('10.0.0.{0}'.format(i), 0.01))
+c.add_member(FakeTomcat('10.0.0.8', 0.5))
+c.add_member(FakeTomcat('10.0.0.9', 2))
+
+# results are yielded as nodes finish
+hosts = [ h for h, rv in c.iter_command('server_status', deadline=1, partial=True) ]
+assert len(hosts) == 9 and hosts[-1] == '10.0.0.8:8080'
+
+start = time.time()
+rv = c.run_command('server_status', deadline=1)
+assert time.time() - start < 2
+assert rv.timed_out == [ '10.0.0.9:8080' ]
+assert isinstance(rv.failures['10.0.0.9:8080'], TomcatError)
+assert len(rv.results) == 9 and len(rv.latencies) == 9
+assert rv.stragglers == [ '10.0.0.9:8080' ]
+
+rv = c.run_command('server_status', deadline=1, partial=True)
+assert not rv.has_failures and rv.timed_out == [ '10.0.0.9:8080' ]
+
+rv = c.run_command('server_status', hosts=[ '10.0.0.{0}:8080'.format(i) for i in range(9) ])
+assert rv.timed_out == [] and rv.median_latency < 0.1
+rv.straggler_min_delay = 0.2
+assert rv.stragglers == [ '10.0.0.8:8080' ]
+
+c.shutdown()
+
+# commands share one pool, its threads stop on shutdown
+threads = threading.active_count()
+c = TomcatCluster()
+for i in range(30):
+    c.add_member(FakeTomcat('10.0.1.{0}'.format(i), 0.001))
+c.run_command('server_status')
+running = threading.active_count()
+assert running > threads
+for i in range(10):
+    assert len(c.run_command('server_status').results) == 30
+    c.run_command('server_status', threads=5)
+assert threading.active_count() == running
+c.shutdown()
+assert threading.active_count() == threads
+# a new pool is started when the cluster is used again
+with c:
+    c.run_command('server_status')
+    assert threading.active_count() == running
+assert threading.active_count() == threads
+print "Selftest OK"
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import os,sys,resource,subprocess
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat.parser import iter_search_results, compact
+from cStringIO import StringIO
+
+testdata = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+def webmodule_response(count):
+    with open(os.path.join(testdata, 'test1.txt')) as f:
+        webmodule = f.read().split('\n\n', 1)[1]
+    out = [ 'OK - Number of results: {0}\n\n'.format(count) ]
+    for i in xrange(count):
+        out.append(webmodule.replace('//localhost/', '//localhost/app{0}'.format(i), 1))
+    return ''.join(out)
+
+def snapshot(nodes, apps, use_compact):
+    '''
+    Simulate TomcatCluster.run_command('list_webapps') results
+    '''
+    data = webmodule_response(apps)
+    rv = {}
+    for n in xrange(nodes):
+        beans = iter_search_results(StringIO(data))
+        if use_compact:
+            beans = ((k, compact(v)) for k, v in beans)
+        rv['10.0.{0}.{1}:8080'.format(n / 256, n % 256)] = dict(beans)
+    return rv
+
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+if __name__ == '__main__':
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    apps = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    if len(sys.argv) > 3:
+        # child process: report memory growth in KiB
+        before = max_rss()
+        s = snapshot(nodes, apps, sys.argv[3] == 'compact')
+        print max_rss() - before
+        sys.exit(0)
+
+    print 'Snapshot of {0} nodes x {1} webapps'.format(nodes, apps)
+    rss = {}
+    for mode in [ 'dict', 'compact' ]:
+        out = subprocess.check_output([ sys.executable, __file__,
+                                        str(nodes), str(apps), mode ])
+        rss[mode] = int(out)
+        print '{0:<8} {1:>10.1f} MiB'.format(mode, rss[mode] / 1024.0)
+    print 'Reduction: {0:.0f}%'.format(100.0 - 100.0 * rss['compact'] / rss['dict'])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import os,sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import Tomcat
+from tomcat.httppool import PooledResponse
+from jmxstub import JMXStubServer
+
+beans = ''.join('Name: Catalina:j2eeType=WebModule,name=//localhost/app{0},'
+                'J2EEApplication=none,J2EEServer=none\nname: /app{0}\n'
+                'path: /app{0}\nstateName: STARTED\nwebappVersion: \n\n'
+                .format(i) for i in range(2000))
+response = 'OK - Number of results: 2000\n\n' + beans
+
+default_blocksize = PooledResponse.blocksize
+
+def run(compression, blocksize=default_blocksize):
+    s = JMXStubServer({ 'qry': response }, compression=compression)
+    t = Tomcat('127.0.0.1', port=s.port)
+    PooledResponse.blocksize = blocksize
+    try:
+        rv = t.list_webapps()
+        transfer = t.jmx.last_transfer
+        assert transfer == (s.last_sent, len(response)), (compression, transfer)
+        # the connection was read to the end and is reused
+        assert t.list_webapps() == rv and s.connections == 1
+        assert (t.jmx.bytes_received, t.jmx.bytes_decoded) == \
+               (2 * s.last_sent, 2 * len(response))
+        return (rv, s.last_sent)
+    finally:
+        PooledResponse.blocksize = default_blocksize
+        t.pool.close()
+        s.shutdown()
+
+(expected, size) = run(None)
+assert len(expected) == 2000 and size == len(response)
+for encoding in [ 'gzip', 'deflate', 'raw-deflate', 'identity' ]:
+    for blocksize in [ default_blocksize, 100 ]:
+        (rv, sent) = run(encoding, blocksize)
+        assert rv == expected, encoding
+        if encoding == 'identity':
+            assert sent == len(response)
+        else:
+            assert sent < len(response) / 5, (encoding, sent)
+
+# without Accept-Encoding the server does not compress
+s = JMXStubServer({ 'qry': response }, compression='gzip')
+t = Tomcat('127.0.0.1', port=s.port)
+t.jmx.compression = False
+assert t.list_webapps() == expected
+assert t.jmx.last_transfer == (len(response), len(response))
+t.pool.close()
+s.shutdown()
+print "Selftest OK"
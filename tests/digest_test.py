@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import os,sys,tempfile,urlparse,fnmatch,logging,zipfile
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import TomcatError, war_digest
+from tomcat.deployer import ClusterDeployer, parse_warfiles
+from jmxstub import JMXStubServer
+
+logging.getLogger('pytomcat').addHandler(logging.NullHandler())
+tmpdir = tempfile.mkdtemp(prefix='pytomcat-digest')
+war = os.path.join(tmpdir, 'foo##002.war')
+def build(content):
+    z = zipfile.ZipFile(war, 'w')
+    z.writestr('index.html', content)
+    z.close()
+build('build 1')
+
+# digests are cached by path, mtime and size
+cache = {}
+digest = war_digest(war, cache)
+st = os.stat(war)
+cache[os.path.abspath(war)] = [ st.st_mtime, st.st_size, 'cached' ]
+assert war_digest(war, cache) == 'cached'
+os.utime(war, (st.st_atime, st.st_mtime + 10))
+assert war_digest(war, cache) == digest
+
+class Node:
+    def __init__(self, host, hosts):
+        (self.host, self.hosts) = (host, hosts)
+        self.apps = { '/foo##001': 'STARTED' }
+        self.deploys = 0
+        self.undeploys = 0
+        self.fail = False
+
+    def __call__(self, path):
+        url = urlparse.urlparse(path)
+        params = urlparse.parse_qs(url.query)
+        if 'qry' in params:
+            qry = params['qry'][0]
+            if 'component=Member' in qry:
+                beans = [ 'Name: Catalina:type=Cluster,component=Member,'
+                          'name=tcp://{0}\nhostname: {0}\nready: true\n'
+                          'failing: false\nsuspect: false\n\n'.format(h)
+                          for h in self.hosts if h != self.host ]
+            else:
+                pattern = qry.split('name=', 1)[1].split(',', 1)[0]
+                beans = [ 'Name: Catalina:j2eeType=WebModule,name=//localhost{0},'
+                          'J2EEApplication=none,J2EEServer=none\nname: {0}\n'
+                          'path: {1}\nstateName: {2}\nwebappVersion: {3}\n\n'
+                          .format(ctx, ctx.split('##')[0], state, ctx.split('##')[1])
+                          for ctx, state in self.apps.items()
+                          if fnmatch.fnmatch('//localhost' + ctx, pattern) ]
+            return 'OK - Number of results: {0}\n\n{1}'.format(len(beans),
+                                                               ''.join(beans))
+        if 'invoke' in params:
+            # undeploy_old_versions
+            if params['op'] == [ 'checkUndeploy' ]:
+                self.apps.pop('/foo##001', None)
+            return 'OK - Operation without return value\n'
+        if url.path.endswith('/deploy'):
+            self.deploys += 1
+            if self.fail:
+                return 'FAIL - Deploy Upload Failed\n'
+            self.apps[params['path'][0]] = 'STARTED'
+            return 'OK - Deployed application\n'
+        if url.path.endswith('/undeploy'):
+            self.undeploys += 1
+            self.apps.pop(params['path'][0], None)
+            return 'OK - Undeployed application\n'
+        return 'FAIL - Unknown command\n'
+
+hosts = [ '127.0.0.{0}'.format(i) for i in range(1, 4) ]
+(nodes, servers) = ({}, [])
+for h in hosts:
+    nodes[h] = Node(h, hosts)
+    port = servers[0].port if servers else 0
+    servers.append(JMXStubServer({ 'default': nodes[h] }, host=h, port=port))
+port = servers[0].port
+
+deployers = []
+def deployer():
+    deployers.append(ClusterDeployer(host=hosts[0], port=port, user='admin',
+                     passwd='admin', cache_ttl=0, check_memory=False,
+                     undeploy_on_error=False, poll_interval=0.1,
+                     deploy_wait_time=1,
+                     digest_index=os.path.join(tmpdir, 'digests')))
+    return deployers[-1]
+
+# the deploy fails on one node
+nodes[hosts[2]].fail = True
+try:
+    deployer().deploy(parse_warfiles([ war ]))
+    assert False, 'deploy should have failed'
+except TomcatError:
+    pass
+assert [ nodes[h].deploys for h in hosts ] == [ 1, 1, 1 ]
+
+# a retry failing again only undeploys from the nodes it touched
+d = deployer()
+d.undeploy_on_error = True
+try:
+    d.deploy(parse_warfiles([ war ]))
+    assert False, 'deploy should have failed'
+except TomcatError:
+    pass
+assert [ nodes[h].deploys for h in hosts ] == [ 1, 1, 2 ]
+assert [ nodes[h].undeploys for h in hosts ] == [ 0, 0, 1 ]
+assert all('/foo##002' in nodes[h].apps for h in hosts[:2])
+
+# a retry only deploys to that node
+nodes[hosts[2]].fail = False
+deployer().deploy(parse_warfiles([ war ]))
+assert [ nodes[h].deploys for h in hosts ] == [ 1, 1, 3 ]
+assert all('/foo##002' in nodes[h].apps for h in hosts)
+
+# nothing left to do
+deployer().deploy(parse_warfiles([ war ]))
+assert [ nodes[h].deploys for h in hosts ] == [ 1, 1, 3 ]
+
+# a different build with the same name is still refused
+build('build 2')
+try:
+    deployer().deploy(parse_warfiles([ war ]))
+    assert False, 'deploy should have failed'
+except TomcatError as e:
+    assert 'There is already a context' in str(e), e
+
+# so is a build that was not recorded
+d = deployer()
+d.digest_index = None
+try:
+    d.deploy(parse_warfiles([ war ]))
+    assert False, 'deploy should have failed'
+except TomcatError as e:
+    assert 'There is already a context' in str(e), e
+
+# undeploying forgets the recorded builds
+d = deployer()
+d.undeploy([ '/foo##002' ])
+assert not any(d._deployed_digest(h, '/foo##002', 'localhost')
+               for h in d.c.members)
+
+for d in deployers:
+    for t in d.c.members.values():
+        t.pool.close()
+for s in servers:
+    s.shutdown()
+for f in os.listdir(tmpdir):
+    os.unlink(os.path.join(tmpdir, f))
+os.rmdir(tmpdir)
+print "Selftest OK"
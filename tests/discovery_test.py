@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import os,sys,tempfile,threading
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import TomcatCluster
+from jmxstub import JMXStubServer
+
+def members_response(hosts):
+    rv = [ 'OK - Number of results: {0}\n\n'.format(len(hosts)) ]
+    for h in hosts:
+        rv.append('Name: Catalina:type=Cluster,component=Member,name=tcp://{0}\n'
+                  'hostname: {0}\nready: true\nfailing: false\nsuspect: false\n\n'
+                  .format(h))
+    return ''.join(rv)
+
+# A chain of nodes, each one only knows about its neighbours
+hosts = [ '127.0.0.{0}'.format(i) for i in range(1, 7) ]
+fleet = {}
+for i, h in enumerate(hosts):
+    neighbours = hosts[max(i - 1, 0):i] + hosts[i + 1:i + 2]
+    port = fleet[hosts[0]].port if fleet else 0
+    fleet[h] = JMXStubServer({ 'qry': members_response(neighbours) },
+                             host=h, port=port)
+port = fleet[hosts[0]].port
+expected = sorted('{0}:{1}'.format(h, port) for h in hosts)
+
+clusters = []
+c = TomcatCluster(hosts[0], 'admin', 'admin', port)
+clusters.append(c)
+assert sorted(c.members.keys()) == expected
+assert all(s.requests == 1 for s in fleet.values())
+
+# members are no longer shared between instances
+assert TomcatCluster().members == {}
+
+# Members of a healthy cluster know about all the others
+for h in hosts:
+    fleet[h].responses['qry'] = members_response([ o for o in hosts if o != h ])
+
+cache = tempfile.mktemp(prefix='pytomcat-topology')
+try:
+    c = TomcatCluster(hosts[0], 'admin', 'admin', port, topology_cache=cache)
+    clusters.append(c)
+    assert sorted(c.members.keys()) == expected
+    requests = sum(s.requests for s in fleet.values())
+
+    # a cached topology only costs a single request to the seed host
+    c = TomcatCluster(hosts[0], 'admin', 'admin', port, topology_cache=cache)
+    clusters.append(c)
+    assert sorted(c.members.keys()) == expected
+    assert sum(s.requests for s in fleet.values()) == requests + 1
+
+    # the whole graph is searched again if the seed disagrees
+    fleet['127.0.0.9'] = JMXStubServer({ 'qry': members_response(hosts) },
+                                       host='127.0.0.9', port=port)
+    fleet[hosts[0]].responses['qry'] = members_response(hosts[1:] + [ '127.0.0.9' ])
+    c = TomcatCluster(hosts[0], 'admin', 'admin', port, topology_cache=cache)
+    clusters.append(c)
+    assert '127.0.0.9:{0}'.format(port) in c.members
+    assert sum(s.requests for s in fleet.values()) > requests + 2
+finally:
+    if os.path.exists(cache):
+        os.remove(cache)
+    for c in clusters:
+        c.shutdown()
+        for t in c.members.values():
+            t.pool.close()
+    stopping = [ threading.Thread(target=s.shutdown) for s in fleet.values() ]
+    for t in stopping:
+        t.start()
+    for t in stopping:
+        t.join()
+
+print "Selftest OK"
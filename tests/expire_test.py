@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import os,sys,time,threading,urlparse,logging
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import Tomcat, TomcatError, events
+from jmxstub import JMXStubServer
+
+logging.getLogger('pytomcat').addHandler(logging.NullHandler())
+
+ids = [ 'S{0:04d}'.format(i) for i in range(200) ]
+managers = ('OK - Number of results: 2\n\n'
+            'Name: Catalina:type=Manager,context=/app,host=vhost1\n'
+            'activeSessions: {0}\n\n'
+            'Name: Catalina:type=Manager,context=/idle,host=vhost1\n'
+            'activeSessions: 0\n\n'.format(len(ids)))
+requests = []
+def expire(path):
+    requests.append(urlparse.parse_qs(urlparse.urlparse(path).query))
+    return ('OK - Session information for application at context path /app\n'
+            'OK - Default maximum session inactive interval 30 minutes\n'
+            '>0 minutes: {0} sessions were expired\n'.format(len(ids)))
+s = JMXStubServer({ 'qry': managers, 'expire': expire })
+t = Tomcat('127.0.0.1', port=s.port)
+received = []
+t.set_progress_callback(lambda **args: received.append(args))
+
+# one manager request expires every session of the webapp
+assert t.expire_sessions('/*', 'vhost1') == { '/app': len(ids), '/idle': 0 }
+assert requests == [ { 'path': [ '/app' ], 'idle': [ '0' ] } ]
+assert s.requests == 2
+assert [ (e['event'], e['context'], e['expired'], e['total'])
+         for e in received ] == [ (events.EXPIRE, '/app', len(ids), len(ids)) ]
+
+# expiring invalidates cached session counts
+t.jmx.enable_cache(ttl=60)
+assert t.list_sessions('/*', 'vhost1', counts_only=True)['/app'] == len(ids)
+t.expire_sessions('/*', 'vhost1')
+s.responses['qry'] = managers.replace('activeSessions: {0}'.format(len(ids)),
+                                      'activeSessions: 0')
+assert t.list_sessions('/*', 'vhost1', counts_only=True)['/app'] == 0
+t.jmx.disable_cache()
+s.responses['qry'] = managers
+del received[:]
+
+# without the expire command sessions are expired over JMX, a few at a time
+(running, most, expired) = ([ 0 ], [ 0 ], [])
+lock = threading.Lock()
+def invoke(path):
+    params = urlparse.parse_qs(urlparse.urlparse(path).query)
+    if params['op'] == [ 'listSessionIds' ]:
+        return 'OK - Operation listSessionIds returned:\n{0} \n'.format(' '.join(ids))
+    with lock:
+        running[0] += 1
+        most[0] = max(most[0], running[0])
+    time.sleep(0.01)
+    with lock:
+        running[0] -= 1
+        expired.append(params['ps'][0])
+    return 'OK - Operation expireSession without return value\n'
+s.responses['expire'] = 'FAIL - Unknown command /expire\n'
+s.responses['invoke'] = invoke
+del received[:]
+t.expire_progress_interval = 50
+start = time.time()
+assert t.expire_sessions('/app', 'vhost1')['/app'] == len(ids)
+elapsed = time.time() - start
+assert sorted(expired) == ids
+assert 1 < most[0] <= t.expire_concurrency
+assert elapsed < len(ids) * 0.01 / 2, elapsed
+assert [ e['expired'] for e in received ] == [ 50, 100, 150, 200 ]
+assert all(e['total'] == len(ids) and e['rate'] > 0 for e in received)
+
+s.responses['qry'] = 'OK - Number of results: 0\n\n'
+try:
+    t.expire_sessions('/missing', 'vhost1')
+    assert False, 'expire_sessions should have failed'
+except TomcatError as e:
+    assert 'Unable to find context' in str(e), e
+
+# managers are listed a few at a time, counts need no invoke at all
+s.responses['qry'] = 'OK - Number of results: 40\n\n' + ''.join(
+    'Name: Catalina:type=Manager,context=/app{0},host=vhost1\n'
+    'activeSessions: 3\n\n'.format(i) for i in range(40))
+(running[0], most[0]) = (0, 0)
+def list_ids(path):
+    with lock:
+        running[0] += 1
+        most[0] = max(most[0], running[0])
+    time.sleep(0.01)
+    with lock:
+        running[0] -= 1
+    return 'OK - Operation listSessionIds returned:\nA B C \n'
+s.responses['invoke'] = list_ids
+rv = t.list_sessions(vhost='vhost1')
+assert len(rv) == 40 and all(v == [ 'A', 'B', 'C' ] for v in rv.values())
+assert 1 < most[0] <= t.session_concurrency
+most[0] = 0
+assert set(t.list_sessions(vhost='vhost1', counts_only=True).values()) == set([ 3 ])
+lazy = t.list_sessions(vhost='vhost1', lazy=True)
+assert most[0] == 0
+assert list(lazy['/app7']) == [ 'A', 'B', 'C' ] and most[0] == 1
+
+t.pool.close()
+s.shutdown()
+print "Selftest OK"
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import BaseHTTPServer, SocketServer, threading, urlparse, zlib
+
+class JMXStubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    A local HTTP/1.1 server imitating the Manager text and JMX Proxy
+    interfaces of Tomcat. Responses are looked up from the responses dict
+    by request parameter ('qry', 'get', 'invoke' or the manager command),
+    falling back to the 'default' entry. A response may also be a
+    callable receiving the request path. delay is added to every request
+    and connect_delay to every new connection (e.g. to emulate a TLS
+    handshake over a WAN link). Several servers may listen on the same
+    port of different loopback addresses (127.0.0.2 etc.) to emulate
+    cluster members. With compression ('gzip', 'deflate', 'raw-deflate'
+    for a deflate stream without zlib headers, or 'identity') responses
+    are sent with that Content-Encoding to clients accepting it. Idle
+    keep-alive connections are closed after keep_alive_timeout seconds.
+
+    >>> s = JMXStubServer({ 'qry': 'OK - Number of results: 0\\n\\n' })
+    >>> t = Tomcat('127.0.0.1', port=s.port)
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, responses, delay=0, connect_delay=0,
+                 host='127.0.0.1', port=0, compression=None,
+                 keep_alive_timeout=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _JMXStubHandler)
+        self.responses = responses
+        self.compression = compression
+        self.keep_alive_timeout = keep_alive_timeout
+        self.delay = delay
+        self.connect_delay = connect_delay
+        self.port = self.server_address[1]
+        self.requests = 0
+        self.connections = 0
+        # Body size of the last response on the wire
+        self.last_sent = 0
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def handle_error(self, request, client_address):
+        # clients are free to drop keep-alive connections at any time
+        pass
+
+    def response_for(self, path):
+        url = urlparse.urlparse(path)
+        params = urlparse.parse_qs(url.query)
+        for key in [ 'qry', 'get', 'invoke' ]:
+            if key in params and key in self.responses:
+                return self.responses[key]
+        command = url.path.rstrip('/').split('/')[-1]
+        return self.responses.get(command, self.responses.get('default', ''))
+
+class _JMXStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer the response like Tomcat does, small writes trigger delayed ACKs
+    wbufsize = 65536
+
+    def setup(self):
+        self.timeout = self.server.keep_alive_timeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+        if self.server.connect_delay:
+            threading.Event().wait(self.server.connect_delay)
+
+    def _respond(self):
+        self.server.requests += 1
+        length = int(self.headers.getheader('Content-Length', 0))
+        if length:
+            self.rfile.read(length)
+        if self.server.delay:
+            threading.Event().wait(self.server.delay)
+        body = self.server.response_for(self.path)
+        if callable(body):
+            body = body(self.path)
+        encoding = self.server.compression
+        accepted = self.headers.getheader('Accept-Encoding') or ''
+        if encoding and (encoding == 'identity' or
+                         encoding.split('-')[-1] in accepted):
+            (body, encoding) = _encode(body, encoding)
+        else:
+            encoding = None
+        self.server.last_sent = len(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT = _respond
+
+    def log_message(self, *args):
+        pass
+
+def _encode(body, encoding):
+    '''
+    Return the body compressed with encoding and the Content-Encoding
+    '''
+    if encoding == 'gzip':
+        c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        c = zlib.compressobj(6)
+    elif encoding == 'raw-deflate':
+        (c, encoding) = (zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS), 'deflate')
+    else:
+        return (body, encoding)
+    return (c.compress(body) + c.flush(), encoding)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import os,sys,time
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat.parser import parse
+
+testdata = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+memory_bean = '''Name: java.lang:type=MemoryPool,name=Pool{0}
+Name: Pool{0}
+Usage: javax.management.openmbean.CompositeDataSupport(compositeType=javax.management.openmbean.CompositeType(name=java.lang.management.MemoryUsage,items=((itemName=committed,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)),(itemName=init,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)),(itemName=max,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)),(itemName=used,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)))),contents={{committed=65404928, init=65404928, max=110362624, used=11296184}})
+MemoryManagerNames: Array[java.lang.String] of length 2
+\tConcurrentMarkSweep
+\tParNew
+UsageThreshold: 0.3
+Valid: true
+
+'''
+
+def search_response(count):
+    '''
+    Build a synthetic search result with count WebModule and MemoryPool beans
+    '''
+    with open(os.path.join(testdata, 'test1.txt')) as f:
+        webmodule = f.read().split('\n\n', 1)[1]
+    out = [ 'OK - Number of results: {0}\n\n'.format(count * 2) ]
+    for i in xrange(count):
+        out.append(webmodule.replace('//localhost/', '//localhost/app{0}'.format(i), 1))
+        out.append(memory_bean.format(i))
+    return ''.join(out)
+
+def bench(rule, data, rounds=3):
+    best = None
+    for i in xrange(rounds):
+        start = time.time()
+        parse(rule, data)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print '{0:<16} {1:>8.1f} KiB {2:>8.3f}s {3:>8.1f} MiB/s'.format(
+        rule, len(data) / 1024.0, best, len(data) / best / 1048576)
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    bench('search_results', search_response(count))
@@ -4,7 +4,8 @@ import os,sys
 parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0,parentdir)
 
-from tomcat.parser import parse
+from tomcat.parser import parse, compact
+from tomcat.error import TomcatError
 
 # Testing code below
 def test():
@@ -38,10 +39,25 @@ deploymentDescriptor: <!-- Blah, blah, ({ blah }), this   can not crash -->
 
     assert parse('search_results', input) == expected_output
 
+    for k, v in expected_output.items():
+        c = compact(v)
+        assert c == v and dict(c) == v and sorted(c.keys()) == sorted(v.keys())
+        assert c.get('missing') is None and not 'missing' in c
+    assert compact({'hostname': '10.0.0.6'})['hostname'] is compact({'hostname': '10.0.0.6'})['hostname']
+
+    attributes = [ 'Usage', 'MemoryPoolNames', 'hostname' ]
+    expected_output = dict((k, dict((a, v) for a, v in b.items() if a in attributes))
+                           for k, b in expected_output.items())
+    assert parse('search_results', input, attributes) == expected_output
+
     input = "OK - Attribute get 'java.lang:type=Memory' - HeapMemoryUsage = javax.management.openmbean.CompositeDataSupport(compositeType=javax.management.openmbean.CompositeType(name=java.lang.management.MemoryUsage,items=((itemName=committed,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)),(itemName=init,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)),(itemName=max,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)),(itemName=used,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)))),contents={committed=85000192, init=0, max=129957888, used=16825392})\n"
     expected_output = {'max': 129957888, 'init': 0, 'used': 16825392, 'committed': 85000192}
     assert parse('get_results', input) == expected_output
 
+    input = "OK - Attribute get 'x:type=Build' - Info = javax.management.openmbean.CompositeDataSupport(compositeType=javax.management.openmbean.CompositeType(name=x.BuildInfo,items=((itemName=enabled,itemType=javax.management.openmbean.SimpleType(name=java.lang.Boolean)),(itemName=number,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)),(itemName=owner,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)),(itemName=version,itemType=javax.management.openmbean.SimpleType(name=java.lang.String)))),contents={enabled=true, number=42, owner=null, version=0002})\n"
+    expected_output = {'enabled': True, 'number': 42, 'owner': 'null', 'version': '0002'}
+    assert parse('get_results', input) == expected_output
+
     input = "OK - Attribute get 'java.lang:type=Memory' - HeapMemoryUsage - key 'max' = 129957888\n"
     expected_output = 129957888
     assert parse('get_results', input) == expected_output
@@ -74,6 +90,18 @@ deploymentDescriptor: <!-- Blah, blah, ({ blah }), this   can not crash -->
     expected_output = [{'blockedTime': -1, 'blockedCount': 0, 'lockedSynchronizers': '[Ljavax.management.openmbean.CompositeData;@7317325c', 'lockName': 'com.sun.jmx.remote.internal.ArrayNotificationBuffer@d2a7c1e', 'lockedMonitors': '[Ljavax.management.openmbean.CompositeData;@43684726', 'waitedCount': 1032, 'stackTrace': '[Ljavax.management.openmbean.CompositeData;@77eb710b', 'waitedTime': -1, 'threadState': 'TIMED_WAITING', 'threadName': 'RMI TCP Connection(39)-192.168.56.1', 'lockOwnerName': 'null', 'lockOwnerId': -1, 'suspended': False, 'threadId': 100, 'lockInfo': {'className': 'com.sun.jmx.remote.internal.ArrayNotificationBuffer', 'identityHashCode': 220888094}, 'inNative': False}]
     assert parse('invoke_results', input) == expected_output
 
+    for rule, input in [
+            ('search_results', 'OK - Number of results: 1\n\nName: x\nbroken\n\n'),
+            ('search_results', 'OK - Number of results: 1\n\nName: x\nkey: value\n'),
+            ('get_results', "OK - Attribute get 'x' - y = javax.management.openmbean.CompositeDataSupport(compositeType=x,contents={a=1\n"),
+            ('invoke_results', 'OK - Operation x returned:\n') ]:
+        try:
+            parse(rule, input)
+        except TomcatError:
+            pass
+        else:
+            raise AssertionError('{0} accepted invalid input {1!r}'.format(rule, input))
+
     print "Selftest PASSED"
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import os,sys,time,threading,logging
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import TomcatCluster, TomcatError
+
+class FakeTomcat:
+    '''
+    Deploys take slow seconds for the WARs listed in slow_wars, fast
+    seconds otherwise
+    '''
+    lock = threading.Lock()
+    running = 0
+    most = 0
+
+    def __init__(self, host, slow_wars, fast=0.02, slow=0.2):
+        (self.host, self.port) = (host, 8080)
+        (self.slow_wars, self.fast, self.slow) = (slow_wars, fast, slow)
+        self.deployed = []
+        self.running = 0
+        self.most = 0
+
+    def set_progress_callback(self, callback):
+        pass
+
+    def deploy(self, war, ctx, vhost='localhost'):
+        with self.lock:
+            FakeTomcat.running += 1
+            FakeTomcat.most = max(FakeTomcat.most, FakeTomcat.running)
+            self.running += 1
+            self.most = max(self.most, self.running)
+        try:
+            time.sleep(self.slow if war in self.slow_wars else self.fast)
+            if war == 'broken.war':
+                raise TomcatError('FAIL - Deploy Upload Failed')
+            self.deployed.append(war)
+        finally:
+            with self.lock:
+                FakeTomcat.running -= 1
+                self.running -= 1
+
+logging.getLogger('pytomcat').addHandler(logging.NullHandler())
+
+# each node is slow for a different WAR
+wars = [ 'app{0}.war'.format(i) for i in range(5) ]
+c = TomcatCluster()
+for i in range(4):
+    c.add_member(FakeTomcat('10.0.0.{0}'.format(i), wars[i::4]))
+hosts = sorted(c.members)
+
+# one cluster-wide barrier per WAR
+start = time.time()
+for w in wars:
+    assert not c.run_command('deploy', w, '/ctx').has_failures
+barrier = time.time() - start
+
+for t in c.members.values():
+    del t.deployed[:]
+tasks = [ (h, 'deploy', (w, '/ctx')) for h in hosts for w in wars ]
+start = time.time()
+rv = list(c.iter_tasks(tasks))
+pipelined = time.time() - start
+assert len(rv) == len(tasks)
+assert not any(isinstance(r[3], Exception) for r in rv)
+assert all(t.deployed == wars for t in c.members.values())
+assert all(t.most == 1 for t in c.members.values())
+# the slowest node does 2 slow and 3 fast deploys, instead of 5 slow ones
+assert pipelined < barrier * 0.7, (pipelined, barrier)
+
+# limits
+FakeTomcat.most = 0
+for t in c.members.values():
+    t.most = 0
+list(c.iter_tasks(tasks, threads=2))
+assert FakeTomcat.most == 2
+FakeTomcat.most = 0
+list(c.iter_tasks(tasks, per_host=2))
+assert max(t.most for t in c.members.values()) == 2
+assert FakeTomcat.most <= 8
+
+# nodes finish their own WARs before another node starts
+order = []
+for host, command, args, r in c.iter_tasks(tasks, threads=1):
+    order.append(host)
+assert order == sorted(order)
+
+# failures are reported per task
+tasks = [ (h, 'deploy', (w, '/ctx')) for h in hosts[:2]
+          for w in [ 'ok.war', 'broken.war' ] ]
+rv = dict(((h, a[0]), r) for h, cmd, a, r in c.iter_tasks(tasks))
+assert isinstance(rv[(hosts[0], 'broken.war')], TomcatError)
+assert rv[(hosts[1], 'ok.war')] is None
+assert list(c.iter_tasks([])) == []
+
+# tasks run on the shared pool, no threads are left behind
+threads = threading.active_count()
+for i in range(5):
+    list(c.iter_tasks(tasks))
+assert threading.active_count() == threads
+tasks = [ (h, 'deploy', (w, '/ctx')) for h in hosts for w in wars ]
+for t in c.members.values():
+    del t.deployed[:]
+for rv in c.iter_tasks(tasks, threads=2):
+    break
+time.sleep(0.5)
+assert threading.active_count() == threads
+assert sum(len(t.deployed) for t in c.members.values()) <= 3
+c.shutdown()
+print "Selftest OK"
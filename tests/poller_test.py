@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import os,sys,time,urlparse,logging
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import Tomcat, TomcatError, Poller, wait_until
+from jmxstub import JMXStubServer
+
+logging.getLogger('pytomcat').addHandler(logging.NullHandler())
+
+# intervals back off with jitter up to the cap, and start over on reset
+p = Poller(60, initial_interval=0.1, backoff=2, max_interval=1, jitter=0.2)
+p.end_time = time.time() + 60
+intervals = [ p.next_interval() for i in range(8) ]
+for i, expected in enumerate([ 0.1, 0.2, 0.4, 0.8, 1, 1, 1, 1 ]):
+    assert expected * 0.8 <= intervals[i] <= min(expected * 1.2, 1), intervals
+p.reset()
+assert p.next_interval() <= 0.12
+
+# the first attempt is immediate, the last one is at the deadline
+start = time.time()
+attempts = []
+assert not Poller(0.5, max_interval=0.1).wait(
+    lambda: attempts.append(time.time() - start))
+assert attempts[0] < 0.05 and 0.5 <= attempts[-1] < 0.6, attempts
+assert 5 < len(attempts) < 20
+
+# a condition holding after 0.3s is noticed well before a fixed 5s poll
+start = time.time()
+assert wait_until(lambda: time.time() - start > 0.3, 10)
+assert time.time() - start < 0.8
+assert Poller(0).wait(lambda: True) and not Poller(0).wait(lambda: False)
+
+class Restarter:
+    def restart(self):
+        self.time = time.time()
+
+def webmodule(ctx, state):
+    return ('Name: Catalina:j2eeType=WebModule,name=//localhost{0},'
+            'J2EEApplication=none,J2EEServer=none\nname: {0}\n'
+            'stateName: {1}\n\n'.format(ctx, state))
+
+(restarter, polls) = (Restarter(), [])
+def server_state():
+    # down for 0.3s, then /app takes 0.3s to start, /stopped never does
+    elapsed = time.time() - getattr(restarter, 'time', time.time() - 10)
+    return ('STOPPING' if elapsed < 0.3 else 'STARTED',
+            'STARTING' if elapsed < 0.6 else 'STARTED')
+def get(path):
+    return "OK - Attribute get 'Catalina:type=Server' - stateName = {0}\n".format(
+               server_state()[0])
+def qry(path):
+    pattern = urlparse.parse_qs(urlparse.urlparse(path).query)['qry'][0]
+    polls.append(pattern)
+    apps = [ webmodule(c, s) for c, s in [ ('/app', server_state()[1]),
+                                           ('/stopped', 'STOPPED') ]
+             if pattern == 'Catalina:j2eeType=WebModule,name=//*/*,*'
+                or pattern.startswith('Catalina:j2eeType=WebModule,name=//*' + c + ',') ]
+    return 'OK - Number of results: {0}\n\n{1}'.format(len(apps), ''.join(apps))
+
+s = JMXStubServer({ 'get': get, 'qry': qry })
+t = Tomcat('127.0.0.1', port=s.port)
+t._restarter_obj = restarter
+start = time.time()
+t.restart(timeout=5)
+elapsed = time.time() - start
+assert 0.6 <= elapsed < 1.2, elapsed
+# only the webapps that were running are waited for
+assert all('/stopped' not in p for p in polls[1:]), polls
+
+# state polls bypass the JMX result cache
+t.jmx.enable_cache(ttl=2)
+del polls[:]
+start = time.time()
+t.restart(timeout=5)
+elapsed = time.time() - start
+assert 0.6 <= elapsed < 1.2, elapsed
+assert len(polls) > 2
+t.jmx.disable_cache()
+
+# the timeout covers the whole restart
+restarter.restart = lambda: None
+try:
+    t.restart(timeout=0.3)
+    assert False, 'restart should have timed out'
+except TomcatError as e:
+    assert 'shut down' in str(e), e
+
+t.pool.close()
+s.shutdown()
+print "Selftest OK"
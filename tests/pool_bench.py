@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+import os,sys,time,urllib2
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import Tomcat
+from jmxstub import JMXStubServer
+
+def bench(name, server, fn, count):
+    connections = server.connections
+    start = time.time()
+    for i in xrange(count):
+        fn()
+    elapsed = time.time() - start
+    print '{0:<36} {1:>8.0f} req/s {2:>6} new connections'.format(
+        name, count / elapsed, server.connections - connections)
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    response = "OK - Attribute get 'Catalina:type=Server' - stateName = STARTED\n"
+    for connect_delay in [ 0, 0.005 ]:
+        server = JMXStubServer({ 'get': response }, connect_delay=connect_delay)
+        t = Tomcat('127.0.0.1', port=server.port)
+        url = '{0}?get=Catalina%3Atype%3DServer&att=stateName'.format(t.jmx.baseurl)
+        def urlopen():
+            request = urllib2.Request(url)
+            request.add_header('Authorization', t.jmx.auth_header)
+            urllib2.urlopen(request, None, 10).read()
+
+        print 'Connection setup delay: {0}ms'.format(connect_delay * 1000)
+        bench('  urllib2 connection per request', server, urlopen, count)
+        bench('  Tomcat.server_status (pooled)', server, t.server_status, count)
+        t.pool.close()
+        server.shutdown()
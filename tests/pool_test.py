@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import os,sys,time,threading,logging
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import Tomcat, TomcatError
+from jmxstub import JMXStubServer
+
+logging.getLogger('pytomcat').addHandler(logging.NullHandler())
+
+QRY = 'OK - Number of results: 0\n\n'
+invoked = []
+
+def slow_invoke(path):
+    invoked.append(path)
+    threading.Event().wait(1.5)
+    return 'OK - Operation restart returned:\n'
+
+def dropped_invoke(path):
+    # e.g. a wrapper restart closing the connection while shutting down
+    invoked.append(path)
+    raise IOError('connection dropped')
+
+def expect_error(f, *args):
+    try:
+        f(*args)
+    except TomcatError:
+        return
+    assert False, 'TomcatError expected'
+
+s = JMXStubServer({ 'qry': QRY, 'invoke': slow_invoke })
+t = Tomcat('127.0.0.1', port=s.port)
+t.jmx.timeout = 1
+
+# A timed out invoke on a reused connection is sent once, and the caller
+# only waits for one timeout
+t.jmx.query('*:*')
+start = time.time()
+expect_error(t.jmx.invoke, 'Catalina:type=Service', 'restart')
+assert len(invoked) == 1 and time.time() - start < 1.5
+
+# A connection dropped by the server after receiving an invoke
+s.responses['invoke'] = dropped_invoke
+del invoked[:]
+t.jmx.query('*:*')
+expect_error(t.jmx.invoke, 'Catalina:type=Service', 'restart')
+assert len(invoked) == 1
+
+# Queries are not retried on a timeout either
+def slow_query(path):
+    invoked.append(path)
+    threading.Event().wait(1.5)
+    return QRY
+s.responses['qry'] = slow_query
+del invoked[:]
+expect_error(t.jmx.query, 'Catalina:type=Server')
+assert len(invoked) == 1
+t.pool.close()
+s.shutdown()
+
+# Idle connections closed by the server are not reused
+s = JMXStubServer({ 'qry': QRY }, keep_alive_timeout=0.2)
+t = Tomcat('127.0.0.1', port=s.port)
+t.jmx.query('*:*')
+t.jmx.query('*:*')
+assert s.connections == 1
+time.sleep(0.5)
+t.jmx.query('*:*')
+assert (s.connections, s.requests) == (2, 3)
+t.pool.close()
+s.shutdown()
+print "Selftest OK"
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import os,sys,threading,urlparse,logging
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import Tomcat, TomcatCluster
+from jmxstub import JMXStubServer
+
+logging.getLogger('pytomcat').addHandler(logging.NullHandler())
+
+class Node:
+    '''
+    Serves GlobalRequestProcessor and Runtime beans from counters
+    '''
+    def __init__(self):
+        self.start_time = 1000
+        self.counters = {
+            'http-nio-8080': dict(requestCount=1000, errorCount=10,
+                processingTime=20000, maxTime=500, bytesSent=10000000,
+                bytesReceived=100000),
+            'ajp-nio-8009': dict(requestCount=500, errorCount=0,
+                processingTime=5000, maxTime=300, bytesSent=2000000,
+                bytesReceived=50000) }
+
+    def add(self, connector, **deltas):
+        for k, v in deltas.items():
+            self.counters[connector][k] += v
+
+    def __call__(self, path):
+        qry = urlparse.parse_qs(urlparse.urlparse(path).query)['qry'][0]
+        if qry.startswith('java.lang:type=Runtime'):
+            beans = [ 'Name: java.lang:type=Runtime\nStartTime: {0}\n\n'
+                      .format(self.start_time) ]
+        else:
+            beans = [ 'Name: Catalina:type=GlobalRequestProcessor,name="{0}"\n{1}\n'
+                      .format(name, ''.join('{0}: {1}\n'.format(*kv)
+                                            for kv in c.items()))
+                      for name, c in self.counters.items() ]
+        return 'OK - Number of results: {0}\n\n{1}'.format(len(beans),
+                                                           ''.join(beans))
+
+(n1, n2) = (Node(), Node())
+servers = [ JMXStubServer({ 'qry': n }) for n in [ n1, n2 ] ]
+c = TomcatCluster()
+for s in servers:
+    c.add_member(Tomcat('127.0.0.1', port=s.port))
+c.enable_cache(ttl=60)
+(h1, h2) = [ '127.0.0.1:{0}'.format(s.port) for s in servers ]
+t = c.members[h1]
+
+# rates between two samples, counters are never served from the cache
+sample = t.request_counters()
+assert sample['connectors']['http-nio-8080']['requestCount'] == 1000
+n1.add('http-nio-8080', requestCount=200, errorCount=2, processingTime=3000,
+       bytesSent=400000, bytesReceived=20000)
+n1.add('ajp-nio-8009', requestCount=100, processingTime=500)
+sample['time'] -= 2
+rv = t.request_stats(sample=sample)
+http = rv['connectors']['http-nio-8080']
+assert 1.99 < http['elapsed'] < 2.1, http
+assert http['requestCount'] == 200 and not http['reset']
+assert 95 < http['requestsPerSecond'] <= 100.5
+assert http['meanLatency'] == 15.0 and http['errorRate'] == 0.01
+assert 195000 < http['bytesSentPerSecond'] <= 200000
+assert http['maxTime'] == 500
+total = rv['total']
+assert total['requestCount'] == 300 and 145 < total['requestsPerSecond'] <= 150.5
+assert abs(total['meanLatency'] - 3500 / 300.0) < 1e-9
+assert abs(total['errorRate'] - 2 / 300.0) < 1e-9 and total['maxTime'] == 500
+
+# a restart resets the counters
+sample = t.request_counters()
+n1.start_time = 2000
+for name in n1.counters:
+    n1.counters[name] = dict((k, 0) for k in n1.counters[name])
+n1.add('http-nio-8080', requestCount=50, processingTime=500)
+rv = t.request_stats(sample=sample)
+assert rv['connectors']['http-nio-8080']['reset']
+assert rv['connectors']['http-nio-8080']['requestCount'] == 50
+assert rv['total']['reset'] and rv['total']['meanLatency'] == 10.0
+# so does any counter going backwards
+n1.add('ajp-nio-8009', requestCount=20)
+sample = t.request_counters()
+n1.counters['ajp-nio-8009']['requestCount'] = 0
+rv = t.request_stats(sample=sample)
+assert rv['connectors']['ajp-nio-8009']['reset']
+assert not rv['connectors']['http-nio-8080']['reset']
+
+# cluster rollup
+def traffic():
+    for n, requests in [ (n1, 100), (n2, 300) ]:
+        n.add('http-nio-8080', requestCount=requests, processingTime=requests * 10)
+timer = threading.Timer(0.25, traffic)
+timer.start()
+rv = c.request_stats(interval=0.5)
+assert rv['failed'] == []
+assert rv['nodes'][h1]['total']['requestCount'] == 100
+assert rv['nodes'][h2]['total']['requestCount'] == 300
+assert rv['total']['requestCount'] == 400 and rv['total']['meanLatency'] == 10.0
+assert 700 < rv['total']['requestsPerSecond'] <= 800
+assert abs(rv['total']['requestsPerSecond'] - sum(
+    v['total']['requestsPerSecond'] for v in rv['nodes'].values())) < 1e-6
+
+# nodes that cannot be sampled are reported
+servers[1].responses['qry'] = 'FAIL - Unknown bean\n'
+rv = c.request_stats(interval=0)
+assert rv['failed'] == [ h2 ] and rv['nodes'].keys() == [ h1 ]
+
+for t in c.members.values():
+    t.pool.close()
+for s in servers:
+    s.shutdown()
+print "Selftest OK"
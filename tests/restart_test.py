@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import os,sys,time,threading,logging
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import TomcatError
+from tomcat.deployer import ClusterDeployer
+
+class FakeTomcat:
+    '''
+    Down for down seconds when restarted, other members list it as active
+    again rejoin seconds after that
+    '''
+    lock = threading.Lock()
+    events = []
+    # cached argument of every state poll
+    polls = []
+
+    def __init__(self, host, nodes, sessions, down=0.1, rejoin=0.1):
+        (self.host, self.port, self.nodes) = (host, 8080, nodes)
+        (self.sessions, self.down, self.rejoin) = (sessions, down, rejoin)
+        (self.restarted, self.back) = (None, 0)
+        self.dead = False
+
+    def set_progress_callback(self, callback):
+        pass
+
+    def load_info(self):
+        return { 'activeSessions': self.sessions, 'currentThreadsBusy': 1 }
+
+    def has_cluster(self):
+        return True
+
+    def server_status(self, cached=True):
+        self.polls.append(cached)
+        if self.dead or time.time() < self.back - self.rejoin:
+            return 'STOPPED'
+        return 'STARTED'
+
+    def active_members(self, cached=True):
+        self.polls.append(cached)
+        now = time.time()
+        return dict((n.host, { 'hostname': n.host }) for n in self.nodes
+                    if n is not self and not n.dead and now >= n.back)
+
+    def restart(self):
+        with self.lock:
+            self.events.append((time.time(), self.host, 'down'))
+        self.back = time.time() + self.down + self.rejoin
+        time.sleep(self.down)
+        if self.host.endswith('.9'):
+            raise TomcatError('Timed out waiting for {0} to boot up'.format(self.host))
+
+def out_of_rotation(nodes):
+    '''
+    Largest number of nodes out of rotation at the same time
+    '''
+    changes = sorted([ (t, 1) for t, h, e in FakeTomcat.events ] +
+                     [ (n.back, -1) for n in nodes if n.back ])
+    (most, current) = (0, 0)
+    for t, delta in changes:
+        current += delta
+        most = max(most, current)
+    return most
+
+logging.getLogger('pytomcat').addHandler(logging.NullHandler())
+
+def deployer(loads, **opts):
+    d = ClusterDeployer(host=None, user='admin', passwd='admin', cache_ttl=0,
+                        poll_interval=0.02, **opts)
+    nodes = []
+    for i, sessions in enumerate(loads):
+        nodes.append(FakeTomcat('10.0.0.{0}'.format(i), nodes, sessions))
+        d.c.add_member(nodes[-1])
+    del FakeTomcat.events[:]
+    del FakeTomcat.polls[:]
+    return (d, nodes)
+
+# least loaded first, one node at a time until nodes come back
+(d, nodes) = deployer([ 50, 10, 0, 30, 20, 40 ], restart_fraction=0.5)
+start = time.time()
+rv = d.restart()
+elapsed = time.time() - start
+order = [ h for t, h, e in FakeTomcat.events ]
+assert order[:4] == [ '10.0.0.2', '10.0.0.1', '10.0.0.4', '10.0.0.3' ], order
+assert sorted(order[4:]) == [ '10.0.0.0', '10.0.0.5' ], order
+assert sorted(rv) == sorted(d.c.members)
+assert all(0.2 <= v < 0.5 for v in rv.values()), rv
+assert FakeTomcat.events[1][0] >= nodes[2].back
+# the window grows to 3 nodes, half of the cluster stays in rotation
+assert out_of_rotation(nodes) == 3
+assert elapsed < sum(rv.values()) * 0.8, (elapsed, rv)
+# rotation and rejoin polls bypass the JMX result cache
+assert FakeTomcat.polls and not any(FakeTomcat.polls)
+
+# a node already out of rotation counts against the capacity floor
+(d, nodes) = deployer([ 0 ] * 6, restart_fraction=0.5)
+nodes[5].dead = True
+d.restart([ h for h in d.c.members if h != '10.0.0.5:8080' ])
+assert out_of_rotation(nodes) == 2
+
+# so does an explicit floor
+(d, nodes) = deployer([ 0 ] * 6, restart_fraction=0.5, restart_min_capacity=0.8)
+d.restart()
+assert out_of_rotation(nodes) == 1
+nodes[0].dead = True
+try:
+    d.restart([ h for h in d.c.members if h != '10.0.0.0:8080' ])
+    assert False, 'restart should have failed'
+except TomcatError as e:
+    assert 'in rotation' in str(e), e
+
+# no more nodes are restarted after a failure
+(d, nodes) = deployer([ 10 ] * 9 + [ 0 ], restart_fraction=0.2)
+try:
+    d.restart()
+    assert False, 'restart should have failed'
+except SystemExit:
+    pass
+assert [ h for t, h, e in FakeTomcat.events ] == [ '10.0.0.9' ]
+print "Selftest OK"
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import os,sys,urlparse,fnmatch
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import Tomcat, TomcatCluster, TomcatError
+from jmxstub import JMXStubServer
+
+def usage(used, max):
+    return ('javax.management.openmbean.CompositeDataSupport(compositeType='
+            'javax.management.openmbean.CompositeType(name=java.lang.management.MemoryUsage,'
+            'items=((itemName=max,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)),'
+            '(itemName=used,itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)))),'
+            'contents={{max={1}, used={0}}})'.format(used, max))
+
+beans = [
+    ('Catalina:type=Server', [ ('stateName', 'STARTED') ]),
+    ('java.lang:type=Threading', [ ('ThreadCount', '42'), ('PeakThreadCount', '50'),
+                                   ('DaemonThreadCount', '30') ]),
+    ('Wrapper:name=wrapper', [ ('ControlledByWrapper', 'true') ]),
+    ('Catalina:type=Cluster', [ ('clusterName', 'Catalina') ]),
+    ('Catalina:type=Cluster,component=Member,name=tcp://{10, 0, 0, 2}:4000',
+        [ ('hostname', '10.0.0.2'), ('ready', 'true'), ('failing', 'false'),
+          ('suspect', 'false') ]),
+    ('Catalina:type=Cluster,component=Member,name=tcp://{10, 0, 0, 3}:4000',
+        [ ('hostname', '10.0.0.3'), ('ready', 'false'), ('failing', 'false'),
+          ('suspect', 'false') ]),
+    ('java.lang:type=Memory', [ ('HeapMemoryUsage', usage(10, 100)),
+                                ('NonHeapMemoryUsage', usage(30, 200)),
+                                ('Verbose', 'false') ]),
+    ('java.lang:type=MemoryPool,name=CMS Old Gen', [ ('Usage', usage(60, 80)) ]),
+    ('Catalina:type=Host,host=localhost', [ ('name', 'localhost'), ('autoDeploy', 'true') ]),
+    ('Catalina:type=Connector,port=8080', [ ('protocol', 'HTTP/1.1'), ('port', '8080') ]),
+    ('Catalina:type=Connector,port=8009', [ ('protocol', 'AJP/1.3'), ('port', '8009') ]),
+    ('Catalina:j2eeType=WebModule,name=//localhost/,J2EEApplication=none,J2EEServer=none',
+        [ ('baseName', 'ROOT'), ('name', ''), ('path', ''), ('stateName', 'STARTED'),
+          ('webappVersion', ''), ('docBase', 'ROOT') ]),
+    ('Catalina:j2eeType=WebModule,name=//localhost/manager,J2EEApplication=none,J2EEServer=none',
+        [ ('baseName', 'manager'), ('name', '/manager'), ('path', '/manager'),
+          ('stateName', 'STARTED'), ('webappVersion', ''), ('docBase', 'manager') ]),
+    ('Catalina:type=Manager,context=/,host=localhost', [ ('activeSessions', '0') ]),
+    ('Catalina:type=Manager,context=/manager,host=localhost', [ ('activeSessions', '2') ]),
+]
+
+queries = []
+invokes = []
+
+def matches(name, pattern):
+    patterns = [ pattern ] + ([ pattern[:-2] ] if pattern.endswith(',*') else [])
+    return any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+def jmxproxy(path):
+    params = dict((k, v[0]) for k, v in
+                  urlparse.parse_qs(urlparse.urlparse(path).query).items())
+    if 'qry' in params:
+        queries.append(params['qry'])
+        found = [ (n, a) for n, a in beans if matches(n, params['qry']) ]
+        return 'OK - Number of results: {0}\n\n{1}'.format(len(found), ''.join(
+                   'Name: {0}\n{1}\n'.format(n, ''.join('{0}: {1}\n'.format(*kv)
+                                                        for kv in a))
+                   for n, a in found))
+    if 'get' in params:
+        attrs = dict(dict(beans).get(params['get'], []))
+        if not params['att'] in attrs:
+            return 'Error - Cannot find attribute\n'
+        value = attrs[params['att']]
+        if 'key' in params:
+            value = value.split(params['key'] + '=')[1].split(',')[0].split('}')[0]
+        return 'OK - Attribute get {0} - {1} = {2}\n'.format(
+                   params['get'], params['att'], value)
+    if 'invoke' in params:
+        invokes.append(params['op'])
+    if params.get('op') == 'dumpAllThreads':
+        return ('OK - Operation dumpAllThreads returned:\n'
+                '  "main" Id=1 RUNNABLE\n  "Finalizer" Id=3 WAITING\n')
+    if params.get('op') == 'listSessionIds':
+        return 'OK - Operation listSessionIds returned:\nA1 B2 \n'
+    if params.get('op') == 'findConnectors':
+        return ('OK - Operation findConnectors returned:\n'
+                '  Connector[HTTP/1.1-8080]\n  Connector[AJP/1.3-8009]\n')
+    return 'Error - unsupported request\n'
+
+server = JMXStubServer({ 'default': jmxproxy })
+t = Tomcat('127.0.0.1', port=server.port)
+
+s = t.snapshot()
+assert len(queries) == 10
+assert s.server_status() == t.server_status() == 'STARTED'
+assert s.thread_count() == 42
+assert s.can_restart() == t.can_restart() == True
+assert s.has_cluster() == t.has_cluster() == True
+assert s.cluster_name() == t.cluster_name() == 'Catalina'
+assert s.cluster_members() == t.cluster_members()
+assert s.active_members().keys() == t.active_members().keys()
+assert s.memory_info() == t.memory_info()
+assert s.memory_usage() == t.memory_usage()
+assert s.find_pools_over(50) == t.find_pools_over(50) == [ 'CMS Old Gen' ]
+assert s.max_heap() == t.max_heap() == 100
+assert s.max_nonheap() == t.max_nonheap() == 200
+assert s.vhosts() == t.vhosts()
+assert sorted(s.find_connectors()) == sorted(t.find_connectors())
+assert s.list_webapps() == t.list_webapps(attributes=Tomcat.webapp_attributes)
+assert s.list_webapps('/manager') == t.list_webapps('/manager', attributes=Tomcat.webapp_attributes)
+assert s.find_managers() == t.find_managers(attributes=[ 'activeSessions' ])
+assert s.list_sessions() == t.list_sessions() == { '/': [], '/manager': [ 'A1', 'B2' ] }
+assert s.list_sessions('/manager') == t.list_sessions('/manager')
+assert s.list_sessions(counts_only=True) == t.list_sessions(counts_only=True) \
+       == { '/': 0, '/manager': 2 }
+lazy = t.list_sessions(lazy=True)
+assert [ list(lazy[k]) for k in sorted(lazy) ] == [ [], [ 'A1', 'B2' ] ]
+lazy = s.list_sessions(lazy=True)
+assert [ list(lazy[k]) for k in sorted(lazy) ] == [ [], [ 'A1', 'B2' ] ]
+
+# snapshots are read-only and never do I/O
+del queries[:]
+s.memory_usage()
+assert queries == []
+try:
+    s.name = 'x'
+    assert False
+except AttributeError:
+    pass
+try:
+    s.list_webapps()['/']['stateName'] = 'STOPPED'
+    assert False
+except TypeError:
+    pass
+
+# only the queries of the requested sections are made
+s = t.snapshot([ 'status', 'memory' ])
+assert sorted(queries) == [ 'Catalina:type=Server', 'java.lang:type=Memory*,*' ]
+try:
+    s.list_webapps()
+    assert False
+except TomcatError:
+    pass
+
+# the thread dump is opt-in, it is invoked alongside the queries
+assert not 'dumpAllThreads' in invokes
+try:
+    s.dump_all_threads()
+    assert False
+except TomcatError:
+    pass
+del queries[:]
+s = t.snapshot([ 'status', 'thread_dump' ])
+assert queries == [ 'Catalina:type=Server' ]
+assert invokes.count('dumpAllThreads') == 1
+assert s.dump_all_threads() == t.dump_all_threads()
+assert s.server_status() == 'STARTED'
+
+c = TomcatCluster()
+c.add_member(t)
+rv = c.snapshot([ 'status' ])
+assert rv.results.values()[0].server_status() == 'STARTED'
+c.shutdown()
+
+t.pool.close()
+server.shutdown()
+print "Selftest OK"
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import os,sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import Tomcat
+from jmxstub import JMXStubServer
+
+class Line(str):
+    '''
+    A response line counting how many of its kind are still referenced
+    '''
+    live = 0
+    def __new__(cls, s):
+        Line.live += 1
+        return str.__new__(cls, s)
+    def __del__(self):
+        Line.live -= 1
+
+beans = ''.join('Name: Catalina:j2eeType=WebModule,name=//localhost/app{0},'
+                'J2EEApplication=none,J2EEServer=none\nname: /app{0}\n'
+                'path: /app{0}\nstateName: STARTED\nwebappVersion: \n\n'
+                .format(i) for i in range(5000))
+s = JMXStubServer({ 'qry': 'OK - Number of results: 5000\n\n' + beans })
+t = Tomcat('127.0.0.1', port=s.port)
+(lines_read, iter_lines) = ([ 0 ], t.jmx._iter_lines)
+def counting_lines(*args):
+    for l in iter_lines(*args):
+        lines_read[0] += 1
+        yield Line(l)
+t.jmx._iter_lines = counting_lines
+
+# beans are parsed as lines arrive, at most one bean's lines are held
+most = 0
+for name, webapp in t.iter_webapps():
+    most = max(most, Line.live)
+assert name == '/app4999' and most <= 7, most
+assert Line.live == 0 and len(t.pool._idle) == 1
+
+# stopping early leaves the rest of the response unread and the
+# connection is closed rather than returned to the pool
+lines_read[0] = 0
+for name, webapp in t.iter_webapps():
+    break
+assert name == '/app0' and lines_read[0] <= 10, lines_read
+assert Line.live == 0 and len(t.pool._idle) == 0
+webapps = t.list_webapps()
+assert len(webapps) == 5000 and s.connections == 2
+
+t.pool.close()
+s.shutdown()
+print "Selftest OK"
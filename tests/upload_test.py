@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import os,sys,tempfile,time,threading
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import Tomcat, TomcatCluster, WarFile, UploadScheduler
+from jmxstub import JMXStubServer
+
+data = os.urandom(3 * 1024 * 1024 + 12345)
+(fd, fn) = tempfile.mkstemp(suffix='.war')
+os.write(fd, data)
+os.close(fd)
+
+war = WarFile(fn)
+assert len(war) == len(data)
+
+# readers are independent, chunks are large whatever httplib asks for
+events = []
+def cb(**args):
+    events.append(args)
+(r1, r2) = (war.open(cb, url='a'), war.open())
+chunks = []
+while True:
+    chunk = r1.read(8192)
+    if not chunk:
+        break
+    assert len(chunk) <= r1.chunksize
+    chunks.append(str(chunk))
+    assert str(r2.read(8192)) == chunks[-1]
+assert ''.join(chunks) == data
+assert len(chunks) == 4
+assert [ e['position'] for e in events ] == [ i * r1.chunksize for i in range(4) ] + [ len(data) ]
+assert events[-1]['total'] == len(data) and events[-1]['url'] == 'a'
+assert all('rate' in e and 'elapsed' in e for e in events)
+
+# a request retried on a new connection starts over
+r1.seek(0)
+assert r1.tell() == 0 and str(r1.read(10)) == data[:r1.chunksize]
+
+# the same mapping is uploaded to every node
+received = []
+def deploy(path):
+    return 'OK - Deployed application at context path /test\n'
+servers = [ JMXStubServer({ 'deploy': deploy }) for i in range(3) ]
+c = TomcatCluster()
+for s in servers:
+    c.add_member(Tomcat('127.0.0.1', port=s.port))
+c.set_progress_callback(lambda **args: received.append(args))
+rv = c.run_command('deploy', war, '/test')
+assert not rv.has_failures, rv.failures
+done = [ e for e in received if 'position' in e and e['position'] == len(data) ]
+assert len(set(e['url'] for e in done)) == 3
+war.close()
+
+# locations take turns, or go one after the other
+sched = UploadScheduler()
+racks = { 'a1': 'A', 'a2': 'A', 'a3': 'A', 'b1': 'B', 'c1': 'C', 'c2': 'C' }
+hosts = sorted(racks)
+assert sched.order(hosts) == hosts
+assert sched.order(hosts, racks) == [ 'a1', 'b1', 'c1', 'a2', 'c2', 'a3' ]
+assert sched.order(hosts, lambda h: h[0], grouped=True) == hosts
+
+# bandwidth and concurrent uploads are limited, the ETA is reported
+(running, most) = ([ 0 ], [ 0 ])
+lock = threading.Lock()
+def slow_deploy(path):
+    with lock:
+        running[0] += 1
+        most[0] = max(most[0], running[0])
+    time.sleep(0.1)
+    with lock:
+        running[0] -= 1
+    return 'OK - Deployed application at context path /test\n'
+for s in servers:
+    s.responses['deploy'] = slow_deploy
+del received[:]
+bandwidth = 32 * 1024 * 1024
+sched = UploadScheduler(bandwidth=bandwidth, max_uploads=2)
+war = WarFile(fn, sched)
+sched.expect(len(war) * 3)
+start = time.time()
+rv = c.run_command('deploy', war, '/test')
+elapsed = time.time() - start
+assert not rv.has_failures, rv.failures
+assert most[0] <= 2
+assert sched.sent == len(data) * 3
+assert elapsed >= (sched.sent - bandwidth * sched.burst_interval) / float(bandwidth)
+(rate, eta) = sched.progress()
+assert 0 < rate <= bandwidth * 1.1 and eta == 0
+assert all(e['eta'] is not None for e in received if e.get('position'))
+war.close()
+
+# filenames still work, and so do empty files
+open(fn, 'w').close()
+empty = WarFile(fn)
+assert len(empty) == 0 and empty.open().read(8192) == ''
+empty.close()
+rv = c.run_command('deploy', fn, '/test')
+assert not rv.has_failures, rv.failures
+os.unlink(fn)
+
+for t in c.members.values():
+    t.pool.close()
+for s in servers:
+    s.shutdown()
+print "Selftest OK"
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import os,sys,tempfile,zipfile
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import TomcatError, validate_warfile, validate_warfiles
+from tomcat.deployer import parse_warfiles
+
+war_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_wars')
+def war(name):
+    return os.path.join(war_dir, name)
+
+def invalid(fn, require_descriptor=False):
+    try:
+        validate_warfile(fn, require_descriptor)
+    except TomcatError as e:
+        return str(e)
+    return None
+
+# static WARs are fine unless a descriptor is required
+for name in [ 'blank.war', 'hello.war', 'goodbye.war' ]:
+    assert invalid(war(name)) is None
+    assert 'no WEB-INF/web.xml' in invalid(war(name), True)
+# web.xml or annotated listeners
+for name in [ 'sess.war', 'slow.war', 'conditional.war' ]:
+    assert invalid(war(name), True) is None
+assert 'not a zip file' in invalid(war('corrupt.war'))
+
+tmpdir = tempfile.mkdtemp(prefix='pytomcat-warfile')
+def make_war(name, entries, compression=zipfile.ZIP_DEFLATED):
+    fn = os.path.join(tmpdir, name)
+    z = zipfile.ZipFile(fn, 'w', compression)
+    for k, v in entries:
+        z.writestr(k, v)
+    z.close()
+    return fn
+
+# damaged entries
+for compression in [ zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED ]:
+    fn = make_war('crc.war', [ ('index.html', 'hello world ' * 1000) ],
+                  compression)
+    data = open(fn, 'rb').read()
+    i = data.index('PK\x03\x04') + 30 + len('index.html') + 20
+    open(fn, 'wb').write(data[:i] + chr(ord(data[i]) ^ 0xff) + data[i + 1:])
+    assert 'index.html is corrupt' in invalid(fn), invalid(fn)
+
+# a truncated archive has no central directory
+open(fn, 'wb').write(data[:len(data) // 2])
+assert 'not a zip file' in invalid(fn)
+
+fn = make_war('xml.war', [ ('WEB-INF/web.xml', '<web-app><servlet></web-app>') ])
+assert 'malformed WEB-INF/web.xml' in invalid(fn)
+
+# annotations may come with a library
+jar = os.path.join(tmpdir, 'lib.jar')
+z = zipfile.ZipFile(jar, 'w')
+z.writestr('com/example/Servlet.class',
+           '\xca\xfe\xba\xbe..Ljavax/servlet/annotation/WebServlet;..')
+z.close()
+fn = make_war('lib.war', [ ('WEB-INF/lib/lib.jar', open(jar, 'rb').read()) ])
+assert invalid(fn, True) is None
+
+# all invalid files are reported at once, by worker processes
+good = make_war('good##001.war', [ ('index.html', 'ok') ])
+try:
+    validate_warfiles([ war('corrupt.war'), good, war('hello.war'),
+                        os.path.join(tmpdir, 'xml.war') ], processes=2)
+    assert False, 'validation should have failed'
+except TomcatError as e:
+    assert 'corrupt.war' in str(e) and 'xml.war' in str(e), e
+    assert not 'good' in str(e) and not 'hello' in str(e), e
+
+try:
+    parse_warfiles([ war('corrupt.war') ])
+    assert False, 'validation should have failed'
+except TomcatError:
+    pass
+assert parse_warfiles([ war('corrupt.war') ], validate=False) == \
+       { war('corrupt.war'): ('/corrupt', '/corrupt', None) }
+assert parse_warfiles([ good ]) == { good: ('/good##001', '/good', '001') }
+
+for f in os.listdir(tmpdir):
+    os.unlink(os.path.join(tmpdir, f))
+os.rmdir(tmpdir)
+print "Selftest OK"
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import os,sys,time,threading,urlparse,fnmatch
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat import Tomcat, TomcatCluster, ClusterWebappIndex
+from jmxstub import JMXStubServer
+
+def webmodule(template, path, version, state):
+    ctx = '{0}##{1}'.format(path, version)
+    attrs = { 'name': ctx, 'path': path, 'webappVersion': version,
+              'baseName': ctx[1:], 'stateName': state }
+    lines = [ 'Name: Catalina:j2eeType=WebModule,name=//localhost{0},'
+              'J2EEApplication=none,J2EEServer=none'.format(ctx) ]
+    for l in template:
+        k = l.split(':', 1)[0]
+        lines.append('{0}: {1}'.format(k, attrs[k]) if k in attrs else l)
+    return ('//localhost' + ctx, '\n'.join(lines) + '\n\n')
+
+class Node:
+    '''
+    Serves WebModule queries for a list of (object name, bean) tuples
+    '''
+    def __init__(self, beans):
+        self.beans = beans
+
+    def __call__(self, path):
+        qry = urlparse.parse_qs(urlparse.urlparse(path).query)['qry'][0]
+        pattern = qry.split('name=', 1)[1].split(',', 1)[0]
+        found = [ b for name, b in self.beans if fnmatch.fnmatch(name, pattern) ]
+        return ''.join([ 'OK - Number of results: {0}\n\n'.format(len(found)) ]
+                       + found)
+
+def bench(name, fn, repeat=1):
+    start = time.time()
+    for i in xrange(repeat):
+        rv = fn()
+    elapsed = (time.time() - start) / repeat
+    print '{0:<52} {1:>10.4f}s'.format(name, elapsed)
+    return rv
+
+if __name__ == '__main__':
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    contexts = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    # a WebModule without the large multi-line attributes
+    template = [ l for l in open(os.path.join(os.path.dirname(
+                     os.path.abspath(__file__)), 'testdata', 'test1.txt'))
+                 .read().split('\n\n')[1].splitlines()
+                 if ':' in l and not l.startswith(('\t', 'deploymentDescriptor',
+                                                   'Name:')) ]
+    beans = [ webmodule(template, '/app{0}'.format(i), '001', 'STARTED')
+              for i in xrange(contexts) ]
+    new = webmodule(template, '/app7', '002', 'STARTING')
+    fleet = [ Node(list(beans)) for i in xrange(nodes) ]
+    servers = [ JMXStubServer({ 'qry': n }) for n in fleet ]
+    c = TomcatCluster()
+    for s in servers:
+        c.add_member(Tomcat('127.0.0.1', port=s.port))
+    print 'Simulated fleet: {0} nodes, {1} webapps each'.format(nodes, contexts)
+
+    # a new version is deployed and the poller waits for it to start
+    for n in fleet[:nodes // 2]:
+        n.beans.append(new)
+    index = ClusterWebappIndex()
+    bench('Building the index (all webapps)',
+          lambda: c.update_webapp_index(index))
+    full = bench('webapp_status (all webapps, every poll)',
+                 lambda: c.webapp_status())
+    assert set(full) == set(index.contexts())
+    for ctx, v in full.items():
+        s = index.status(ctx)
+        v['presentOn'].sort()
+        s['presentOn'].sort()
+        assert s == v, (ctx, s, v)
+    assert not full['/app7##002']['coherent']
+    assert full['/app7##002']['clusterDetails']['stateName'].values() == \
+           [ 'STARTING' ] * (nodes // 2)
+
+    for n in fleet:
+        n.beans[-1:] = [ webmodule(template, '/app7', '002', 'STARTED') ]
+    rv = bench('update_webapp_index (1 context)',
+               lambda: c.update_webapp_index(index, contexts=[ '/app7##002' ]))
+    assert not rv.has_failures
+    assert index.is_coherent('/app7##002')
+    assert index.state('/app7##002') == 'STARTED'
+    bench('update_webapp_index (1 path, all versions)',
+          lambda: c.update_webapp_index(index, paths=[ '/app7' ]))
+    assert sorted(index.contexts('/app7')) == [ '/app7##001', '/app7##002' ]
+    assert index.latest('/app7') == '/app7##002'
+    assert len(index.contexts()) == contexts + 1
+
+    queries = 10000
+    bench('{0} is_coherent/state/latest queries'.format(queries),
+          lambda: [ (index.is_coherent('/app7##002'), index.state('/app1##001'),
+                     index.latest('/app7')) for i in xrange(queries) ])
+    full = c.webapp_status()
+    bench('{0} queries on webapp_status results'.format(queries),
+          lambda: [ (full['/app7##002']['coherent'],
+                     full['/app1##001']['stateName'],
+                     max(k for k, v in full.items() if v['path'] == '/app7'))
+                    for i in xrange(queries) ])
+
+    for t in c.members.values():
+        t.pool.close()
+    stopping = [ threading.Thread(target=s.shutdown) for s in servers ]
+    for t in stopping:
+        t.start()
+    for t in stopping:
+        t.join()
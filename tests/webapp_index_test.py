@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import os,sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from tomcat.webappindex import ClusterWebappIndex
+
+def app(ctx, state='STARTED'):
+    (path, sep, version) = ctx.partition('##')
+    return { 'stateName': state, 'path': path, 'webappVersion': version }
+
+def apps(*ctxs):
+    return dict((ctx, app(ctx)) for ctx in ctxs)
+
+hosts = [ 'n1:8080', 'n2:8080', 'n3:8080' ]
+idx = ClusterWebappIndex(hosts)
+for h in hosts:
+    assert idx.update(h, apps('/app##001', '/other')) == 2
+assert idx.is_coherent('/app##001') and idx.is_coherent('/other')
+assert idx.state('/app##001') == 'STARTED'
+assert idx.latest('/app') == '/app##001'
+# Nothing changed, nothing to apply
+assert idx.update('n1:8080', apps('/app##001', '/other')) == 0
+
+# Deploying a new version makes it the latest once any node has it, but it
+# is only coherent when all nodes do
+assert idx.update('n1:8080', apps('/app##001', '/app##002', '/other')) == 1
+assert idx.latest('/app') == '/app##002'
+assert sorted(idx.contexts('/app')) == [ '/app##001', '/app##002' ]
+assert idx.present_on('/app##002') == [ 'n1:8080' ]
+assert idx.is_present('/app##002', 'n1:8080')
+assert not idx.is_present('/app##002')
+assert not idx.is_coherent('/app##002')
+for h in hosts[1:]:
+    idx.update(h, apps('/app##001', '/app##002', '/other'))
+assert idx.is_coherent('/app##002')
+
+# A node in a different state breaks coherence until it catches up
+w = apps('/app##001', '/app##002', '/other')
+w['/app##002'] = app('/app##002', 'STOPPED')
+assert idx.update('n2:8080', w) == 1
+assert not idx.is_coherent('/app##002')
+assert idx.state('/app##002') is None
+s = idx.status('/app##002')
+assert s['stateName'] is None and s['path'] == '/app' and not s['coherent']
+assert s['clusterDetails']['stateName'] == {
+    'n1:8080': 'STARTED', 'n2:8080': 'STOPPED', 'n3:8080': 'STARTED' }
+idx.update('n2:8080', apps('/app##001', '/app##002', '/other'))
+assert idx.state('/app##002') == 'STARTED' and idx.is_coherent('/app##002')
+
+# A scoped update only touches the contexts in scope: /other is not
+# reported but is out of scope, so it stays; /app##001 is gone
+scope = lambda ctx, path: path == '/app'
+assert idx.update('n1:8080', apps('/app##002'), scope) == 1
+assert idx.present_on('/app##001') == [ 'n2:8080', 'n3:8080' ]
+assert idx.is_present('/other', 'n1:8080') and idx.is_coherent('/other')
+# Without a scope, whatever is not reported is removed
+assert idx.update('n1:8080', apps('/app##002')) == 1
+assert not idx.is_present('/other', 'n1:8080')
+assert idx.present_on('/other') == [ 'n2:8080', 'n3:8080' ]
+assert not idx.is_coherent('/other')
+
+# Removing a node: what it alone had goes away, the others no longer need
+# to be on it to be coherent
+idx.update('n1:8080', apps('/app##002', '/app##003', '/other'))
+assert idx.latest('/app') == '/app##003'
+idx.remove_node('n1:8080')
+assert sorted(idx.hosts) == [ 'n2:8080', 'n3:8080' ]
+assert not '/app##003' in idx
+assert idx.latest('/app') == '/app##002'
+assert idx.is_coherent('/app##001') and idx.is_coherent('/other')
+assert idx.present_on('/app##002') == [ 'n2:8080', 'n3:8080' ]
+
+# Removing the last context serving a path forgets the path
+for h in [ 'n2:8080', 'n3:8080' ]:
+    idx.update(h, apps('/other'))
+assert idx.paths() == [ '/other' ]
+assert idx.latest('/app') is None and idx.contexts('/app') == []
+assert idx.webapp_status().keys() == [ '/other' ]
+assert idx.webapp_status([ '/app##002' ]) == {}
+
+print "Selftest OK"
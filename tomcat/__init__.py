@@ -1,58 +1,67 @@
 #!/usr/bin/env python
 
-import re, os, logging, time
+import re, os, logging, time, threading, json, fnmatch, hashlib, zipfile, zlib
+import multiprocessing, Queue
+from cStringIO import StringIO
+from xml.etree import ElementTree
+from multiprocessing import TimeoutError
 from multiprocessing.pool import ThreadPool
-from multiprocessing.sharedctypes import Value
 from error import TomcatError
 from jmxproxy import JMXProxyConnection
-from manager import ManagerConnection
+from parser import compact
+from manager import ManagerConnection, WarFile, UploadScheduler
+from httppool import HTTPConnectionPool
+from webappindex import ClusterWebappIndex
+from poller import Poller
+import events
 
 class Tomcat:
     progress_callback = None
+    webapp_attributes = [ 'name', 'baseName', 'path', 'stateName', 'webappVersion' ]
+    # find_webapps lists all webapps at once rather than running more
+    # than this many queries
+    max_webapp_queries = 8
+    # JMX invokes in flight when expiring sessions one by one, and
+    # sessions between EXPIRE progress events
+    expire_concurrency = 8
+    expire_progress_interval = 500
+    # Session managers listed at a time
+    session_concurrency = 8
+    # Longest interval between polls while waiting for a restart
+    max_poll_interval = 2
 
     def __init__(self, host, user = 'admin', passwd = 'admin', port = 8080):
         (self.host, self.port) = (host, port)
         self.log = logging.getLogger('pytomcat.Tomcat')
         self.name = 'Tomcat at {0}:{1}'.format(host,port)
-        self.jmx = JMXProxyConnection(host, user, passwd, port)
-        self.mgr = ManagerConnection(host, user, passwd, port)
+        self.pool = HTTPConnectionPool(host, port)
+        self.jmx = JMXProxyConnection(host, user, passwd, port, pool=self.pool)
+        self.mgr = ManagerConnection(host, user, passwd, port, pool=self.pool)
 
-    def memory_info(self):
+    def memory_info(self, cached=True):
         '''
-        Get memory pools, sizes and allocation information
+        Get memory pools, sizes and allocation information. Pass
+        cached=False to bypass the JMX result cache (e.g. when polling).
 
         >>> t.memory_info()
         { 'HeapMemory': {'max': 129957888, 'init': 0, 'used': 16853056, 'committed': 85000192}, ... }
         '''
-        data = self.jmx.query('java.lang:type=Memory*,*')
-        meminfo = {}
-
-        generic = data.pop('java.lang:type=Memory')
-        for k in [ 'NonHeapMemoryUsage', 'HeapMemoryUsage' ]:
-            meminfo.update({ k.replace('Usage',''): generic[k] })
-
-        for k, v in data.iteritems():
-            if k.startswith('java.lang:type=MemoryPool,'):
-                name = k.replace('java.lang:type=MemoryPool,name=','')
-                meminfo.update({ name: v['Usage']})
-
-        return meminfo
+        (qry, attributes) = _MEMORY_QUERY
+        return _memory_info(self.jmx.iter_query(qry, attributes, cached),
+                            self.name)
 
-    def memory_usage(self):
+    def memory_usage(self, cached=True):
         '''
         Get memory pool usage as percentage of allowed maximum.
 
         >>> t.memory_usage()
         { 'HeapMemory': 10, 'NonHeapMemory': 15, ... }
         '''
-        usage = {}
-        for k, v in self.memory_info().iteritems():
-            usage[k] = 100 * v['used'] / v['max']
-
-        return usage
+        return _memory_usage(self.memory_info(cached))
         
-    def find_pools_over(self, percentage):
-        return list(k for k, v in self.memory_usage().iteritems() if v > percentage)
+    def find_pools_over(self, percentage, cached=True):
+        return list(k for k, v in self.memory_usage(cached).iteritems()
+                    if v > percentage)
 
     def run_gc(self):
         '''
@@ -86,11 +95,12 @@ class Tomcat:
         '''
         Return true if this instance of Tomcat is member of a cluster
         '''
-        return len(self.jmx.query('Catalina:type=Cluster')) > 0
+        return len(self.jmx.query('Catalina:type=Cluster', [])) > 0
 
-    def server_status(self):
+    def server_status(self, cached=True):
         '''
-        Return the state name of the Tomcat server component.
+        Return the state name of the Tomcat server component. Pass
+        cached=False to bypass the JMX result cache (e.g. when polling).
 
         >>> t.server_status()
         'STARTED'
@@ -99,7 +109,7 @@ class Tomcat:
         http://tomcat.apache.org/tomcat-7.0-doc/api/org/apache/catalina/Lifecycle.html
         http://tomcat.apache.org/tomcat-7.0-doc/api/org/apache/catalina/LifecycleState.html
         '''
-        return self.jmx.get('Catalina:type=Server', 'stateName')
+        return self.jmx.get('Catalina:type=Server', 'stateName', cached=cached)
 
     @property
     def _restarter(self):
@@ -131,46 +141,65 @@ class Tomcat:
 
     def restart(self, timeout=600):
         '''
-        Restart this instance of Tomcat.
+        Restart this instance of Tomcat and wait (at most timeout seconds
+        in total) for it to shut down, boot up and start the webapps that
+        were running before. Polls back off from a short interval up to
+        max_poll_interval seconds, see Poller.
         Restarting will only work if Tomcat is launched by a supported wrapper
         which exposes restarting functionality via JMX.
 
         >>> t.restart()
         '''
+        end_time = time.time() + timeout
+        def poller():
+            return Poller(max(end_time - time.time(), 0),
+                          max_interval=self.max_poll_interval)
         def started():
             try:
-                return self.server_status() == 'STARTED'
-            except: 
-                return False
-        def apps_started(apps):
-            try:
-                all_restarted = False
-                max_attempts = 5
-                attempts = 0
-                while not all_restarted:
-                    current_apps = map(lambda x: (x['baseName'], x['stateName']=='STARTED') ,self.list_webapps().values())
-                    original_apps = map(lambda x: (x, True), apps)
-                    all_restarted = all_restarted or set(original_apps).issubset(set(current_apps))
-                    attempts += 1
-                    if attempts >= max_attempts:
-                        break
-                return all_restarted
-            except:
+                return self.server_status(cached=False) == 'STARTED'
+            except Exception as e:
+                self.log.debug('Polling the state of %s: %s', self.name, e)
                 return False
-        apps = map(lambda x: x['baseName'], self.list_webapps().values())
+        apps = [ k for k, v in self.iter_webapps(attributes=[ 'stateName' ])
+                 if v['stateName'] == 'STARTED' ]
         if not self.can_restart():
             raise TomcatError('{0} does not support remote restarting'
                               .format(self.name))
         self._restarter.restart()
-        if not wait_until(lambda: not started(), timeout):
+        if not poller().wait(lambda: not started()):
             raise TomcatError('Timed out waiting for {0} to shut down'
                               .format(self.name))
-        if not wait_until(started, timeout):
+        if not poller().wait(started):
             raise TomcatError('Timed out waiting for {0} to boot up'
                               .format(self.name))
-        if not wait_until(lambda: apps_started(apps), timeout):
+        pending = self._wait_for_webapps(apps, poller())
+        if pending:
             raise TomcatError('Timed out waiting for applications ({0}) to boot up'
-                              .format(apps))
+                              .format(', '.join(sorted(pending))))
+
+    def _wait_for_webapps(self, contexts, poller, vhost='*'):
+        '''
+        Poll the state of the webapps until all of them are STARTED, the
+        interval goes back to the shortest whenever one of them starts.
+        Returns the contexts that did not start in time.
+        '''
+        pending = set(contexts)
+        for attempt in poller:
+            if not pending:
+                break
+            try:
+                apps = self.find_webapps(contexts=pending, vhost=vhost,
+                                         attributes=[ 'stateName' ],
+                                         cached=False)
+            except Exception as e:
+                self.log.debug('Polling webapps of %s: %s', self.name, e)
+                continue
+            started = set(k for k, v in apps.iteritems()
+                          if v['stateName'] == 'STARTED')
+            if pending & started:
+                pending -= started
+                poller.reset()
+        return pending
 
     def cluster_name(self):
         '''
@@ -178,32 +207,43 @@ class Tomcat:
         '''
         return self.jmx.get('Catalina:type=Cluster', 'clusterName')
 
-    def cluster_members(self):
+    def cluster_members(self, cached=True):
         '''
         Return all members of the cluster
 
         >>> map(lambda x: x['hostname'], t.cluster_members().values())
         ['192.168.56.101', '192.168.56.102', '192.168.56.103']
         '''
-        invalid_ips = [ '0.0.0.0', '255.255.255.255' ]
-        def is_valid(m):
-            return ( m['hostname'] not in invalid_ips )
-        m = self.jmx.query('Catalina:type=Cluster,component=Member,*')
-        return dict((k, v) for k, v in m.iteritems() if is_valid(v))
+        return _valid_members(self.jmx.iter_query(_MEMBERS_QUERY,
+                                                  cached=cached))
 
-    def active_members(self):
+    def active_members(self, cached=True):
         '''
         Return only active members of the cluster
         '''
-        def is_active(m):
-            return ( m['ready'] and not m['failing'] and not m['suspect'] )
+        return _active_members(self.cluster_members(cached))
 
-        m = self.cluster_members()
-        return dict((k, v) for k, v in m.iteritems() if is_active(v))
+    def load_info(self):
+        '''
+        Return the traffic this instance is carrying: active sessions of all
+        webapps and request threads busy in all connectors
 
-    def list_webapps(self, app='*', vhost='*'):
+        >>> t.load_info()
+        {'activeSessions': 12, 'currentThreadsBusy': 3}
+        '''
+        sessions = self.list_sessions(counts_only=True)
+        pools = self.jmx.iter_query('Catalina:type=ThreadPool,*',
+                                    [ 'currentThreadsBusy' ])
+        return { 'activeSessions': sum(sessions.values()),
+                 'currentThreadsBusy': sum(v.get('currentThreadsBusy') or 0
+                                           for k, v in pools) }
+
+    def list_webapps(self, app='*', vhost='*', attributes=None, cached=True):
         '''
-        List webapps running on the specified host
+        List webapps running on the specified host.
+        Pass attributes (e.g. Tomcat.webapp_attributes) to only retrieve
+        the listed WebModule attributes, and cached=False to bypass the
+        JMX result cache (e.g. when polling).
 
         >>> for v in t.list_webapps().values():
         ...     print '{baseName:<20} {path:<20} {stateName}'.format(**v)
@@ -219,26 +259,53 @@ class Tomcat:
         http://tomcat.apache.org/tomcat-7.0-doc/api/org/apache/catalina/Lifecycle.html
         http://tomcat.apache.org/tomcat-7.0-doc/api/org/apache/catalina/LifecycleState.html
         '''
-        def sanitize_name(name):
-            return '/' if name == None else name
-        rv = self.jmx.query(
-                   'Catalina:j2eeType=WebModule,name=//{0}/{1},*'
-                   .format(vhost, re.sub('^/', '', app)))
-        return dict((sanitize_name(v['name']),v) for k, v in rv.iteritems())
+        return dict(self.iter_webapps(app, vhost, attributes, cached))
 
-    def find_managers(self, app='*', vhost='*'):
+    def iter_webapps(self, app='*', vhost='*', attributes=None, cached=True):
         '''
-        TODO
+        Same as list_webapps, but yields (name, webapp) tuples as they are
+        received, so the caller may stop early without reading the rest
+
+        >>> any(v['stateName'] != 'STARTED' for k, v in t.iter_webapps())
+        False
+        '''
+        (qry, attributes) = _webapps_query(app, vhost, attributes)
+        return _webapps(self.jmx.iter_query(qry, attributes, cached))
+
+    def find_webapps(self, contexts=(), paths=(), vhost='*', attributes=None,
+                     cached=True):
         '''
-        def extract_context(mgr_id):
-            # FIXME: depends on the exact ordering of parts in the object ID
-            return re.match(
-                       '^Catalina:type=Manager,context=(.+?),host=(.+?)',
-                       mgr_id).group(1)
-        rv = self.jmx.query(
-                   'Catalina:type=Manager,context={0},host={1}'
-                   .format(app, vhost))
-        return dict((extract_context(k),v) for k, v in rv.iteritems())
+        Same as list_webapps, but only returns the webapps named in contexts
+        or serving one of paths (any version), querying just those instead
+        of every webapp on the host
+
+        >>> t.find_webapps(paths=[ '/app' ], attributes=[ 'stateName' ]).keys()
+        ['/app##001', '/app##002']
+        '''
+        (contexts, paths) = (set(contexts), set(paths))
+        patterns = list(contexts) + [ p + s for p in paths for s in ('', '##*') ]
+        if len(patterns) > self.max_webapp_queries:
+            attrs = attributes
+            if attrs is not None and 'path' not in attrs:
+                attrs = list(attrs) + [ 'path' ]
+            return dict((k, v) for k, v in self.iter_webapps('*', vhost, attrs, cached)
+                        if k in contexts or v.get('path') in paths)
+        rv = {}
+        for p in patterns:
+            rv.update(self.iter_webapps(p, vhost, attributes, cached))
+        return rv
+
+    def find_managers(self, app='*', vhost='*', attributes=None):
+        '''
+        Return session managers of the matching webapps keyed by context.
+        Pass attributes to only retrieve the listed Manager attributes
+        ('objectName' is always present).
+
+        >>> t.find_managers('/manager', attributes=[ 'activeSessions' ])
+        {'/manager': {'activeSessions': 1, 'objectName': 'Catalina:type=Manager,context=/manager,host=localhost'}}
+        '''
+        return _managers(self.jmx.iter_query(
+                   _managers_query(app, vhost), attributes))
 
     def _list_session_ids(self, mgr_obj_id):
         ids = self.jmx.invoke(mgr_obj_id, 'listSessionIds')
@@ -247,16 +314,38 @@ class Tomcat:
         else:
             return ids.rstrip().split(' ')
 
-    def list_sessions(self, app='*', vhost='*'):
+    def _iter_session_ids(self, mgr_obj_id):
+        ids = self.jmx.invoke(mgr_obj_id, 'listSessionIds')
+        for m in re.finditer('\\S+', ids or ''):
+            yield m.group(0)
+
+    def list_sessions(self, app='*', vhost='*', counts_only=False, lazy=False):
         '''
-        TODO
+        Return the active session IDs of the matching webapps keyed by
+        context. The session managers are queried session_concurrency at
+        a time. With counts_only only the number of active sessions is
+        returned, without listing any IDs. With lazy every context gets
+        an iterator instead, its IDs are only listed when it is consumed.
+
+        >>> t.list_sessions('/manager')
+        {'/manager': ['A1', 'B2']}
+        >>> t.list_sessions(counts_only=True)
+        {'/': 0, '/manager': 2}
+        >>> next(t.list_sessions('/manager', lazy=True)['/manager'])
+        'A1'
         '''
-        rv = {}
-        for k, v in self.find_managers(app, vhost).iteritems():
-            if v['activeSessions'] > 0:
-                rv[k] = self._list_session_ids(v['objectName'])
-            else:
-                rv[k] = []
+        mgrs = self.find_managers(app, vhost, [ 'activeSessions' ])
+        if counts_only:
+            return dict((k, v['activeSessions']) for k, v in mgrs.iteritems())
+        active = [ (k, v['objectName']) for k, v in mgrs.iteritems()
+                   if v['activeSessions'] > 0 ]
+        rv = dict((k, iter(()) if lazy else []) for k in mgrs)
+        if lazy:
+            rv.update((k, self._iter_session_ids(o)) for k, o in active)
+        else:
+            ids = _concurrently([ lambda o=o: self._list_session_ids(o)
+                                  for k, o in active ], self.session_concurrency)
+            rv.update(zip([ k for k, o in active ], ids))
         return rv
 
     def undeploy_old_versions(self, vhost=None):
@@ -289,6 +378,41 @@ class Tomcat:
         '''
         return self.jmx.invoke('Catalina:type=Service', 'findConnectors')
 
+    def request_counters(self):
+        '''
+        Return the cumulative request counters of each connector (see
+        request_stats), read bypassing the JMX result cache, along with
+        the time they were read at and the start time of the JVM
+
+        >>> t.request_counters()['connectors']
+        {'http-nio-8080': {'requestCount': 1234, 'errorCount': 2, 'processingTime': 56789, 'maxTime': 812, 'bytesSent': 4567890, 'bytesReceived': 12345}}
+        '''
+        (processors, runtime) = _concurrently([
+            lambda: self.jmx.query(_REQUEST_PROCESSORS_QUERY,
+                                   _REQUEST_COUNTERS + [ 'maxTime' ], cached=False),
+            lambda: self.jmx.query('java.lang:type=Runtime', [ 'StartTime' ],
+                                   cached=False) ])
+        return { 'time': time.time(),
+                 'startTime': runtime.get('java.lang:type=Runtime', {}).get('StartTime'),
+                 'connectors': _request_processors(processors) }
+
+    def request_stats(self, interval=1, sample=None):
+        '''
+        Return request throughput, latency, error rate and bandwidth per
+        connector and for the whole node, computed from two samples of the
+        request counters taken interval seconds apart (or from sample, a
+        previous result of request_counters, to now). Counters reset by a
+        restart between the samples are counted from zero and reported
+        with 'reset'. Latencies are in milliseconds.
+
+        >>> t.request_stats(interval=5)['total']
+        {'requestCount': 600, 'requestsPerSecond': 120.0, 'meanLatency': 14.2, 'errorCount': 3, 'errorRate': 0.005, 'maxTime': 812, 'bytesSent': 3145728, 'bytesSentPerSecond': 629145.6, 'bytesReceived': 61440, 'bytesReceivedPerSecond': 12288.0, 'processingTime': 8520, 'elapsed': 5.0, 'reset': False}
+        '''
+        if sample is None:
+            sample = self.request_counters()
+            time.sleep(interval)
+        return _request_stats(sample, self.request_counters())
+
     def max_heap(self):
         return self.jmx.get('java.lang:type=Memory', 'HeapMemoryUsage', 'max')
 
@@ -297,14 +421,18 @@ class Tomcat:
 
     def deploy(self, filename, context=None, vhost='localhost'):
         '''
-        Deploy a Web application archive (WAR)
+        Deploy a Web application archive (WAR), filename may also be a
+        WarFile to share between several deploys
 
         >>> t.deploy('/tmp/myapp.war')
         '''
-        (ctx, path, version) = parse_warfile(filename)
+        (ctx, path, version) = parse_warfile(getattr(filename, 'name', filename))
         if context == None:
             context = ctx
-        return self.mgr.deploy(filename, context, vhost)
+        try:
+            return self.mgr.deploy(filename, context, vhost)
+        finally:
+            self.jmx.invalidate_cache()
 
     def undeploy(self, context, vhost='localhost'):
         '''
@@ -312,35 +440,124 @@ class Tomcat:
 
         >>> t.undeploy('/myapp')
         '''
-        self.mgr.undeploy(context, vhost)
+        try:
+            self.mgr.undeploy(context, vhost)
+        finally:
+            self.jmx.invalidate_cache()
 
     def _expire_session(self, mgr_obj_id, session_id):
         self.jmx.invoke(mgr_obj_id, 'expireSession', session_id)
 
     def expire_sessions(self, app, vhost = '*'):
         '''
-        Forcefully expire ALL active sessions in a webapp
+        Forcefully expire ALL active sessions in a webapp. Every matching
+        context is expired with a single request to the expire command of
+        the Manager text interface, falling back to expiring the sessions
+        one by one over JMX, expire_concurrency at a time. EXPIRE progress
+        events report the expired sessions and the rate per second.
+        Returns the number of expired sessions by context.
 
         >>> t.expire_sessions('/manager')
+        {'/manager': 1}
         '''
-        sessions = self.list_sessions(app, vhost)
-        if len(sessions) <= 0:
+        mgrs = self.find_managers(app, vhost, [ 'activeSessions' ])
+        if len(mgrs) <= 0:
             raise TomcatError("Unable to find context '{0}' from vhost '{1}'"
                               .format(app, vhost))
+        rv = {}
+        for ctx, mgr in mgrs.iteritems():
+            start = time.time()
+            total = mgr['activeSessions']
+            if total <= 0:
+                rv[ctx] = 0
+                continue
+            host = re.search('[:,]host=([^,]+)', mgr['objectName']).group(1)
+            try:
+                try:
+                    rv[ctx] = self.mgr.expire(ctx, 0, host)
+                finally:
+                    self.jmx.invalidate_cache()
+            except TomcatError as e:
+                self.log.debug("Expiring the sessions of %s with the manager "
+                               "failed, expiring them one by one: %s", ctx, e)
+                rv[ctx] = self._expire_each(ctx, mgr['objectName'], start)
+            self._expire_progress(ctx, rv[ctx], rv[ctx], start)
+        return rv
 
-        mgrs = self.find_managers(app, vhost)
-        for ctx, ids in sessions.iteritems():
-            for id in ids:
-                if not ctx in mgrs:
-                    raise TomcatError(
-                              "Unable to find manager for context '{0}' from vhost '{1}'"
-                              .format(app, vhost))
-                self._expire_session(mgrs[ctx]['objectName'], id)
+    def _expire_progress(self, ctx, expired, total, start):
+        if self.progress_callback != None:
+            elapsed = time.time() - start
+            try:
+                self.progress_callback(event=events.EXPIRE, node=self.name,
+                    context=ctx, expired=expired, total=total,
+                    elapsed=elapsed,
+                    rate=expired / elapsed if elapsed > 0 else 0.0)
+            except Exception as e:
+                self.log.error('running progress callback: %s', e)
+
+    def _expire_each(self, ctx, mgr_obj_id, start):
+        ids = self._list_session_ids(mgr_obj_id)
+        total = len(ids)
+        if total <= 0:
+            return 0
+        expired = 0
+        pool = ThreadPool(processes=min(self.expire_concurrency, total))
+        try:
+            for i in pool.imap_unordered(
+                    lambda id: self._expire_session(mgr_obj_id, id), ids):
+                expired += 1
+                if expired % self.expire_progress_interval == 0 and expired < total:
+                    self._expire_progress(ctx, expired, total, start)
+        finally:
+            pool.close()
+            pool.join()
+        return expired
 
     def set_progress_callback(self, callback):
         self.progress_callback = callback
         self.mgr.progress_callback = callback
 
+    def snapshot(self, sections=None):
+        '''
+        Capture the listed sections (default: all of them but thread_dump)
+        in as few JMX queries as possible, run concurrently. The returned
+        TomcatSnapshot answers the usual read-only questions without any
+        further requests. A thread dump is an operation rather than an
+        attribute, so it cannot share a query; the opt-in thread_dump
+        section invokes dumpAllThreads alongside the queries.
+
+        >>> s = t.snapshot([ 'status', 'memory', 'webapps' ])
+        >>> s.server_status(), s.memory_usage()['HeapMemory']
+        ('STARTED', 10)
+        '''
+        if sections is None:
+            sections = _SNAPSHOT_SECTIONS
+        unknown = set(sections) - set(_SNAPSHOT_SECTIONS + _SNAPSHOT_OPTIONAL)
+        if unknown:
+            raise TomcatError('Unknown snapshot sections: {0}'
+                              .format(', '.join(sorted(unknown))))
+
+        beans = {}
+        calls = [ lambda q=q, a=a: self.jmx.query(q, a)
+                  for q, a in _snapshot_queries(sections) ]
+        if 'thread_dump' in sections:
+            calls.append(self.dump_all_threads)
+        results = _concurrently(calls)
+        thread_dump = results.pop() if 'thread_dump' in sections else None
+        for rv in results:
+            beans.update((k, compact(v)) for k, v in rv.iteritems())
+
+        session_ids = {}
+        if 'sessions' in sections:
+            mgrs = [ k for k, v in beans.iteritems()
+                     if k.startswith('Catalina:type=Manager,')
+                     and v.get('activeSessions') > 0 ]
+            ids = _concurrently([ lambda k=k: self._list_session_ids(k)
+                                  for k in mgrs ], self.session_concurrency)
+            session_ids = dict((k, tuple(v)) for k, v in zip(mgrs, ids))
+        return TomcatSnapshot(self.name, sections, beans, session_ids,
+                              thread_dump)
+
 class _JSWRestarter:
      name = 'org.tanukisoftware.wrapper:type=WrapperManager'
      def __init__(self, tomcat):
@@ -367,7 +584,7 @@ class _YAJSWRestarter:
          self.log = logging.getLogger('pytomcat._YAJSWRebooter')
 
      def detect(self):
-         beans = self.jmx.query('Wrapper:name=*').keys()
+         beans = self.jmx.query('Wrapper:name=*', []).keys()
          if len(beans) <= 0:
              return False
          if len(beans) > 1:
@@ -381,6 +598,318 @@ class _YAJSWRestarter:
          self.log.debug("Requesting a restart from YAJSW")
          return self.jmx.invoke(self.name, 'restart')
 
+# Queries and result post-processing of the read APIs, shared with
+# asyncclient.AsyncTomcat
+
+_MEMORY_QUERY = ( 'java.lang:type=Memory*,*',
+                  [ 'NonHeapMemoryUsage', 'HeapMemoryUsage', 'Usage' ] )
+
+def _memory_info(beans, server):
+    meminfo = {}
+    for k, v in beans:
+        if k == 'java.lang:type=Memory':
+            for u in [ 'NonHeapMemoryUsage', 'HeapMemoryUsage' ]:
+                meminfo.update({ u.replace('Usage',''): v[u] })
+        elif k.startswith('java.lang:type=MemoryPool,'):
+            name = k.replace('java.lang:type=MemoryPool,name=','')
+            meminfo.update({ name: v['Usage']})
+
+    if not 'HeapMemory' in meminfo:
+        raise TomcatError('java.lang:type=Memory not found on {0}'
+                          .format(server))
+    return meminfo
+
+_MEMBERS_QUERY = 'Catalina:type=Cluster,component=Member,*'
+
+def _valid_members(beans):
+    invalid_ips = [ '0.0.0.0', '255.255.255.255' ]
+    return dict((k, v) for k, v in beans if v['hostname'] not in invalid_ips)
+
+def _webapps_query(app, vhost, attributes):
+    if attributes is not None and 'name' not in attributes:
+        attributes = list(attributes) + [ 'name' ]
+    return ( 'Catalina:j2eeType=WebModule,name=//{0}/{1},*'
+             .format(vhost, re.sub('^/', '', app)), attributes )
+
+def _webapps(beans):
+    def sanitize_name(name):
+        return '/' if name == None else name
+    return ((sanitize_name(v['name']),v) for k, v in beans)
+
+def _managers_query(app, vhost):
+    return 'Catalina:type=Manager,context={0},host={1}'.format(app, vhost)
+
+def _managers(beans):
+    def extract_context(mgr_id):
+        # FIXME: depends on the exact ordering of parts in the object ID
+        return re.match(
+                   '^Catalina:type=Manager,context=(.+?),host=(.+?)',
+                   mgr_id).group(1)
+    return dict((extract_context(k),v) for k, v in beans)
+
+def _active_members(members):
+    def is_active(m):
+        return ( m['ready'] and not m['failing'] and not m['suspect'] )
+    return dict((k, v) for k, v in members.iteritems() if is_active(v))
+
+def _memory_usage(meminfo):
+    usage = {}
+    for k, v in meminfo.iteritems():
+        usage[k] = 100 * v['used'] / v['max']
+    return usage
+
+_REQUEST_PROCESSORS_QUERY = 'Catalina:type=GlobalRequestProcessor,*'
+# Cumulative GlobalRequestProcessor counters, maxTime is not cumulative
+_REQUEST_COUNTERS = [ 'requestCount', 'errorCount', 'processingTime',
+                      'bytesSent', 'bytesReceived' ]
+
+def _request_processors(beans):
+    def connector(name):
+        return re.search('[:,]name="?([^",]+)', name).group(1)
+    return dict((connector(k), dict((a, v.get(a) or 0) for a in
+                                    _REQUEST_COUNTERS + [ 'maxTime' ]))
+                for k, v in beans.iteritems())
+
+def _request_rates(stats):
+    '''
+    Fill in the rates derived from the counter deltas in stats
+    '''
+    (requests, elapsed) = (stats['requestCount'], stats['elapsed'])
+    def per_second(n):
+        return n / elapsed if elapsed > 0 else 0.0
+    stats['requestsPerSecond'] = per_second(float(requests))
+    stats['bytesSentPerSecond'] = per_second(float(stats['bytesSent']))
+    stats['bytesReceivedPerSecond'] = per_second(float(stats['bytesReceived']))
+    stats['meanLatency'] = (float(stats['processingTime']) / requests
+                            if requests > 0 else 0.0)
+    stats['errorRate'] = (float(stats['errorCount']) / requests
+                          if requests > 0 else 0.0)
+    return stats
+
+def _request_rollup(stats):
+    '''
+    Combine request stats of several connectors or nodes, rates add up and
+    latency and error rate are weighted by the number of requests
+    '''
+    rv = dict((k, sum(s[k] for s in stats)) for k in _REQUEST_COUNTERS)
+    rv['maxTime'] = max([ s['maxTime'] for s in stats ] or [ 0 ])
+    rv['elapsed'] = max([ s['elapsed'] for s in stats ] or [ 0 ])
+    rv['reset'] = any(s['reset'] for s in stats)
+    _request_rates(rv)
+    for k in [ 'requestsPerSecond', 'bytesSentPerSecond', 'bytesReceivedPerSecond' ]:
+        rv[k] = sum(s[k] for s in stats)
+    return rv
+
+def _request_stats(first, second):
+    '''
+    Request stats per connector and for the node between two results of
+    Tomcat.request_counters
+    '''
+    elapsed = second['time'] - first['time']
+    restarted = first['startTime'] != second['startTime']
+    connectors = {}
+    for name, now in second['connectors'].iteritems():
+        before = first['connectors'].get(name)
+        reset = (restarted or before is None or
+                 any(now[k] < before[k] for k in _REQUEST_COUNTERS))
+        stats = dict((k, now[k] if reset else now[k] - before[k])
+                     for k in _REQUEST_COUNTERS)
+        stats.update(maxTime=now['maxTime'], elapsed=elapsed, reset=reset)
+        connectors[name] = _request_rates(stats)
+    return { 'connectors': connectors,
+             'total': _request_rollup(connectors.values()) }
+
+def _concurrently(calls, threads=None):
+    '''
+    Run the callables in parallel threads (at most threads at a time) and
+    return their results in order, re-raising the first error if any of
+    them failed
+    '''
+    results = [ None ] * len(calls)
+    pending = iter(xrange(len(calls)))
+    lock = threading.Lock()
+    def run():
+        while True:
+            with lock:
+                i = next(pending, None)
+            if i is None:
+                return
+            try:
+                results[i] = (True, calls[i]())
+            except Exception as e:
+                results[i] = (False, e)
+    if threads is None:
+        threads = len(calls)
+    workers = [ threading.Thread(target=run)
+                for i in xrange(1, min(threads, len(calls))) ]
+    for t in workers:
+        t.start()
+    run()
+    for t in workers:
+        t.join()
+    for ok, rv in results:
+        if not ok:
+            raise rv
+    return [ rv for ok, rv in results ]
+
+# Queries (object name pattern, attributes) needed by each snapshot
+# section. Sections sharing a pattern share the query.
+_SNAPSHOT_QUERIES = {
+    'status'    : [ ('Catalina:type=Server', [ 'stateName' ]) ],
+    'threads'   : [ ('java.lang:type=Threading',
+                     [ 'ThreadCount', 'PeakThreadCount', 'DaemonThreadCount' ]) ],
+    'restart'   : [ (_JSWRestarter.name, [ 'ControlledByNativeWrapper' ]),
+                    ('Wrapper:name=*', [ 'ControlledByWrapper' ]) ],
+    'cluster'   : [ ('Catalina:type=Cluster,*', None) ],
+    'memory'    : [ _MEMORY_QUERY ],
+    'vhosts'    : [ ('Catalina:type=Host,*', None) ],
+    'connectors': [ ('Catalina:type=Connector,*', [ 'protocol', 'port' ]) ],
+    'webapps'   : [ ('Catalina:j2eeType=WebModule,*', Tomcat.webapp_attributes) ],
+    'sessions'  : [ ('Catalina:type=Manager,*', [ 'activeSessions' ]) ],
+    # an invoke, see Tomcat.snapshot
+    'thread_dump': [],
+}
+
+_SNAPSHOT_SECTIONS = ( 'status', 'threads', 'restart', 'cluster', 'memory',
+                       'vhosts', 'connectors', 'webapps', 'sessions' )
+# Only captured when asked for
+_SNAPSHOT_OPTIONAL = ( 'thread_dump', )
+
+def _snapshot_queries(sections):
+    '''
+    Return the (pattern, attributes) queries covering all sections, with
+    the attributes of a pattern shared by several sections merged
+    '''
+    plan = {}
+    for section in sections:
+        for pattern, attributes in _SNAPSHOT_QUERIES[section]:
+            if attributes is None or (pattern in plan and plan[pattern] is None):
+                plan[pattern] = None
+            else:
+                plan[pattern] = sorted(set(plan.get(pattern, [])) | set(attributes))
+    return sorted(plan.items())
+
+class TomcatSnapshot(object):
+    '''
+    An immutable, point in time view of a Tomcat instance returned by
+    Tomcat.snapshot(). Methods answer the same questions as the ones of
+    Tomcat without any I/O; beans are read-only and hold only the
+    attributes listed in the snapshot plan. Asking about a section that
+    was not captured raises TomcatError.
+
+    >>> s = t.snapshot()
+    >>> s.thread_count(), s.can_restart(), s.cluster_name()
+    (42, False, 'Catalina')
+    '''
+    __slots__ = ('name', 'time', 'sections', '_beans', '_session_ids',
+                 '_thread_dump')
+
+    def __init__(self, name, sections, beans, session_ids, thread_dump=None):
+        for k, v in [ ('name', name), ('time', time.time()),
+                      ('sections', frozenset(sections)), ('_beans', beans),
+                      ('_session_ids', session_ids),
+                      ('_thread_dump', thread_dump) ]:
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('TomcatSnapshot is read-only')
+
+    def _require(self, section):
+        if not section in self.sections:
+            raise TomcatError("Section '{0}' is not part of the snapshot of {1}"
+                              .format(section, self.name))
+
+    def _bean(self, section, name):
+        self._require(section)
+        try:
+            return self._beans[name]
+        except KeyError:
+            raise TomcatError('{0} not found on {1}'.format(name, self.name))
+
+    def _matching(self, section, pattern):
+        '''
+        Return the beans matching an object name pattern, a trailing ',*'
+        also matches no further properties like in JMX
+        '''
+        self._require(section)
+        patterns = [ pattern ]
+        if pattern.endswith(',*'):
+            patterns.append(pattern[:-2])
+        return sorted((k, v) for k, v in self._beans.iteritems()
+                      if any(fnmatch.fnmatchcase(k, p) for p in patterns))
+
+    def server_status(self):
+        return self._bean('status', 'Catalina:type=Server')['stateName']
+
+    def thread_count(self):
+        return self._bean('threads', 'java.lang:type=Threading')['ThreadCount']
+
+    def dump_all_threads(self):
+        self._require('thread_dump')
+        return self._thread_dump
+
+    def can_restart(self):
+        self._require('restart')
+        jsw = self._beans.get(_JSWRestarter.name, {})
+        if jsw.get('ControlledByNativeWrapper'):
+            return True
+        return any(v.get('ControlledByWrapper') for k, v in
+                   self._matching('restart', 'Wrapper:name=*'))
+
+    def has_cluster(self):
+        self._require('cluster')
+        return 'Catalina:type=Cluster' in self._beans
+
+    def cluster_name(self):
+        return self._bean('cluster', 'Catalina:type=Cluster')['clusterName']
+
+    def cluster_members(self):
+        return _valid_members(self._matching('cluster', _MEMBERS_QUERY))
+
+    def active_members(self):
+        return _active_members(self.cluster_members())
+
+    def memory_info(self):
+        return _memory_info(self._matching('memory', _MEMORY_QUERY[0]), self.name)
+
+    def memory_usage(self):
+        return _memory_usage(self.memory_info())
+
+    def find_pools_over(self, percentage):
+        return list(k for k, v in self.memory_usage().iteritems() if v > percentage)
+
+    def max_heap(self):
+        return self.memory_info()['HeapMemory']['max']
+
+    def max_nonheap(self):
+        return self.memory_info()['NonHeapMemory']['max']
+
+    def vhosts(self):
+        return dict(self._matching('vhosts', 'Catalina:type=Host,*'))
+
+    def find_connectors(self):
+        '''
+        Connector names in the format of Tomcat.find_connectors(), built
+        from the Connector beans
+        '''
+        return [ 'Connector[{0}-{1}]'.format(v['protocol'], v['port'])
+                 for k, v in self._matching('connectors', 'Catalina:type=Connector,*') ]
+
+    def list_webapps(self, app='*', vhost='*'):
+        pattern = _webapps_query(app, vhost, None)[0]
+        return dict(_webapps(self._matching('webapps', pattern)))
+
+    def find_managers(self, app='*', vhost='*'):
+        return _managers(self._matching('sessions', _managers_query(app, vhost)))
+
+    def list_sessions(self, app='*', vhost='*', counts_only=False, lazy=False):
+        mgrs = self.find_managers(app, vhost)
+        if counts_only:
+            return dict((ctx, v['activeSessions']) for ctx, v in mgrs.iteritems())
+        wrap = iter if lazy else list
+        return dict((ctx, wrap(self._session_ids.get(v['objectName'], ())))
+                    for ctx, v in mgrs.iteritems())
+
 def parse_warfile(filename):
     m = re.match('^(?P<ctx>(?P<path>.+?)(##(?P<ver>.+?))?)\\.war$',
                  '/' + os.path.basename(filename), flags=re.I)
@@ -388,38 +917,257 @@ def parse_warfile(filename):
         raise TomcatError("Invalid WAR file name: '{0}'".format(filename))
     return ( m.group('ctx'), m.group('path'), m.group('ver') )
 
-def wait_until(predicate, timeout, poll_interval=5):
-    end_time = time.time() + timeout
-    while time.time() < end_time:
-        if predicate(): return True
-        time.sleep(poll_interval)
+# Constant pool entries of classes annotated with @WebServlet etc.
+_WEB_ANNOTATIONS = re.compile('L(javax|jakarta)/servlet/annotation/Web'
+                              '(Servlet|Filter|Listener);')
+_INITIALIZERS = ( 'META-INF/web-fragment.xml',
+                  'META-INF/services/javax.servlet.ServletContainerInitializer',
+                  'META-INF/services/jakarta.servlet.ServletContainerInitializer' )
+
+def _has_annotations(z):
+    '''
+    Look for annotated classes, web fragments or container initializers
+    in WEB-INF/classes and the jars in WEB-INF/lib
+    '''
+    for name in z.namelist():
+        if name.startswith('WEB-INF/classes/') and name.endswith('.class'):
+            if _WEB_ANNOTATIONS.search(z.read(name)):
+                return True
+        elif name.startswith('WEB-INF/lib/') and name.endswith('.jar'):
+            try:
+                jar = zipfile.ZipFile(StringIO(z.read(name)))
+            except zipfile.BadZipfile:
+                continue
+            if any(n in _INITIALIZERS for n in jar.namelist()):
+                return True
+            if any(_WEB_ANNOTATIONS.search(jar.read(n))
+                   for n in jar.namelist() if n.endswith('.class')):
+                return True
     return False
 
+def validate_warfile(filename, require_descriptor=False):
+    '''
+    Check that a WAR file can be deployed: a zip archive with a readable
+    central directory, entries matching their CRCs and a well-formed
+    WEB-INF/web.xml if there is one. With require_descriptor, a WAR
+    without web.xml must have annotated servlets, filters or listeners
+    (static WARs are fine otherwise). Raises a TomcatError.
+
+    >>> validate_warfile('tests/test_wars/corrupt.war')
+    TomcatError: Invalid WAR file 'tests/test_wars/corrupt.war': File is not a zip file
+    '''
+    def invalid(reason):
+        return TomcatError("Invalid WAR file '{0}': {1}".format(filename, reason))
+    try:
+        z = zipfile.ZipFile(filename)
+        try:
+            for info in z.infolist():
+                # reading an entry to the end checks its CRC
+                try:
+                    f = z.open(info)
+                    while f.read(1 << 20):
+                        pass
+                except (zipfile.BadZipfile, zlib.error) as e:
+                    raise invalid('{0} is corrupt: {1}'.format(info.filename, e))
+            if 'WEB-INF/web.xml' in z.namelist():
+                try:
+                    ElementTree.fromstring(z.read('WEB-INF/web.xml'))
+                except Exception as e:
+                    raise invalid('malformed WEB-INF/web.xml: {0}'.format(e))
+            elif require_descriptor and not _has_annotations(z):
+                raise invalid('no WEB-INF/web.xml or annotated servlets, '
+                              'filters or listeners')
+        finally:
+            z.close()
+    except (zipfile.BadZipfile, zipfile.LargeZipFile, zlib.error,
+            IOError, EOFError) as e:
+        raise invalid(e)
+
+def _validation_error((filename, require_descriptor)):
+    try:
+        validate_warfile(filename, require_descriptor)
+    except TomcatError as e:
+        return str(e)
+    return None
+
+_valid_warfiles = {}
+
+def validate_warfiles(filenames, require_descriptor=False, processes=None):
+    '''
+    Validate WAR files (see validate_warfile) in a pool of processes (one
+    per CPU by default), raising a TomcatError for all invalid ones.
+    Files that passed before are only checked again once their mtime or
+    size change.
+    '''
+    todo = []
+    for fn in filenames:
+        try:
+            st = os.stat(fn)
+        except OSError as e:
+            raise TomcatError("Invalid WAR file '{0}': {1}".format(fn, e))
+        key = (os.path.abspath(fn), require_descriptor)
+        if _valid_warfiles.get(key) != (st.st_mtime, st.st_size):
+            todo.append((fn, key, (st.st_mtime, st.st_size)))
+    args = [ (fn, require_descriptor) for fn, key, stamp in todo ]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if len(todo) > 1 and processes > 1:
+        pool = multiprocessing.Pool(min(len(todo), processes))
+        try:
+            errors = pool.map(_validation_error, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = map(_validation_error, args)
+    for (fn, key, stamp), e in zip(todo, errors):
+        if e is None:
+            _valid_warfiles[key] = stamp
+    errors = [ e for e in errors if e is not None ]
+    if errors:
+        raise TomcatError('\n'.join(errors))
+
+_war_digests = {}
+
+def war_digest(filename, cache=None):
+    '''
+    Return the SHA-1 hex digest of the contents of a WAR file. Digests are
+    cached in cache (a dict shared by the whole process by default) and
+    only computed again when the path, mtime or size of the file change.
+
+    >>> war_digest('/tmp/app##002.war')
+    '4b8e1f7f5c1c5a0e6a3f7f9b1b2d3e4f5a6b7c8d'
+    '''
+    if cache is None:
+        cache = _war_digests
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    entry = cache.get(path)
+    if entry is not None and list(entry[:2]) == [ st.st_mtime, st.st_size ]:
+        return entry[2]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            h.update(block)
+    cache[path] = [ st.st_mtime, st.st_size, h.hexdigest() ]
+    return cache[path][2]
+
+def wait_until(predicate, timeout, poll_interval=None):
+    '''
+    Poll predicate until it is true (returns True) or timeout seconds have
+    passed (returns False), backing off up to poll_interval seconds
+    between attempts, see Poller
+    '''
+    return Poller(timeout, max_interval=poll_interval).wait(predicate)
+
 class TomcatCluster:
+    # Size of the thread pool shared by all commands run on the cluster,
+    # also limits the number of nodes queried at a time during discovery
     max_threads = 20
-    members = {}
     progress_callback = None
     active_only = False
-
-    def __init__(self, host = None, user = None, passwd = None, port = 8080):
+    # File to remember discovered members in (None disables). Cached
+    # members are used for topology_ttl seconds as long as the seed host
+    # still reports the same membership.
+    topology_cache = None
+    topology_ttl = 600
+
+    def __init__(self, host = None, user = None, passwd = None, port = 8080,
+                 topology_cache = None):
         self.log = logging.getLogger('pytomcat.TomcatCluster')
         (self.user, self.passwd, self.port) = (user, passwd, port)
+        self.members = {}
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        if topology_cache is not None:
+            self.topology_cache = topology_cache
         if host != None:
             self._discover(Tomcat(host, user, passwd, port))
 
-    def _discover(self, t):
+    def _member_hosts(self, t):
         if self.active_only:
             members = t.active_members().values()
         else:
             members = t.cluster_members().values()
-        for h in map(lambda x: x['hostname'], members):
-            member_id = '{0}:{1}'.format(h, self.port)
-            if not member_id in self.members:
-                self.log.info("Autodiscovered cluster member '%s'", h)
+        return set(map(lambda x: x['hostname'], members))
+
+    def _discover(self, t):
+        seed_view = self._member_hosts(t)
+        cached = self._load_topology(t)
+        # The seed does not list itself, so it may be the one host missing
+        if (cached is not None and seed_view <= cached
+                and len(cached - seed_view) <= 1):
+            self.log.info("Using %d cluster members cached in %s",
+                          len(cached), self.topology_cache)
+            for h in cached:
                 self.add_member(Tomcat(h, self.user, self.passwd, self.port))
-                self._discover(self.members[member_id])
+        else:
+            self._discover_members(seed_view,
+                                   '{0}:{1}'.format(t.host, self.port))
+            self._save_topology(t)
         self.set_progress_callback(self.progress_callback)
 
+    def _discover_members(self, hosts, seed_id):
+        '''
+        Breadth-first search of the membership graph, the members found
+        in each round are queried in parallel. The seed has been queried
+        already.
+        '''
+        command = 'active_members' if self.active_only else 'cluster_members'
+        while hosts:
+            frontier = []
+            for h in hosts:
+                member_id = '{0}:{1}'.format(h, self.port)
+                if not member_id in self.members:
+                    self.log.info("Autodiscovered cluster member '%s'", h)
+                    self.add_member(Tomcat(h, self.user, self.passwd, self.port))
+                    if member_id != seed_id:
+                        frontier.append(member_id)
+            hosts = set()
+            if frontier:
+                for member_id, rv in self.iter_command(command, hosts=frontier):
+                    if isinstance(rv, Exception):
+                        raise rv
+                    hosts.update(v['hostname'] for v in rv.values())
+
+    def _topology_key(self, t):
+        return '{0}:{1}{2}'.format(t.host, t.port,
+                                   ' active' if self.active_only else '')
+
+    def _read_topology_cache(self):
+        try:
+            with open(self.topology_cache) as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            self.log.debug("Unable to read %s: %s", self.topology_cache, e)
+            return {}
+
+    def _load_topology(self, t):
+        if not self.topology_cache:
+            return None
+        entry = self._read_topology_cache().get(self._topology_key(t))
+        if not isinstance(entry, dict) or not 'members' in entry:
+            return None
+        if time.time() - entry.get('time', 0) > self.topology_ttl:
+            return None
+        return set(entry['members'])
+
+    def _save_topology(self, t):
+        if not self.topology_cache:
+            return
+        topology = self._read_topology_cache()
+        topology[self._topology_key(t)] = {
+            'time': time.time(),
+            'members': sorted(m.host for m in self.members.values()) }
+        tmp = '{0}.{1}.tmp'.format(self.topology_cache, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(topology, f, indent=1)
+            os.rename(tmp, self.topology_cache)
+        except (IOError, OSError) as e:
+            self.log.warn("Unable to save cluster topology to %s: %s",
+                          self.topology_cache, e)
+
     def _run_progress_callback(self, **args):
         if self.progress_callback != None:
             try:
@@ -436,19 +1184,200 @@ class TomcatCluster:
             raise TomcatError('{0} already exists'.format(member_id))
         self.members[member_id] = t
 
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(processes=self.max_threads)
+            return self._pool
+
+    def shutdown(self):
+        '''
+        Stop the worker threads after the commands in progress have
+        finished. A new pool is started if the cluster is used afterwards.
+
+        >>> with TomcatCluster('localhost', 'admin', 'admin') as c:
+        ...     c.run_command('server_status')
+        '''
+        with self._pool_lock:
+            (pool, self._pool) = (self._pool, None)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
     def run_command(self, command, *args, **opts):
+        '''
+        Run a Tomcat command on all members (or the ones listed in hosts)
+        and wait for all of them to finish. Options:
+          hosts          - member ids to run the command on
+          threads        - maximum number of nodes to run it on at a time
+          abort_on_error - do not start the command on any more nodes
+                           after a failure
+          deadline       - return after this many seconds even if some
+                           nodes have not finished, those are reported as
+                           failed with a TomcatError
+          partial        - report nodes that missed the deadline only in
+                           timed_out instead of failures
+
+        A command still running at the deadline is not interrupted, it
+        keeps its worker thread busy until it completes.
+
+        >>> c.run_command('server_status').results
+        {'192.168.56.101:8080': 'STARTED', '192.168.56.102:8080': 'STARTED'}
+        >>> rv = c.run_command('list_webapps', deadline=5, partial=True)
+        >>> rv.timed_out, rv.stragglers
+        (['192.168.56.103:8080'], ['192.168.56.103:8080'])
+        '''
+        (results, latencies) = ([], {})
+        for host, rv, latency in self._iter_command(command, args, **opts):
+            results.append((host, rv))
+            if latency is not None:
+                latencies[host] = latency
+        rv = ClusterCommandResults(results, latencies,
+                                   opts.get('partial', False))
+        if rv.stragglers:
+            self.log.info("Slow nodes performing %s: %s", command,
+                          ', '.join('{0} ({1})'.format(h,
+                              '{0:.1f}s'.format(latencies[h]) if h in latencies
+                              else 'timed out') for h in rv.stragglers))
+        return rv
+
+    def iter_command(self, command, *args, **opts):
+        '''
+        Same as run_command, but yields (host, result) tuples as soon as
+        each node finishes. result is an Exception if the command failed.
+        Stopping early does not cancel the command on the other nodes.
+        Nodes missing the deadline are yielded with a TomcatError at the
+        deadline, or not at all if partial is set.
+
+        >>> for host, rv in c.iter_command('deploy', '/tmp/app.war'):
+        ...     if isinstance(rv, Exception):
+        ...         print 'Failed on', host
+        '''
+        partial = opts.get('partial', False)
+        return ((host, rv) for host, rv, latency in
+                self._iter_command(command, args, **opts)
+                if latency is not None or not partial)
+
+    def iter_tasks(self, tasks, threads=None, per_host=1):
+        '''
+        Run a list of (host, command, args) tasks, at most threads
+        (max_threads by default) at a time and at most per_host at a time
+        on the same node, yielding (host, command, args, result) tuples as
+        they finish. result is an Exception if the command failed. A node
+        is given its next task as soon as it is free, before any other
+        node's, so the tasks of each node run back to back. Tasks run on
+        the shared pool; tasks not started yet are dropped if the caller
+        stops iterating.
+
+        >>> tasks = [ (h, 'deploy', (war, ctx)) for h in c.members
+        ...           for war, ctx in [ ('/tmp/a.war', '/a'), ('/tmp/b.war', '/b') ] ]
+        >>> for host, command, args, rv in c.iter_tasks(tasks, threads=10):
+        ...     print host, args[1], rv
+        '''
+        if threads is None:
+            threads = self.max_threads
+        pending = list(tasks)
+        running = {}
+        lock = threading.Condition()
+        results = Queue.Queue()
+
+        def next_task(prefer):
+            free = [ i for i, t in enumerate(pending)
+                     if running.get(t[0], 0) < per_host ]
+            for i in free:
+                if pending[i][0] == prefer:
+                    return pending.pop(i)
+            return pending.pop(free[0]) if free else None
+
+        def worker(n):
+            prefer = None
+            while True:
+                with lock:
+                    task = next_task(prefer)
+                    while task is None and pending:
+                        lock.wait()
+                        task = next_task(prefer)
+                    if task is None:
+                        return
+                    (host, command, args) = task
+                    running[host] = running.get(host, 0) + 1
+                try:
+                    self.log.debug("Performing %s%s on %s", command, args, host)
+                    self._run_progress_callback(event=events.CMD_START,
+                            command=command, args=args, node=host)
+                    rv = getattr(self.members[host], command)(*args)
+                    self._run_progress_callback(event=events.CMD_END,
+                            command=command, args=args, node=host)
+                except Exception as e:
+                    rv = e
+                with lock:
+                    running[host] -= 1
+                    lock.notify_all()
+                results.put((host, command, args, rv))
+                prefer = host
+
+        total = len(pending)
+        if total == 0:
+            return
+        # The workers run on the shared pool, one pool thread each
+        pool = self._executor()
+        for n in range(min(threads, total)):
+            pool.apply_async(worker, (n,))
+        done = 0
+        try:
+            while done < total:
+                yield results.get()
+                done += 1
+        finally:
+            # Abandoned by the caller, the workers stop after their
+            # current task
+            with lock:
+                del pending[:]
+                lock.notify_all()
+
+    def _iter_command(self, command, args, **opts):
+        '''
+        Validate the options and return a generator of (host, result,
+        latency) tuples. latency is None for nodes that missed the deadline.
+        '''
         if len(self.members) <= 0:
             raise TomcatError("Cluster has no members")
-        hosts = opts.setdefault('hosts', self.members.keys())
-        threads = opts.setdefault('threads',
-                      min(self.member_count(), self.max_threads))
-        abort_on_error = opts.setdefault('abort_on_error', False)
-        if abort_on_error:
-            abort = Value('b', 0)
+        hosts = opts.get('hosts', self.members.keys())
+        threads = opts.get('threads', self.max_threads)
+        abort_on_error = opts.get('abort_on_error', False)
+        deadline = opts.get('deadline')
+        if deadline is not None:
+            deadline += time.time()
+        return self._run_on_pool(command, args, hosts, threads,
+                                 abort_on_error, deadline)
+
+    def _run_on_pool(self, command, args, hosts, threads, abort_on_error,
+                     deadline):
+        abort = threading.Event()
+        expired = threading.Event()
+        # Commands run on the shared pool, throttled by a semaphore if
+        # fewer threads were requested. A larger request gets its own pool.
+        limit = threading.Semaphore(threads) if threads < self.max_threads else None
+        own_pool = threads > self.max_threads and len(hosts) > self.max_threads
+        if own_pool:
+            pool = ThreadPool(processes=min(threads, len(hosts)))
+        else:
+            pool = self._executor()
 
         def run_cmd(host):
+            if limit is not None:
+                limit.acquire()
+            start = time.time()
             try:
-                if abort_on_error and abort.value:
+                if expired.is_set():
+                    raise TomcatError('Deadline exceeded')
+                if abort_on_error and abort.is_set():
                     raise TomcatError('Aborted')
                 self.log.debug("Performing %s%s on %s", command, args, host)
                 self._run_progress_callback(event=events.CMD_START,
@@ -460,87 +1389,207 @@ class TomcatCluster:
                         command=command, args=args, node=host)
             except Exception as e:
                 if abort_on_error:
-                    abort.value = True
+                    abort.set()
                 rv = e
-            return (host, rv)
+            finally:
+                if limit is not None:
+                    limit.release()
+            return (host, rv, time.time() - start)
 
-        pool = ThreadPool(processes=threads)
-        return ClusterCommandResults(pool.map(run_cmd, hosts))
+        pending = set(hosts)
+        try:
+            results = pool.imap_unordered(run_cmd, hosts)
+            while pending:
+                try:
+                    if deadline is None:
+                        rv = results.next()
+                    else:
+                        rv = results.next(max(deadline - time.time(), 0))
+                except TimeoutError:
+                    break
+                pending.discard(rv[0])
+                yield rv
+            # Hosts queued behind a hung node must not start any more
+            expired.set()
+            for host in pending:
+                self.log.warn("%s on %s did not finish in time", command, host)
+                yield (host, TomcatError('{0} on {1} did not finish in time'
+                                         .format(command, host)), None)
+        finally:
+            if own_pool:
+                pool.close()
+                if not pending:
+                    pool.join()
 
     def set_progress_callback(self, callback):
         self.progress_callback = callback
         for t in self.members.values():
             t.set_progress_callback(callback)
+
+    def enable_cache(self, ttl=5, max_entries=128):
+        '''
+        Enable the JMX result cache on every member, see
+        JMXProxyConnection.enable_cache
+        '''
+        for t in self.members.values():
+            t.jmx.enable_cache(ttl, max_entries)
+
+    def snapshot(self, sections=None, **opts):
+        '''
+        Snapshot all members (or the ones listed in hosts) at once, see
+        Tomcat.snapshot. Takes the options of run_command.
+
+        >>> rv = c.snapshot([ 'status', 'webapps' ], deadline=10)
+        >>> dict((h, s.server_status()) for h, s in rv.results.items())
+        {'192.168.56.101:8080': 'STARTED', '192.168.56.102:8080': 'STARTED'}
+        '''
+        return self.run_command('snapshot', sections, **opts)
+
+    def request_stats(self, interval=1, **opts):
+        '''
+        Sample the request counters of all members (or the ones listed in
+        hosts) twice, interval seconds apart, and return the request stats
+        of each node (see Tomcat.request_stats) and their cluster-wide
+        rollup. Nodes that failed to report either sample are listed in
+        'failed'. Takes the options of run_command.
+
+        >>> rv = c.request_stats(interval=5)
+        >>> rv['total']['requestsPerSecond'], rv['failed']
+        (360.0, [])
+        '''
+        first = self.run_command('request_counters', **opts)
+        time.sleep(interval)
+        second = self.run_command('request_counters', **opts)
+        nodes = dict((h, _request_stats(first.results[h], v))
+                     for h, v in second.results.iteritems()
+                     if h in first.results)
+        failed = set(opts.get('hosts') or self.members) - set(nodes)
+        for h in sorted(failed):
+            self.log.warn("Unable to sample request counters of %s", h)
+        return { 'nodes': nodes,
+                 'total': _request_rollup([ v['total'] for v in nodes.values() ]),
+                 'failed': sorted(failed) }
+
+    def cache_stats(self):
+        '''
+        Return JMX result cache hit/miss counters summed over all members
+
+        >>> c.cache_stats()
+        {'hits': 42, 'misses': 40, 'entries': 12}
+        '''
+        rv = { 'hits': 0, 'misses': 0, 'entries': 0 }
+        for t in self.members.values():
+            if t.jmx.cache is not None:
+                for k, v in t.jmx.cache.stats.items():
+                    rv[k] += v
+        return rv
     
-    def webapp_status(self, app='*', vhost='*', latest=False):
+    def update_webapp_index(self, index, contexts=None, paths=None,
+                            vhost='*', deadline=None, cached=True):
+        '''
+        Refresh a ClusterWebappIndex with the webapps named in contexts or
+        serving one of paths (all webapps if neither is given). Only those
+        are queried, and only the ones that changed are updated. Nodes that
+        fail or miss the deadline are left out of the refreshed webapps,
+        so these will not be coherent. Pass cached=False to bypass the JMX
+        result cache (e.g. when polling). Returns the ClusterCommandResults.
+
+        >>> idx = ClusterWebappIndex()
+        >>> rv = c.update_webapp_index(idx, paths=[ '/app' ], deadline=10)
+        >>> idx.latest('/app'), idx.is_coherent(idx.latest('/app'))
+        ('/app##002', True)
+        '''
+        for host in index.hosts - set(self.members):
+            index.remove_node(host)
+        index.hosts.update(self.members)
+        if contexts is None and paths is None:
+            (command, args, scope) = ('list_webapps', ('*', vhost), None)
+        else:
+            (contexts, paths) = (set(contexts or ()), set(paths or ()))
+            (command, args) = ('find_webapps', (contexts, paths, vhost))
+            scope = lambda ctx, path: ctx in contexts or path in paths
+        rv = self.run_command(command,
+                              *(args + (Tomcat.webapp_attributes, cached)),
+                              deadline=deadline, partial=True)
+        for host, webapps in rv.results.iteritems():
+            index.update(host, webapps, scope)
+        for host, e in rv.failures.iteritems():
+            self.log.warn('Listing webapps on %s failed: %s', host, e)
+            index.update(host, {}, scope)
+        for host in rv.timed_out:
+            index.update(host, {}, scope)
+        return rv
+
+    def webapp_status(self, app='*', vhost='*', latest=False, deadline=None):
         '''
         Perform a cluster-wide discovery to find webapps that match the filter.
+        With a deadline, nodes that do not answer in time are left out, so
+        the webapps will not be coherent. Callers polling repeatedly should
+        keep a ClusterWebappIndex and use update_webapp_index instead.
 
         >>> c.webapp_status('/manager')
         {'/manager': {'coherent': True, 'stateName': 'STARTED', 'presentOn': ['10.1.6.1'], ... }}
         '''
-        interesting_keys = [ 'stateName', 'path', 'webappVersion' ]
-        app_versions = []
-
-        def new_stats():
-            rv = {
-                'presentOn': [],
-                'coherent': True,
-                'clusterDetails': dict((k,{}) for k in interesting_keys)
-            }
-            rv.update(dict((k,None) for k in interesting_keys))
-            return rv
-
-        def populate_interesting(stats):
-            for key in interesting_keys:
-                cd = stats['clusterDetails']
-                cd[key].update({ host: v[app][key] })
-                if key == 'webappVersion' and v[app][key] is not None:
-                    app_versions.append(v[app][key])
-
-        def consolidate_interesting(stats):
-            for key in interesting_keys:
-                d = stats['clusterDetails'][key]
-                unique = set(i for i in d.values())
-                if len(unique) == 1:
-                    stats[key] = unique.pop()
-                else:
-                    stats['coherent'] = False
-
-        def remove_old_version():
-            app_versions.sort(reverse=True)
-            for k, a in rv.items():
-                if a['webappVersion'] != app_versions[0]:
-                    del rv[k]
-
+        index = ClusterWebappIndex(self.members.keys())
         # TODO: report failed commands
-        apps = self.run_command('list_webapps', app, vhost).results
-        all_keys = set.union(*map(set, apps.values()))
-        rv = {}
-        for app in all_keys:
-            stats = new_stats()
-            for host, v in apps.iteritems():
-                if app in v:
-                    stats['presentOn'].append(host)
-                    populate_interesting(stats)
-            consolidate_interesting(stats)
-            if len(stats['presentOn']) != len(self.members):
-                stats['coherent'] = False
-            rv[app] = stats
+        apps = self.run_command('list_webapps', app, vhost,
+                                Tomcat.webapp_attributes, deadline=deadline,
+                                partial=True).results
+        for host, webapps in apps.iteritems():
+            index.update(host, webapps)
+        rv = index.webapp_status()
         if latest is True:
-            remove_old_version()
+            versions = [ v for a in rv.values()
+                         for v in a['clusterDetails']['webappVersion'].values()
+                         if v is not None ]
+            newest = max(versions) if versions else None
+            for k, a in rv.items():
+                if a['webappVersion'] != newest:
+                    del rv[k]
         return rv
 
 class ClusterCommandResults:
     '''
     Encapsulates the results of a cluster-wide command
     '''
-    def __init__(self, rv):
+    # Nodes taking more than straggler_factor times the median latency
+    # (and at least straggler_min_delay seconds longer) are stragglers
+    straggler_factor = 3
+    straggler_min_delay = 1.0
+
+    def __init__(self, rv, latencies=None, partial=False):
         def success((k,v)):
             return not isinstance(v, Exception)
+        self.latencies = latencies if latencies is not None else {}
+        timed_out = [ (k,v) for k,v in rv if latencies is not None
+                      and not k in latencies ]
+        self.timed_out = [ k for k,v in timed_out ]
+        if partial:
+            rv = [ x for x in rv if not x in timed_out ]
         self._failed = filter(lambda x: not success(x), rv)
         self._succeeded = filter(success, rv)
 
+    @property
+    def median_latency(self):
+        l = sorted(self.latencies.values())
+        if not l:
+            return None
+        mid = len(l) // 2
+        return l[mid] if len(l) % 2 else (l[mid - 1] + l[mid]) / 2.0
+
+    @property
+    def stragglers(self):
+        '''
+        Returns the nodes that were unusually slow or missed the deadline
+        '''
+        median = self.median_latency
+        if median is None:
+            return list(self.timed_out)
+        limit = max(median * self.straggler_factor,
+                    median + self.straggler_min_delay)
+        return sorted([ k for k, v in self.latencies.items() if v > limit ]
+                      + self.timed_out)
+
     @property
     def has_failures(self):
         return len(self._failed) > 0
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+'''
+A non-blocking client for the read-only JMX proxy APIs, for polling very
+large fleets. All requests of an EventLoop are multiplexed on a single
+thread with asyncore (poll(2) based, so not limited to FD_SETSIZE
+sockets), instead of blocking one thread per node like
+TomcatCluster.run_command.
+
+>>> c = AsyncTomcatCluster(user='admin', passwd='admin')
+>>> for h in hosts:
+...     c.add_member(AsyncTomcat(h, 'admin', 'admin', loop=c.loop))
+>>> c.run_command('server_status').results
+{'192.168.56.101:8080': 'STARTED', ...}
+
+>>> t = AsyncTomcat('localhost')
+>>> (status, apps) = (t.server_status(), t.list_webapps())
+>>> status.result(), len(apps.result()) # both requests run concurrently
+('STARTED', 5)
+'''
+
+import asyncore, socket, sys, urllib, base64, time, zlib, logging, collections
+from cStringIO import StringIO
+from . import (TomcatError, ClusterCommandResults, _MEMORY_QUERY,
+               _memory_info, _MEMBERS_QUERY, _valid_members, _webapps_query,
+               _webapps, _managers_query, _managers)
+from parser import parse, iter_search_results
+import events
+
+class EventLoop:
+    '''
+    Runs asynchronous requests until the results being waited for are
+    available. Not thread-safe: use one EventLoop per thread.
+    '''
+    poll_interval = 0.05
+
+    def __init__(self):
+        self.log = logging.getLogger('pytomcat.asyncclient')
+        self._map = {}
+
+    def run_until(self, predicate):
+        while not predicate():
+            if not self._map:
+                raise TomcatError('No requests in progress')
+            asyncore.loop(self.poll_interval, True, self._map, 1)
+            now = time.time()
+            for channel in self._map.values():
+                if channel.deadline < now:
+                    channel.fail(TomcatError('Timed out'))
+
+    def run(self):
+        self.run_until(lambda: not self._map)
+
+class AsyncResult:
+    '''
+    The result of an asynchronous call. result() runs the event loop until
+    the call has completed, then returns its value or raises its error.
+    '''
+    def __init__(self, loop):
+        self._loop = loop
+        self.done = False
+        self._value = None
+        self._error = None
+        self._callbacks = []
+
+    def set_result(self, value):
+        (self._value, self.done) = (value, True)
+        self._run_callbacks()
+
+    def set_error(self, error):
+        (self._error, self.done) = (error, True)
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        (callbacks, self._callbacks) = (self._callbacks, [])
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                self._loop.log.error('running result callback: %s', e)
+
+    def add_done_callback(self, fn):
+        if self.done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def then(self, fn):
+        '''
+        Return an AsyncResult for fn applied to the value of this one
+        '''
+        rv = AsyncResult(self._loop)
+        def chain(r):
+            if r._error is not None:
+                rv.set_error(r._error)
+                return
+            try:
+                value = fn(r._value)
+            except Exception as e:
+                rv.set_error(e)
+                return
+            rv.set_result(value)
+        self.add_done_callback(chain)
+        return rv
+
+    def result(self):
+        self._loop.run_until(lambda: self.done)
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+class _HTTPRequest(asyncore.dispatcher):
+    '''
+    A single HTTP/1.0 GET request, the response is read until the server
+    closes the connection
+    '''
+    def __init__(self, loop, host, port, url, headers, timeout, result):
+        asyncore.dispatcher.__init__(self, map=loop._map)
+        self.deadline = time.time() + timeout
+        self._url = 'http://{0}:{1}{2}'.format(host, port, url)
+        self._result = result
+        self._out = ''.join([ 'GET {0} HTTP/1.0\r\nHost: {1}:{2}\r\n'
+                              .format(url, host, port) ] +
+                            [ '{0}: {1}\r\n'.format(k, v)
+                              for k, v in headers.iteritems() ] + [ '\r\n' ])
+        self._in = []
+        try:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connect((host, port))
+        except Exception as e:
+            self.fail(e)
+
+    def writable(self):
+        return len(self._out) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self._in.append(data)
+
+    def handle_close(self):
+        self.close()
+        try:
+            self._result.set_result(self._response(''.join(self._in)))
+        except Exception as e:
+            self.fail(e)
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def fail(self, e):
+        self.close()
+        if not self._result.done:
+            self._result.set_error(TomcatError(
+                'Error communicating with {0}: {1}'.format(self._url, e)))
+
+    def _response(self, data):
+        (head, sep, body) = data.partition('\r\n\r\n')
+        if not sep:
+            raise TomcatError('Incomplete response')
+        lines = head.split('\r\n')
+        status = lines[0].split(' ', 2)
+        if len(status) < 2 or not status[0].startswith('HTTP/'):
+            raise TomcatError('Malformed status line: {0!r}'.format(lines[0][:80]))
+        if int(status[1]) >= 400:
+            raise TomcatError('HTTP Error {0}: {1}'.format(status[1],
+                              status[2] if len(status) > 2 else ''))
+        headers = dict((k.strip().lower(), v.strip()) for k, sep, v in
+                       (l.partition(':') for l in lines[1:]))
+        encoding = headers.get('content-encoding', '').lower()
+        if encoding in ('gzip', 'x-gzip'):
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+        return body
+
+class AsyncTomcat:
+    '''
+    Asynchronous counterpart of the read APIs of Tomcat. Every method
+    returns an AsyncResult; results are post-processed exactly like the
+    ones of Tomcat.
+    '''
+    timeout = 10
+    # See JMXProxyConnection.compression
+    compression = True
+
+    def __init__(self, host, user = 'admin', passwd = 'admin', port = 8080,
+                 loop = None):
+        (self.host, self.port) = (host, port)
+        self.name = 'Tomcat at {0}:{1}'.format(host,port)
+        self.loop = loop if loop is not None else EventLoop()
+        self.path = '/manager/jmxproxy/'
+        b64 = base64.standard_b64encode('%s:%s' % (user, passwd))
+        self.auth_header = 'Basic %s' % b64
+
+    def _jmx(self, request):
+        headers = { 'Authorization': self.auth_header }
+        if self.compression:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        rv = AsyncResult(self.loop)
+        _HTTPRequest(self.loop, self.host, self.port,
+                     '%s?%s' % (self.path, request), headers, self.timeout, rv)
+        return rv.then(_check_response)
+
+    def iter_query(self, qry, attributes=None):
+        '''
+        Query MBeans, the result is a list of (object name, attributes)
+        tuples. See JMXProxyConnection.iter_query
+        '''
+        def beans(data):
+            rv = list(iter_search_results(StringIO(data), attributes))
+            for (name, attrs) in rv:
+                attrs.setdefault('objectName', name)
+            return rv
+        return self._jmx(urllib.urlencode({ 'qry' : qry })).then(beans)
+
+    def query(self, qry, attributes=None):
+        return self.iter_query(qry, attributes).then(dict)
+
+    def get(self, bean, property, key = None):
+        qry = { 'get': bean, 'att': property }
+        if key != None:
+            qry['key'] = key
+        return self._jmx(urllib.urlencode(qry)).then(
+                   lambda data: parse('get_results', data))
+
+    def server_status(self):
+        return self.get('Catalina:type=Server', 'stateName')
+
+    def memory_info(self):
+        return self.iter_query(*_MEMORY_QUERY).then(
+                   lambda beans: _memory_info(beans, self.name))
+
+    def cluster_members(self):
+        return self.iter_query(_MEMBERS_QUERY).then(_valid_members)
+
+    def list_webapps(self, app='*', vhost='*', attributes=None):
+        return self.iter_query(*_webapps_query(app, vhost, attributes)).then(
+                   lambda beans: dict(_webapps(beans)))
+
+    def find_managers(self, app='*', vhost='*', attributes=None):
+        return self.iter_query(_managers_query(app, vhost), attributes).then(
+                   _managers)
+
+def _check_response(data):
+    data = data.replace('\r', '')
+    if not data.startswith('OK'):
+        raise TomcatError(data)
+    return data
+
+class AsyncTomcatCluster:
+    '''
+    Runs AsyncTomcat commands on all members concurrently, with at most
+    max_concurrency requests in flight.
+    '''
+    max_concurrency = 1000
+    progress_callback = None
+
+    def __init__(self, host = None, user = None, passwd = None, port = 8080,
+                 loop = None):
+        self.log = logging.getLogger('pytomcat.AsyncTomcatCluster')
+        (self.user, self.passwd, self.port) = (user, passwd, port)
+        self.loop = loop if loop is not None else EventLoop()
+        self.members = {}
+        if host != None:
+            self._discover(host)
+
+    def _discover(self, host):
+        '''
+        Add all cluster members reachable from host, querying the members
+        found on each round concurrently
+        '''
+        self.add_member(AsyncTomcat(host, self.user, self.passwd, self.port,
+                                    self.loop))
+        new = [ '{0}:{1}'.format(host, self.port) ]
+        while new:
+            found = self.run_command('cluster_members', hosts=new)
+            for member_id, e in found.failures.iteritems():
+                self.log.error('Discovering cluster members on %s: %s',
+                               member_id, e)
+            new = []
+            for members in found.results.values():
+                for h in set(m['hostname'] for m in members.values()):
+                    member_id = '{0}:{1}'.format(h, self.port)
+                    if not member_id in self.members:
+                        self.log.info("Autodiscovered cluster member '%s'", h)
+                        self.add_member(AsyncTomcat(h, self.user, self.passwd,
+                                                    self.port, self.loop))
+                        new.append(member_id)
+
+    def _run_progress_callback(self, **args):
+        if self.progress_callback != None:
+            try:
+                self.progress_callback(**args)
+            except Exception as e:
+                self.log.error('running progress callback: %s', e)
+
+    def member_count(self):
+        return len(self.members)
+
+    def add_member(self, t):
+        member_id = '{0}:{1}'.format(t.host, t.port)
+        if member_id in self.members:
+            raise TomcatError('{0} already exists'.format(member_id))
+        self.members[member_id] = t
+
+    def set_progress_callback(self, callback):
+        self.progress_callback = callback
+
+    def run_command(self, command, *args, **opts):
+        '''
+        Run an AsyncTomcat command on the members listed in hosts (all
+        by default), at most concurrency (max_concurrency by default)
+        at a time
+
+        >>> c.run_command('find_managers', '/manager', concurrency=200)
+        '''
+        if len(self.members) <= 0:
+            raise TomcatError("Cluster has no members")
+        hosts = opts.get('hosts', self.members.keys())
+        concurrency = opts.get('concurrency', self.max_concurrency)
+        pending = collections.deque(hosts)
+        running = [ 0 ]
+        rv = []
+
+        def start_next():
+            while pending and running[0] < concurrency:
+                host = pending.popleft()
+                running[0] += 1
+                self.log.debug("Performing %s%s on %s", command, args, host)
+                self._run_progress_callback(event=events.CMD_START,
+                        command=command, args=args, node=host)
+                try:
+                    r = getattr(self.members[host], command)(*args)
+                except Exception as e:
+                    r = AsyncResult(self.loop)
+                    r.set_error(e)
+                r.add_done_callback(lambda r, host=host: finish(host, r))
+
+        def finish(host, r):
+            running[0] -= 1
+            if r._error is None:
+                self._run_progress_callback(event=events.CMD_END,
+                        command=command, args=args, node=host)
+                rv.append((host, r._value))
+            else:
+                rv.append((host, r._error))
+            start_next()
+
+        start_next()
+        self.loop.run_until(lambda: len(rv) == len(hosts))
+        return ClusterCommandResults(rv)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import threading, time
+
+class ResultCache:
+    '''
+    A thread-safe, size-bounded LRU cache whose entries expire after ttl
+    seconds. invalidate() drops all entries; a value fetched before the
+    invalidation is not stored afterwards (see generation).
+
+    >>> c = ResultCache(ttl=5)
+    >>> g = c.generation
+    >>> if c.get('qry=*:*') is None:
+    ...     c.put('qry=*:*', fetch(), g)
+    '''
+
+    def __init__(self, ttl=5, max_entries=128):
+        (self.ttl, self.max_entries) = (ttl, max_entries)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._tick = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._tick += 1
+            entry[2] = self._tick
+            return entry[1]
+
+    def put(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if not key in self._entries and len(self._entries) >= self.max_entries:
+                self._evict()
+            self._tick += 1
+            self._entries[key] = [ time.time() + self.ttl, value, self._tick ]
+
+    def _evict(self):
+        now = time.time()
+        expired = [ k for k, e in self._entries.iteritems() if e[0] < now ]
+        for k in expired:
+            del self._entries[k]
+        if len(self._entries) >= self.max_entries:
+            lru = min(self._entries.iteritems(), key=lambda (k, e): e[2])[0]
+            del self._entries[lru]
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        '''
+        Return hit/miss counters
+
+        >>> c.stats
+        {'hits': 12, 'misses': 7, 'entries': 5}
+        '''
+        return { 'hits': self.hits, 'misses': self.misses,
+                 'entries': len(self._entries) }
+
+class SingleFlight:
+    '''
+    Coalesces concurrent identical requests: the first caller of join()
+    for a key becomes the leader and performs the request, callers
+    arriving while it is in flight wait for its outcome instead.
+
+    >>> call = flights.join(key)
+    >>> if call.leader:
+    ...     try:
+    ...         rv = fetch()
+    ...     except Exception as e:
+    ...         flights.finish(call, error=e)
+    ...         raise
+    ...     flights.finish(call, rv)
+    ... else:
+    ...     rv = call.wait(timeout) # raises the leader's error
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.deduplicated = 0
+
+    def join(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and not call.private:
+                self.deduplicated += 1
+                call.followers += 1
+                return _FlightFollower(call)
+            self.executed += 1
+            if call is None:
+                call = self._calls[key] = _Flight(key)
+                return call
+            # Its outcome will not be shared, make a request of our own
+            return _Flight(key)
+
+    def stream(self, call):
+        '''
+        Return True and keep the outcome of a call to its leader if no
+        other caller is waiting for it yet, so that the leader does not
+        have to hold on to the result. Later callers of join() make their
+        own request.
+        '''
+        with self._lock:
+            if call.followers == 0:
+                call.private = True
+            return call.private
+
+    def finish(self, call, value=None, error=None):
+        '''
+        Publish the outcome of a call. A value of None means that the
+        leader gave up and followers have to make their own request.
+        '''
+        with self._lock:
+            if self._calls.get(call.key) is call:
+                del self._calls[call.key]
+        (call.value, call.error) = (value, error)
+        call.event.set()
+
+    def forget(self):
+        '''
+        Let calls in flight finish, but have later callers of join() start
+        new ones (e.g. after a modification on the server)
+        '''
+        with self._lock:
+            self._calls.clear()
+
+    @property
+    def stats(self):
+        return { 'executed': self.executed, 'deduplicated': self.deduplicated }
+
+class _Flight:
+    leader = True
+
+    def __init__(self, key):
+        self.key = key
+        self.followers = 0
+        self.private = False
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+class _FlightFollower:
+    leader = False
+
+    def __init__(self, call):
+        self._call = call
+
+    def wait(self, timeout=None):
+        '''
+        Return the leader's result, or None if the leader gave up or did
+        not finish within timeout seconds
+        '''
+        self._call.event.wait(timeout)
+        if not self._call.event.is_set():
+            return None
+        if self._call.error is not None:
+            raise self._call.error
+        return self._call.value
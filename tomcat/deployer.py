@@ -1,15 +1,24 @@
 #!/usr/bin/env python
 
-import time, logging, sys
+import time, logging, sys, os, json, math, threading, Queue
 from . import *
 import events
 
-def parse_warfiles(warfiles):
-    return dict((f, parse_warfile(f)) for f in warfiles)
+def parse_warfiles(warfiles, validate=True, require_descriptor=False):
+    '''
+    Return the (context, path, version) of each WAR file, after checking
+    that they can be deployed (see validate_warfiles)
+    '''
+    rv = dict((f, parse_warfile(f)) for f in warfiles)
+    if validate:
+        validate_warfiles(warfiles, require_descriptor)
+    return rv
 
 class ClusterDeployer:
     undeploy_on_error = True
     port = 8080
+    # Longest interval between polls, they start shorter and back off
+    # (see Poller)
     poll_interval = 5
     deploy_wait_time = 30
     gc_wait_time = 10
@@ -19,16 +28,121 @@ class ClusterDeployer:
     kill_sessions = False
     auto_restart = False
     restart_fraction = 0.33
+    # Fraction of the cluster that stays in rotation during a rolling
+    # restart (all nodes but restart_fraction of them by default), and
+    # seconds a restarted node may take to be an active member again
+    restart_min_capacity = None
+    rejoin_wait_time = 120
+    # Seconds to cache JMX query results between invocations (0 disables)
+    cache_ttl = 2
+    # See TomcatCluster.topology_cache
+    topology_cache = None
+    # Seconds to wait for the slowest node when polling webapp status
+    status_deadline = 30
+    # Total upload bandwidth in bytes per second and number of concurrent
+    # uploads (None for no limit), see UploadScheduler
+    upload_bandwidth = None
+    max_uploads = None
+    # A dict or function giving the rack or datacenter of a member id,
+    # uploads are spread over locations or done one location at a time
+    # (upload_grouped)
+    upload_location = None
+    upload_grouped = False
+    # Number of nodes deployed to at a time (TomcatCluster.max_threads by
+    # default) and of WARs deployed to the same node at a time
+    max_deploys = None
+    node_deploys = 1
+    # File recording the digest of the WAR deployed to each node (None
+    # disables), nodes already running the same build are not deployed to
+    # again
+    digest_index = None
+    # Check WAR files before deploying them, see validate_warfiles
+    validate_wars = True
+    require_descriptor = False
 
     def __init__(self, **opts):
         self.log = logging.getLogger('pytomcat.deployer')
         for k, v in opts.items():
             setattr(self, k, v)
-        self.c = TomcatCluster(self.host, self.user, self.passwd, self.port)
+        self.c = TomcatCluster(self.host, self.user, self.passwd, self.port,
+                               topology_cache=self.topology_cache)
         self.c.set_progress_callback(self._progress_callback)
+        # Webapps seen on the cluster, per vhost, refreshed incrementally
+        self._indexes = {}
+        self._digests = self._read_digest_index()
+        if self.cache_ttl > 0:
+            self.c.enable_cache(self.cache_ttl)
 
-    def _get_webapps(self, vhost='*'):
-        stats = self.c.webapp_status('*', vhost)
+    def _read_digest_index(self):
+        rv = { 'files': {}, 'deployed': {} }
+        if self.digest_index:
+            try:
+                with open(self.digest_index) as f:
+                    rv.update(json.load(f))
+            except (IOError, ValueError) as e:
+                self.log.debug("Unable to read %s: %s", self.digest_index, e)
+        return rv
+
+    def _save_digest_index(self):
+        if not self.digest_index:
+            return
+        tmp = '{0}.{1}.tmp'.format(self.digest_index, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._digests, f, indent=1)
+            os.rename(tmp, self.digest_index)
+        except (IOError, OSError) as e:
+            self.log.warn("Unable to save WAR digests to %s: %s",
+                          self.digest_index, e)
+
+    def _war_digests(self, new_apps):
+        if not self.digest_index:
+            return {}
+        return dict((fn, war_digest(fn, self._digests['files']))
+                    for fn in new_apps)
+
+    def _deployed_digest(self, host, ctx, vhost):
+        return self._digests['deployed'].get(host, {}).get(vhost, {}).get(ctx)
+
+    def _set_deployed_digest(self, host, ctx, vhost, digest):
+        deployed = self._digests['deployed'].setdefault(host, {}).setdefault(vhost, {})
+        if digest is None:
+            deployed.pop(ctx, None)
+        else:
+            deployed[ctx] = digest
+
+    def _same_build(self, fn, ctx, status, vhost, digests):
+        '''
+        Return the nodes already running the build of fn, or raise an error
+        if ctx is deployed anywhere else or has not started
+        '''
+        digest = digests.get(fn)
+        states = status['clusterDetails']['stateName']
+        same = [ h for h in status['presentOn'] if digest is not None and
+                 self._deployed_digest(h, ctx, vhost) == digest and
+                 states.get(h) == 'STARTED' ]
+        if len(same) < len(status['presentOn']):
+            raise TomcatError(
+                    'There is already a context {0} on {1}'
+                    .format(ctx, ' and '.join(sorted(set(status['presentOn'])
+                                                     - set(same)))))
+        self.log.info("%s is already running on %s, skipping these nodes",
+                      ctx, ', '.join(sorted(same)))
+        return same
+
+    def _webapp_index(self, vhost):
+        if not vhost in self._indexes:
+            self._indexes[vhost] = ClusterWebappIndex(self.c.members.keys())
+        return self._indexes[vhost]
+
+    def _get_webapps(self, vhost='*', paths=None):
+        index = self._webapp_index(vhost)
+        self.c.update_webapp_index(index, paths=paths, vhost=vhost)
+        if paths is None:
+            stats = index.webapp_status()
+        else:
+            stats = index.webapp_status(set(ctx for p in paths
+                                            for ctx in index.contexts(p)))
         self.log.debug("Received cluster-wide application status: %s", stats)
         all_paths = {}
         paths = {}
@@ -45,21 +159,28 @@ class ClusterDeployer:
                 self.c.run_command('expire_sessions', app, vhost) # TODO: report errors
         self.log.info('Attempting to undeploy old versions across the cluster')
         self.c.run_command('undeploy_old_versions', vhost) # TODO: report errors
-        (stats, paths, all_paths) = self._get_webapps(vhost)
+        (stats, paths, all_paths) = self._get_webapps(vhost, [ path ])
         if path in paths and len(paths[path]) > 1:
             raise TomcatError(
                       "Path '{0}' is served by more than one version ({1})"
                       .format(path, ' and '.join(paths[path])))
         self.log.info('Old versions successfully undeployed')
 
-    def _clean_old_apps(self, new_apps, vhost='*'):
-        (stats, paths, all_paths) = self._get_webapps(vhost)
+    def _clean_old_apps(self, new_apps, vhost='*', digests={}):
+        '''
+        Check that new_apps can be deployed and undeploy old versions.
+        Returns the nodes to skip for each WAR file, because they already
+        run the same build (see digest_index).
+        '''
+        (stats, paths, all_paths) = self._get_webapps(vhost,
+                [ path for ctx, path, ver in new_apps.values() ])
         oldapps = []
-        for ctx, path, ver in new_apps.values():
+        skip = {}
+        for fn, (ctx, path, ver) in new_apps.items():
             if ctx in stats:
-                raise TomcatError(
-                        'There is already a context {0} on {1}'
-                        .format(ctx, ' and '.join(stats[ctx]['presentOn'])))
+                skip[fn] = self._same_build(fn, ctx, stats[ctx], vhost, digests)
+                if ver == None:
+                    continue
             if path in all_paths:
                 if ver == None:
                     raise TomcatError(
@@ -79,8 +200,9 @@ class ClusterDeployer:
                             .format(latest, path, ctx))
                     oldapps += sorted(paths[path])[:-1]
         self._undeploy_old_versions(path, oldapps, vhost)
+        return skip
 
-    def _get_memory(self, percentage, hosts=None):
+    def _get_memory(self, percentage, hosts=None, cached=True):
         def ignore_filter(lst):
             ignore_pools = [ 'Par Eden Space', 'Par Survivor Space', 'Code Cache' ]
             return filter(lambda x: x not in ignore_pools, lst)
@@ -89,7 +211,7 @@ class ClusterDeployer:
         else:
             opts = {}
         rv = self.c.run_command('find_pools_over',
-                                100 - self.required_memory, **opts).results
+                                100 - self.required_memory, cached, **opts).results
         # TODO: report errors
         rv = dict((k, ignore_filter(v)) for (k, v) in rv.items())
         rv = dict(filter(lambda (k, v): len(v) > 0, rv.items()))
@@ -100,15 +222,13 @@ class ClusterDeployer:
         self.log.info("Running GC on the following nodes: %s", ', '.join(hosts))
         return self.c.run_command('run_gc', hosts=hosts)
 
+    def _poller(self, timeout):
+        return Poller(timeout, max_interval=self.poll_interval)
+
     def _wait_for_free_mem(self, hosts, percentage):
         self.log.info("Waiting %ss for memory to become available", self.gc_wait_time)
-        wait_total = 0
-        while len(self._get_memory(percentage, hosts)) > 0:
-            if wait_total > self.gc_wait_time:
-                return False
-            time.sleep(self.poll_interval)
-            wait_total += self.poll_interval
-        return True
+        return self._poller(self.gc_wait_time).wait(
+                   lambda: len(self._get_memory(percentage, hosts, False)) <= 0)
 
     def _check_memory(self):
         self.log.info("Checking that all cluster nodes have at least %s%% of free memory",
@@ -143,33 +263,34 @@ class ClusterDeployer:
         raise TomcatError(errstr % mem)
 
     def _wait_for_apps(self, new_apps, vhost='*'):
-        ctx_list = [ ctx for ctx, path, ver in new_apps.values() ]
-        wait_total = 0
+        failed_apps = [ ctx for ctx, path, ver in new_apps.values() ]
         self.log.info("Waiting %ss for webapps to become available on all nodes",
                       self.deploy_wait_time)
-        while wait_total < self.deploy_wait_time:
-            cluster_ok = True
-            stats = self.c.webapp_status('*', vhost)
-            failed_apps = []
-            for ctx in ctx_list:
-                try:
-                    cs = stats[ctx]
-                    self.log.info("\t%s - %s", ctx, cs['clusterDetails']['stateName'])
-                    if cs['coherent'] == False or cs['stateName'] != 'STARTED':
-                        cluster_ok = False
-                        failed_apps.append(ctx)
-                except KeyError:
-                        cluster_ok = False
-                        failed_apps.append(ctx)
-            if cluster_ok == True:
+        index = self._webapp_index(vhost)
+        poller = self._poller(self.deploy_wait_time)
+        for attempt in poller:
+            self.c.update_webapp_index(index, contexts=failed_apps, vhost=vhost,
+                                       deadline=min(self.status_deadline,
+                                                    max(poller.remaining(), 1)),
+                                       cached=False)
+            pending = []
+            for ctx in failed_apps:
+                if ctx in index:
+                    self.log.info("\t%s - %s", ctx, index.status(ctx)
+                                  ['clusterDetails']['stateName'])
+                if not index.is_coherent(ctx) or index.state(ctx) != 'STARTED':
+                    pending.append(ctx)
+            if len(pending) < len(failed_apps):
+                poller.reset()
+            failed_apps = pending
+            if not failed_apps:
                 break
-            wait_total += self.poll_interval
-            time.sleep(self.poll_interval)
         return failed_apps
 
     def _progress_callback(self, **args):
         handlers = {
             events.UPLOAD      : self._log_upload_status,
+            events.EXPIRE      : self._log_expire_status,
             events.CMD_START   : self._log_cmd_status,
             events.CMD_END     : self._log_cmd_status
         }
@@ -184,7 +305,17 @@ class ClusterDeployer:
         if evnt['position'] == 0:
             self.log.info('Starting to upload %s to %s', evnt['filename'], evnt['url'])
         elif evnt['position'] == evnt['total']:
-            self.log.info('Completed uploading %s to %s', evnt['filename'], evnt['url'])
+            self.log.info('Completed uploading %s to %s in %.1fs (%.1f MB/s)',
+                          evnt['filename'], evnt['url'], evnt.get('elapsed', 0),
+                          evnt.get('rate', 0) / 1048576.0)
+            if evnt.get('eta') is not None:
+                self.log.info('Uploading at %.1f MB/s in total, %ds left',
+                              evnt['total_rate'] / 1048576.0, evnt['eta'])
+
+    def _log_expire_status(self, evnt):
+        self.log.info('Expired %d of %d sessions of %s on %s (%.0f/s)',
+                      evnt['expired'], evnt['total'], evnt['context'],
+                      evnt['node'], evnt['rate'])
 
     def _log_cmd_status(self, evnt):
         msg = { events.CMD_START: {
@@ -205,14 +336,48 @@ class ClusterDeployer:
                 m[str(i)] = args[i]
             self.log.info(msg[ec][cmd], m)
 
-    def _deploy(self, new_apps, vhost='localhost'):
+    def _deploy(self, new_apps, vhost='localhost', digests={}, skip={}):
+        scheduler = UploadScheduler(self.upload_bandwidth, self.max_uploads)
+        hosts = scheduler.order(self.c.members.keys(), self.upload_location,
+                                self.upload_grouped)
+        wars = {}
+        failures = {}
+        try:
+            for fn, (ctx, path, ver) in new_apps.items():
+                if all(h in skip.get(fn, ()) for h in hosts):
+                    self.log.info("%s is already deployed to all nodes", ctx)
+                    continue
+                # read each WAR once for all nodes
+                wars[fn] = WarFile(fn, scheduler)
+                failures[fn] = {}
+            # every node gets its WARs back to back, without waiting for
+            # the other nodes to receive the previous one
+            tasks = [ (h, 'deploy', (wars[fn], new_apps[fn][0], vhost))
+                      for h in hosts for fn in wars
+                      if not h in skip.get(fn, ()) ]
+            scheduler.expect(sum(len(args[0]) for h, cmd, args in tasks))
+            if tasks:
+                self.log.info("Performing a cluster-wide deploy of %s",
+                              ' and '.join(new_apps[fn][0] for fn in wars))
+            for host, cmd, (war, ctx, vh), rv in self.c.iter_tasks(tasks,
+                    self.max_deploys, self.node_deploys):
+                if isinstance(rv, Exception):
+                    self.log.error("Failed to deploy %s to %s: %s",
+                                   ctx, host, rv)
+                    failures[war.name][host] = rv
+                else:
+                    self._set_deployed_digest(host, ctx, vhost,
+                                              digests.get(war.name))
+        finally:
+            for war in wars.values():
+                war.close()
+            self._save_digest_index()
         failed_apps = []
-        for fn, (ctx, path, ver) in new_apps.items():
-            self.log.info("Performing a cluster-wide deploy of %s", ctx)
-            rv = self.c.run_command('deploy', fn, ctx, vhost)
-            if rv.has_failures:
+        for fn, f in failures.items():
+            if f:
+                ctx = new_apps[fn][0]
                 self.log.error("Failed to deploy %s to the following nodes: %s",
-                               ctx, rv.failures)
+                               ctx, f)
                 failed_apps.append(ctx)
         return failed_apps
 
@@ -220,7 +385,9 @@ class ClusterDeployer:
         '''
         Perform a cluster-wide deployment of a webapp
         Before deployment, the following tasks will be executed:
+          - check that the WAR files are valid (see validate_wars)
           - check that the path will not conflict with any other app in cluster
+          - skip nodes already running the same build (see digest_index)
           - if the app is versioned, expire old versions before proceeding
           - check that there is enough memory available on every node
           - optionally reboot nodes to reclaim memory
@@ -228,53 +395,160 @@ class ClusterDeployer:
         >>> from tomcat.deployer import parse_warfiles
         >>> d.deploy(parse_warfiles([ '/tmp/test.war' ]))
         '''
-        def handle_failure(failed):
+        def handle_failure(failed, skip):
             if len(failed) <= 0:
                 return
             errstr = "Deployment of {0} failed".format(' and '.join(failed))
             self.log.error(errstr)
             if self.undeploy_on_error:
-                ctx_names = [ ctx for ctx, path, ver in new_apps.values() ]
-                rv = self.undeploy(ctx_names, vhost)
+                # Leave the nodes that were skipped serving the app
+                for fn, (ctx, path, ver) in new_apps.items():
+                    hosts = [ h for h in self.c.members
+                              if not h in skip.get(fn, ()) ]
+                    if hosts:
+                        self.undeploy([ ctx ], vhost, hosts)
             raise TomcatError(errstr)
 
-        self._clean_old_apps(new_apps, vhost)
+        if self.validate_wars:
+            validate_warfiles(new_apps.keys(), self.require_descriptor)
+        digests = self._war_digests(new_apps)
+        skip = self._clean_old_apps(new_apps, vhost, digests)
         if self.check_memory:
             self._check_memory()
-        handle_failure(self._deploy(new_apps, vhost))
-        handle_failure(self._wait_for_apps(new_apps, vhost))
+        handle_failure(self._deploy(new_apps, vhost, digests, skip), skip)
+        handle_failure(self._wait_for_apps(new_apps, vhost), skip)
 
-    def undeploy(self, context_names, vhost='localhost'):
+    def undeploy(self, context_names, vhost='localhost', hosts=None):
         '''
-        Perform a cluster-wide undeploy of specified contexts
+        Perform a cluster-wide undeploy of specified contexts, or only on
+        the nodes listed in hosts
 
         >>> d.undeploy([ '/test1', '/test2' ])
         '''
+        if hosts is None:
+            hosts = self.c.members.keys()
         rv = {}
         for ctx in context_names:
             self.log.info("Performing a cluster-wide undeploy of %s", ctx)
-            rv[ctx] = self.c.run_command('undeploy', ctx, vhost) # TODO: report errors
+            rv[ctx] = self.c.run_command('undeploy', ctx, vhost,
+                                         hosts=hosts) # TODO: report errors
+            for host in rv[ctx].results:
+                self._set_deployed_digest(host, ctx, vhost, None)
+        self._save_digest_index()
         return rv
 
     def restart(self, hosts=None):
         '''
         Perform a safe rolling restart of the specified cluster nodes.
+        Nodes carrying the fewest sessions and busy threads go first. A
+        node is back in rotation once it is STARTED and the other members
+        list it as active again. One node is restarted at a time at first,
+        and one more each time a node comes back, up to restart_fraction
+        of the cluster, as long as restart_min_capacity of the cluster
+        stays in rotation. Returns the seconds each node was out of
+        rotation.
 
         >>> d.restart()
+        {'192.168.56.101:8080': 41.2, '192.168.56.102:8080': 38.7}
         '''
-        threads = int(round(self.c.member_count() * self.restart_fraction))
-        if threads < 1:
+        count = self.c.member_count()
+        max_window = int(round(count * self.restart_fraction))
+        if max_window < 1:
             raise TomcatError(
                 "Unable to restart {0}% of the nodes in a {1} node cluster"
-                .format(self.restart_fraction * 100, self.c.member_count()))
-        self.log.debug("Restarting %d nodes at once", threads)
-        opts = { 'abort_on_error': True, 'threads': threads }
-        if hosts:
-            opts['hosts'] = hosts
-        rv = self.c.run_command('restart', **opts)
-        if rv.has_failures:
+                .format(self.restart_fraction * 100, count))
+        if self.restart_min_capacity is None:
+            floor = count - max_window
+        else:
+            floor = int(math.ceil(count * self.restart_min_capacity))
+        pending = self._restart_order(hosts or self.c.members.keys())
+        clustered = any(self.c.run_command('has_cluster').results.values())
+        self.log.debug("Restarting up to %d nodes at once, keeping %d of %d "
+                       "in rotation", max_window, floor, count)
+
+        start = time.time()
+        (window, running, out, failures) = (1, set(), {}, {})
+        done = Queue.Queue()
+        while running or (pending and not failures):
+            if pending and not failures and len(running) < window:
+                healthy = self._nodes_in_rotation(running)
+                while pending and len(running) < window:
+                    if len(healthy - set(pending[:1])) < floor:
+                        break
+                    host = pending.pop(0)
+                    healthy.discard(host)
+                    running.add(host)
+                    self._start_restart(host, clustered, running, done)
+                if not running:
+                    raise TomcatError(
+                        "Restarting {0} would leave less than {1} of {2} "
+                        "nodes in rotation".format(pending[0], floor, count))
+            (host, elapsed, rv) = done.get()
+            running.discard(host)
+            out[host] = elapsed
+            if rv is None:
+                window = min(window + 1, max_window)
+            else:
+                self.log.error("Restarting %s failed: %s", host, rv)
+                failures[host] = rv
+
+        self.log.info("Restarted %d nodes in %.1fs", len(out), time.time() - start)
+        for host, elapsed in sorted(out.items()):
+            self.log.info("\t%s - out of rotation for %.1fs", host, elapsed)
+        if failures:
             self.log.error("There were failed applications after restart")
             sys.exit(1)
+        return out
+
+    def _restart_order(self, hosts):
+        '''
+        Least loaded nodes first, the ones that cannot report their load
+        before all others
+        '''
+        loads = self.c.run_command('load_info', hosts=hosts).results
+        def load(host):
+            l = loads.get(host)
+            if l is None:
+                return (-1, -1, host)
+            return (l['activeSessions'], l['currentThreadsBusy'], host)
+        return sorted(hosts, key=load)
+
+    def _nodes_in_rotation(self, running):
+        others = [ h for h in self.c.members if h not in running ]
+        rv = self.c.run_command('server_status', False, hosts=others)
+        return set(h for h, v in rv.results.items() if v == 'STARTED')
+
+    def _rejoined(self, host, running):
+        '''
+        Whether every other node in rotation lists host as an active member
+        '''
+        observers = [ h for h in self.c.members
+                      if h != host and h not in list(running) ]
+        views = self.c.run_command('active_members', False,
+                                   hosts=observers).results
+        hostname = self.c.members[host].host
+        return len(views) > 0 and all(
+            any(m['hostname'] == hostname for m in v.values())
+            for v in views.values())
+
+    def _start_restart(self, host, clustered, running, done):
+        def restart():
+            start = time.time()
+            rv = None
+            try:
+                result = self.c.run_command('restart', hosts=[ host ])
+                if result.has_failures:
+                    raise result.failures[host]
+                if clustered and not self._poller(self.rejoin_wait_time).wait(
+                        lambda: self._rejoined(host, running)):
+                    raise TomcatError('{0} did not rejoin the cluster in {1}s'
+                                      .format(host, self.rejoin_wait_time))
+            except Exception as e:
+                rv = e
+            done.put((host, time.time() - start, rv))
+        t = threading.Thread(target=restart)
+        t.daemon = True
+        t.start()
 
     def rollback(self, paths):
         """
@@ -5,3 +5,4 @@ Event type constants
 UPLOAD = 0
 CMD_START = 1
 CMD_END = 2
+EXPIRE = 3
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+import httplib, urllib2, socket, select, errno, threading, time, logging, zlib
+
+class HTTPConnectionPool:
+    '''
+    A thread-safe pool of persistent HTTP/1.1 connections to a single host.
+    Connections are reused for consecutive requests and closed once they
+    have been idle for longer than max_idle_time seconds (this should be
+    shorter than the keepAliveTimeout of the Tomcat connector).
+
+    >>> pool = HTTPConnectionPool('localhost', 8080)
+    >>> r = pool.request('GET', '/manager/text/list', headers=auth)
+    >>> print r.read()
+    >>> r.close() # returns the connection to the pool
+    '''
+    max_idle_time = 10
+    max_idle = 8
+    connection_class = httplib.HTTPConnection
+    # Errors while sending a request which show that the server had closed
+    # the connection before the request could reach it
+    stale_errors = frozenset([ errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED ])
+
+    def __init__(self, host, port = 8080, timeout = 10):
+        self.log = logging.getLogger('pytomcat.httppool')
+        (self.host, self.port, self.timeout) = (host, port, timeout)
+        self._idle = []
+        self._lock = threading.Lock()
+        self.connections_created = 0
+        self.requests = 0
+
+    def _acquire(self):
+        now = time.time()
+        with self._lock:
+            expired = [ c for c, t in self._idle if now - t > self.max_idle_time ]
+            self._idle = [ (c, t) for c, t in self._idle if now - t <= self.max_idle_time ]
+        for c in expired:
+            c.close()
+        while True:
+            with self._lock:
+                conn = self._idle.pop()[0] if self._idle else None
+            if conn is None:
+                return (self._new_connection(), False)
+            if not self._is_dropped(conn):
+                return (conn, True)
+            self.log.debug("Idle connection to %s:%s was closed by the server",
+                           self.host, self.port)
+            conn.close()
+
+    def _is_dropped(self, conn):
+        '''
+        Has the server closed an idle connection. Nothing is expected from
+        the server between requests, so a readable socket means it has been
+        closed (or is unusable anyway).
+        '''
+        if conn.sock is None:
+            return True
+        try:
+            return bool(select.select([ conn.sock ], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def _new_connection(self):
+        with self._lock:
+            self.connections_created += 1
+        self.log.debug("Opening a new connection to %s:%s", self.host, self.port)
+        return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def request(self, method, url, body = None, headers = {}, timeout = None,
+                idempotent = False):
+        '''
+        Perform a request and return a PooledResponse.
+        Raises urllib2.HTTPError on HTTP error status codes.
+        Idempotent requests (the caller knows that sending them twice does
+        no harm) are retried once on a new connection if sending them on a
+        reused connection fails because the server has closed it. Nothing
+        else is ever retried: once a request may have reached the server,
+        or if it timed out, the error is raised.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        (conn, reused) = self._acquire()
+        while True:
+            sent = False
+            try:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                conn.request(method, url, body, headers)
+                sent = True
+                try:
+                    # Avoid one recv() per byte of the response headers
+                    response = conn.getresponse(buffering=True)
+                except TypeError:
+                    # Python 2.6
+                    response = conn.getresponse()
+                break
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                if (not reused or not idempotent or sent or
+                        isinstance(e, socket.timeout) or
+                        getattr(e, 'errno', None) not in self.stale_errors):
+                    raise
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+                self.log.debug("Reused connection to %s:%s was closed, retrying",
+                               self.host, self.port)
+                (conn, reused) = (self._new_connection(), False)
+
+        with self._lock:
+            self.requests += 1
+        rv = PooledResponse(self, conn, response)
+        if response.status >= 400:
+            rv.close()
+            raise urllib2.HTTPError('http://{0}:{1}{2}'.format(self.host, self.port, url),
+                                    response.status, response.reason,
+                                    response.msg, None)
+        return rv
+
+    def close(self):
+        '''
+        Close all idle connections
+        '''
+        with self._lock:
+            (idle, self._idle) = (self._idle, [])
+        for c, t in idle:
+            c.close()
+
+class PooledResponse:
+    '''
+    A file-like wrapper around httplib.HTTPResponse which returns the
+    connection to the pool when closed, provided that the response has
+    been read completely. A gzip or deflate Content-Encoding is decoded
+    on the fly; bytes_received and bytes_decoded count the body size on
+    the wire and after decoding.
+    '''
+    blocksize = 65536
+
+    def __init__(self, pool, conn, response):
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+        self._buf = ''
+        self._pos = 0
+        self.status = response.status
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self._encoding = (response.getheader('Content-Encoding') or '').strip().lower()
+        if self._encoding in ('gzip', 'x-gzip'):
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self._encoding == 'deflate':
+            self._decoder = zlib.decompressobj()
+        else:
+            self._decoder = None
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def _take(self, end):
+        rv = self._buf[self._pos:end]
+        if end >= len(self._buf):
+            (self._buf, self._pos) = ('', 0)
+        else:
+            self._pos = end
+        return rv
+
+    def _decode(self, data):
+        try:
+            return self._decoder.decompress(data)
+        except zlib.error:
+            if self._encoding != 'deflate' or self.bytes_decoded > 0:
+                raise
+            # Some servers send a raw deflate stream without zlib headers
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(data)
+
+    def _read_block(self):
+        '''
+        Return the next decoded block of the body or '' at the end
+        '''
+        while True:
+            raw = self._response.read(self.blocksize)
+            self.bytes_received += len(raw)
+            if self._decoder is None:
+                data = raw
+            elif raw:
+                data = self._decode(raw)
+                if not data:
+                    continue
+            else:
+                data = self._decoder.flush()
+            self.bytes_decoded += len(data)
+            return data
+
+    def _fill(self):
+        data = self._read_block()
+        if data:
+            self._buf = self._buf[self._pos:] + data
+            self._pos = 0
+        return len(data)
+
+    def read(self, amt=None):
+        while amt is None or len(self._buf) - self._pos < amt:
+            if not self._fill():
+                break
+        if amt is None:
+            return self._take(len(self._buf))
+        return self._take(min(self._pos + amt, len(self._buf)))
+
+    def readline(self):
+        start = self._pos
+        while True:
+            i = self._buf.find('\n', start)
+            if i >= 0:
+                return self._take(i + 1)
+            start = len(self._buf) - self._pos
+            if not self._fill():
+                return self._take(len(self._buf))
+
+    def close(self):
+        if self._conn is None:
+            return
+        (conn, self._conn) = (self._conn, None)
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._release(conn)
+        else:
+            self._response.close()
+            conn.close()
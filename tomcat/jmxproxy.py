@@ -1,61 +1,249 @@
 #!/usr/bin/env python
 
-import urllib, urllib2, base64, logging
-from parser import parse
+import urllib, base64, logging, threading
+from parser import parse, iter_search_results, compact
 from error import TomcatError
+from httppool import HTTPConnectionPool
+from cache import ResultCache, SingleFlight
 
 class JMXProxyConnection:
+    # Return query results as interned, read-only CompactBean mappings
+    compact_results = False
+    # Ask for gzip/deflate compressed responses (used if the connector has
+    # compression enabled, otherwise the server simply ignores it)
+    compression = True
+    # Optional ResultCache for query/get results, see enable_cache()
+    cache = None
+    # Operations known to have no side effects, invoking them does not
+    # invalidate the cache
+    read_only_operations = frozenset([ 'listSessionIds', 'findConnectors',
+                                       'dumpAllThreads' ])
+
     def __init__(self, host, user = 'admin', passwd = 'admin',
-                 port = 8080, timeout = 10):
+                 port = 8080, timeout = 10, pool = None):
         self.log = logging.getLogger('pytomcat.jmxproxy')
         self.timeout = timeout
-        self.baseurl = 'http://%s:%s/manager/jmxproxy/' % (host, port)
+        self.pool = pool if pool is not None else HTTPConnectionPool(host, port)
+        self.path = '/manager/jmxproxy/'
+        self.baseurl = 'http://%s:%s%s' % (host, port, self.path)
         # use custom header, HTTPBasicAuthHandler is an overcomplicated POS
         # http://stackoverflow.com/questions/635113/python-urllib2-basic-http-authentication-and-tr-im
         b64 = base64.standard_b64encode('%s:%s' % (user, passwd))
         self.auth_header = 'Basic %s' % b64
+        self._stats_lock = threading.Lock()
+        # (bytes on the wire, bytes after decompression) of the last request
+        self.last_transfer = (0, 0)
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        # Concurrent identical query/get requests share one HTTP request
+        self.flights = SingleFlight()
 
-    def _do_get(self, request, timeout=None):
+    def _open(self, request, timeout=None, idempotent=False):
         if timeout is None:
             timeout=self.timeout
-        request = urllib2.Request('%s?%s' % (self.baseurl, request))
-        cmd_url = request.get_full_url()
-        request.add_header("Authorization", self.auth_header)
+        cmd_url = '%s?%s' % (self.baseurl, request)
         self.log.debug("JMXProxy request: %s", cmd_url)
+        headers = { 'Authorization': self.auth_header }
+        if self.compression:
+            headers['Accept-Encoding'] = 'gzip, deflate'
         try:
-            result = urllib2.urlopen(request, None, timeout)
+            return self.pool.request('GET', '%s?%s' % (self.path, request),
+                       headers=headers, timeout=timeout, idempotent=idempotent)
         except Exception as e:
             raise TomcatError('Error communicating with {0}: {1}'.format(cmd_url, e))
-        rv = result.read().replace('\r','')
+
+    def enable_cache(self, ttl=5, max_entries=128):
+        '''
+        Cache query and get results for ttl seconds. The cache is
+        invalidated by set, Tomcat.deploy/undeploy and invoking any
+        operation not listed in read_only_operations.
+
+        >>> t.jmx.enable_cache(ttl=2)
+        >>> t.jmx.cache.stats
+        {'hits': 0, 'misses': 0, 'entries': 0}
+        '''
+        self.cache = ResultCache(ttl, max_entries)
+
+    def disable_cache(self):
+        self.cache = None
+
+    def invalidate_cache(self):
+        if self.cache is not None:
+            self.cache.invalidate()
+        # Reads issued from now on must not join those started before
+        self.flights.forget()
+
+    def _close(self, result):
+        result.close()
+        transfer = (result.bytes_received, result.bytes_decoded)
+        with self._stats_lock:
+            self.last_transfer = transfer
+            self.bytes_received += transfer[0]
+            self.bytes_decoded += transfer[1]
+        self.log.debug("JMXProxy transfer: %d bytes received, %d bytes decoded",
+                       *transfer)
+
+    def _do_get(self, request, timeout=None, idempotent=False):
+        result = self._open(request, timeout, idempotent)
+        try:
+            rv = result.read().replace('\r','')
+        finally:
+            self._close(result)
         self.log.debug("JMXProxy response: %s", rv)
         if not rv.startswith('OK'):
             raise TomcatError(rv)
         return rv
 
-    def query(self, qry):
-        def inject_oname(obj_map):
-            for k, v in obj_map.iteritems():
-                if not 'objectName' in v:
-                    v['objectName'] = k
-            return obj_map
-        data = self._do_get(urllib.urlencode({ 'qry' : qry }))
-        return inject_oname(parse('search_results', data))
+    def _read(self, request, timeout=None):
+        '''
+        Perform a read-only request. The response is served from the cache
+        or shared with an identical request in flight if possible.
+        '''
+        cache = self.cache
+        rv = cache.get(request) if cache is not None else None
+        if rv is not None:
+            return rv
+
+        if timeout is None:
+            timeout = self.timeout
+        call = self.flights.join(request)
+        if not call.leader:
+            rv = call.wait(timeout)
+            return rv if rv is not None else self._do_get(request, timeout, True)
+
+        generation = cache.generation if cache is not None else None
+        try:
+            rv = self._do_get(request, timeout, True)
+        except Exception as e:
+            self.flights.finish(call, error=e)
+            raise
+        self.flights.finish(call, rv)
+        if cache is not None:
+            cache.put(request, rv, generation)
+        return rv
+
+    def _read_lines(self, request, timeout=None):
+        '''
+        Like _iter_lines, but for read-only requests served from the cache
+        or shared with an identical request in flight if possible.
+        Responses are only shared if they were read completely, and only
+        kept in memory if there is a cache or a caller to share them with.
+        '''
+        cache = self.cache
+        lines = cache.get(request) if cache is not None else None
+        if lines is not None:
+            for line in lines:
+                yield line
+            return
+
+        if timeout is None:
+            timeout = self.timeout
+        call = self.flights.join(request)
+        if not call.leader:
+            lines = call.wait(timeout)
+            if lines is None:
+                lines = self._iter_lines(request, timeout)
+            for line in lines:
+                yield line
+            return
+
+        if cache is None and self.flights.stream(call):
+            try:
+                for line in self._iter_lines(request, timeout):
+                    yield line
+            finally:
+                self.flights.finish(call)
+            return
+
+        generation = cache.generation if cache is not None else None
+        lines = []
+        try:
+            for line in self._iter_lines(request, timeout):
+                lines.append(line)
+                yield line
+            self.flights.finish(call, lines)
+        except Exception as e:
+            self.flights.finish(call, error=e)
+            raise
+        finally:
+            # Abandoned by the caller, let the followers fetch on their own
+            if not call.event.is_set():
+                self.flights.finish(call)
+        if cache is not None:
+            cache.put(request, lines, generation)
+
+    def _iter_lines(self, request, timeout=None):
+        '''
+        Yield response lines of a query as they are read from the socket
+        '''
+        result = self._open(request, timeout, idempotent=True)
+        try:
+            line = result.readline().replace('\r','')
+            if not line.startswith('OK'):
+                rv = line + result.read().replace('\r','')
+                self.log.debug("JMXProxy response: %s", rv)
+                raise TomcatError(rv)
+            self.log.debug("JMXProxy response: %s", line.rstrip())
+            yield line
+            for line in iter(result.readline, ''):
+                yield line.replace('\r','')
+        finally:
+            self._close(result)
+
+    def iter_query(self, qry, attributes=None, cached=True):
+        '''
+        Query MBeans, yielding (object name, attributes) tuples while the
+        response is still being received. Only one bean is kept in memory
+        at a time and the connection is closed if the caller stops early.
+        If attributes is given, all other bean properties are skipped by
+        the parser ('objectName' is always present). Pass cached=False to
+        always read current values, bypassing the cache.
+        With compact_results enabled, beans are returned as read-only
+        CompactBean mappings.
+
+        >>> for name, attrs in jmx.iter_query('Catalina:type=Manager,*',
+        ...                                   [ 'activeSessions' ]):
+        ...     print name, attrs['activeSessions']
+        '''
+        request = urllib.urlencode({ 'qry' : qry })
+        if cached:
+            lines = self._read_lines(request)
+        else:
+            lines = self._iter_lines(request)
+        for (name, attrs) in iter_search_results(lines, attributes):
+            attrs.setdefault('objectName', name)
+            if self.compact_results:
+                attrs = compact(attrs)
+            yield (name, attrs)
 
-    def get(self, bean, property, key = None):
+    def query(self, qry, attributes=None, cached=True):
+        return dict(self.iter_query(qry, attributes, cached))
+
+    def get(self, bean, property, key = None, cached = True):
         qry = { 'get': bean, 'att': property }
         if key != None:
             qry['key'] = key
-        data = self._do_get(urllib.urlencode(qry))
+        if cached:
+            data = self._read(urllib.urlencode(qry))
+        else:
+            data = self._do_get(urllib.urlencode(qry), idempotent=True)
         return parse('get_results', data)
 
     def set(self, bean, property, value):
-        data = self._do_get(urllib.urlencode(
-                   { 'set': bean, 'att': property, 'key': key }))
+        try:
+            self._do_get(urllib.urlencode(
+                { 'set': bean, 'att': property, 'val': value }))
+        finally:
+            self.invalidate_cache()
 
     def invoke(self, bean, op, *params, **custConnParams):
         timeout = self.timeout
         if 'timeout' in custConnParams:
             timeout = custConnParams['timeout']
-        data = self._do_get(urllib.urlencode(
-                   { 'invoke': bean, 'op': op, 'ps': ','.join(params) }), timeout)
+        try:
+            data = self._do_get(urllib.urlencode(
+                       { 'invoke': bean, 'op': op, 'ps': ','.join(params) }), timeout)
+        finally:
+            if not op in self.read_only_operations:
+                self.invalidate_cache()
         return parse('invoke_results', data)
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
-import urllib, urllib2, base64, os, logging
+import urllib, base64, os, re, logging, mmap, time, threading
 from error import TomcatError
 from events import *
+from httppool import HTTPConnectionPool
 
 class ManagerConnection:
     '''
@@ -17,10 +18,12 @@ class ManagerConnection:
     upload_timeout = 900
 
     def __init__(self, host, user = 'admin', passwd = 'admin',
-                 port = 8080, timeout = 10):
+                 port = 8080, timeout = 10, pool = None):
         self.log = logging.getLogger('pytomcat.manager')
         self.timeout = timeout
-        self.baseurl = 'http://%s:%s/manager/text' % (host, port)
+        self.pool = pool if pool is not None else HTTPConnectionPool(host, port)
+        self.path = '/manager/text'
+        self.baseurl = 'http://%s:%s%s' % (host, port, self.path)
         # use custom header, HTTPBasicAuthHandler is an overcomplicated POS
         b64 = base64.standard_b64encode('%s:%s' % (user, passwd))
         self.auth_header = 'Basic %s' % b64
@@ -28,62 +31,300 @@ class ManagerConnection:
     def _cmd_url(self, command, parameters):
         return '{0}/{1}?{2}'.format(self.baseurl, command, parameters)
 
-    def _do_request(self, request, vhost, timeout=None):
+    def _do_request(self, method, command, parameters, vhost, data=None,
+                    headers={}, timeout=None):
         if timeout == None:
             timeout = self.timeout
-        request.add_header("Authorization", self.auth_header)
-        request.add_header("Host", vhost)
-        cmd_url = request.get_full_url()
+        headers = dict(headers)
+        headers.update({ 'Authorization': self.auth_header, 'Host': vhost })
+        cmd_url = self._cmd_url(command, parameters)
         self.log.debug("TomcatManager request: %s", cmd_url)
         try:
-            result = urllib2.urlopen(request, None, timeout)
+            result = self.pool.request(method,
+                         '{0}/{1}?{2}'.format(self.path, command, parameters),
+                         data, headers, timeout)
+            try:
+                rv = result.read().replace('\r','')
+            finally:
+                result.close()
         except Exception as e:
             raise TomcatError('Error communicating with {0}: {1}'.format(cmd_url, e))
-        rv = result.read().replace('\r','')
         self.log.debug("TomcatManager response: %s", rv)
         if not rv.startswith('OK'):
             raise TomcatError(rv)
         return rv
 
     def _do_get(self, command, parameters, vhost):
-        request = urllib2.Request(self._cmd_url(command, parameters))
-        return self._do_request(request, vhost)
+        return self._do_request('GET', command, parameters, vhost)
 
-    def _do_put(self, command, parameters, filename, vhost):
-        # http://stackoverflow.com/questions/111945/is-there-any-way-to-do-http-put-in-python
+    def _do_put(self, command, parameters, war, vhost):
         cmd_url = self._cmd_url(command, parameters)
-        data = _urllib_file(filename, 'r', self.progress_callback,
-                            url=cmd_url, event=UPLOAD)
-        request = urllib2.Request(cmd_url, data)
-        request.add_header('Content-Type', 'application/binary')
-        request.get_method = lambda: 'PUT'
-        return self._do_request(request, vhost, self.upload_timeout)
-
-    def deploy(self, filename, context, vhost='localhost'):
+        shared = isinstance(war, WarFile)
+        if not shared:
+            war = WarFile(war)
+        scheduler = war.scheduler
+        try:
+            if scheduler is not None:
+                scheduler.acquire()
+            try:
+                data = war.open(self.progress_callback, url=cmd_url,
+                                event=UPLOAD)
+                return self._do_request('PUT', command, parameters, vhost,
+                           data, { 'Content-Type': 'application/binary' },
+                           self.upload_timeout)
+            finally:
+                if scheduler is not None:
+                    scheduler.release()
+        finally:
+            if not shared:
+                war.close()
+
+    def deploy(self, war, context, vhost='localhost'):
+        '''
+        Upload and deploy war, a file name or a WarFile
+        '''
         params = urllib.urlencode({ 'path': context })
-        return self._do_put('deploy', params, filename, vhost)
+        return self._do_put('deploy', params, war, vhost)
 
     def undeploy(self, context, vhost='localhost'):
         self._do_get('undeploy', urllib.urlencode({ 'path' : context }), vhost)
 
-class _urllib_file(file):
-    # http://stackoverflow.com/questions/5925028/urllib2-post-progress-monitoring
-    def __init__(self, path, mode = 'r', callback = None, **args):
-        file.__init__(self, path, mode)
-        self.seek(0, os.SEEK_END)
-        self._total = self.tell()
-        self.seek(0)
+    def expire(self, context, idle=0, vhost='localhost'):
+        '''
+        Expire the sessions of a webapp that have been idle for at least
+        idle minutes (all of them by default) with a single request,
+        returns the number of expired sessions
+        '''
+        rv = self._do_get('expire', urllib.urlencode({ 'path': context,
+                                                       'idle': idle }), vhost)
+        m = re.search('(\\d+) sessions were expired', rv)
+        if m == None:
+            raise TomcatError('Unexpected response to expire: {0}'.format(rv))
+        return int(m.group(1))
+
+class WarFile:
+    '''
+    A WAR file mapped into memory once, so that it can be uploaded to any
+    number of nodes at the same time without reading it again for each
+    of them. Every upload sends read-only views of the mapping.
+
+    >>> war = WarFile('/tmp/app.war')
+    >>> try:
+    ...     c.run_command('deploy', war, '/app')
+    ... finally:
+    ...     war.close()
+
+    Uploads of WarFiles sharing an UploadScheduler share its limits.
+    '''
+    def __init__(self, filename, scheduler = None):
+        self.name = filename
+        self.scheduler = scheduler
+        f = open(filename, 'rb')
+        try:
+            self.size = os.fstat(f.fileno()).st_size
+            # empty files cannot be mapped
+            if self.size > 0:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._map = None
+        finally:
+            f.close()
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.name
+
+    def view(self, offset, size):
+        return buffer(self._map, offset, size) if size > 0 else ''
+
+    def open(self, callback = None, **args):
+        '''
+        Return a new file-like reader for a single upload
+        '''
+        return _WarReader(self, callback, **args)
+
+    def close(self):
+        '''
+        Unmap the file, all uploads must have finished
+        '''
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+class UploadScheduler:
+    '''
+    Limits the total bandwidth (bytes per second) and the number of
+    concurrent uploads of the WarFiles sharing it. Uploads waiting for a
+    slot start in the order they asked for one. Pass the number of bytes
+    about to be uploaded to expect() to get an ETA.
+
+    >>> sched = UploadScheduler(bandwidth=50 * 1048576, max_uploads=4)
+    >>> war = WarFile('/tmp/app.war', sched)
+    >>> sched.expect(len(war) * c.member_count())
+    >>> hosts = sched.order(c.members.keys(), lambda h: h.split('-')[0])
+    >>> c.run_command('deploy', war, '/app', hosts=hosts)
+    '''
+    # Shortest interval the bandwidth limit is enforced over
+    burst_interval = 0.1
+
+    def __init__(self, bandwidth = None, max_uploads = None):
+        (self.bandwidth, self.max_uploads) = (bandwidth, max_uploads)
+        self._lock = threading.Condition(threading.Lock())
+        self._running = 0
+        self._queue = []
+        self._allowance = 0.0
+        self._last = None
+        self.expected = 0
+        self.sent = 0
+        self.start_time = None
+
+    def order(self, hosts, location = None, grouped = False):
+        '''
+        Order hosts by location, a dict or function returning e.g. the
+        rack or datacenter of a host. Locations take turns, so concurrent
+        uploads are spread over their uplinks, or with grouped each
+        location is done before the next one starts.
+        '''
+        if location is None:
+            return list(hosts)
+        if isinstance(location, dict):
+            location = location.get
+        (groups, keys) = ({}, [])
+        for h in hosts:
+            k = location(h)
+            if not k in groups:
+                groups[k] = []
+                keys.append(k)
+            groups[k].append(h)
+        if grouped:
+            return [ h for k in keys for h in groups[k] ]
+        rv = []
+        for i in xrange(max(len(g) for g in groups.values()) if groups else 0):
+            rv += [ groups[k][i] for k in keys if i < len(groups[k]) ]
+        return rv
+
+    def expect(self, size):
+        with self._lock:
+            self.expected += size
+
+    def acquire(self):
+        '''
+        Wait for an upload slot
+        '''
+        ticket = object()
+        with self._lock:
+            self._queue.append(ticket)
+            while (self._queue[0] is not ticket or self.max_uploads and
+                   self._running >= self.max_uploads):
+                self._lock.wait()
+            self._queue.pop(0)
+            self._running += 1
+            self._lock.notify_all()
+
+    def release(self):
+        with self._lock:
+            self._running -= 1
+            self._lock.notify_all()
+
+    def chunksize(self, default):
+        if not self.bandwidth:
+            return default
+        return int(max(4096, min(default, self.bandwidth * self.burst_interval)))
+
+    def throttle(self, size):
+        '''
+        Account for size bytes about to be sent, sleeping as long as needed
+        to stay under the bandwidth limit
+        '''
+        with self._lock:
+            now = time.time()
+            if self.start_time is None:
+                self.start_time = now
+            self.sent += size
+            if not self.bandwidth:
+                return
+            if self._last is not None:
+                # unused bandwidth is not saved for more than a burst
+                self._allowance = min(self.bandwidth * self.burst_interval,
+                    self._allowance + (now - self._last) * self.bandwidth)
+            self._last = now
+            self._allowance -= size
+            delay = -self._allowance / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+    def progress(self):
+        '''
+        Return the total throughput in bytes per second and the estimated
+        seconds left (None if unknown)
+        '''
+        with self._lock:
+            elapsed = time.time() - self.start_time if self.start_time else 0
+            rate = self.sent / elapsed if elapsed > 0 else 0.0
+            eta = None
+            if rate > 0 and self.expected:
+                eta = max(self.expected - self.sent, 0) / rate
+            return (rate, eta)
+
+class _WarReader:
+    '''
+    File-like reader of a WarFile for httplib. read() returns views of
+    chunksize bytes whatever the size asked for (httplib asks for 8k),
+    and the progress callback receives the position (bytes sent so far)
+    and the throughput of this upload in bytes per second, plus the
+    total_rate and eta of its UploadScheduler if it has one.
+    '''
+    chunksize = 1 << 20
+
+    def __init__(self, war, callback = None, **args):
+        self._war = war
+        self._pos = 0
+        self._start = None
         self._callback = callback
-        self._path = path
         self._args = args
 
     def __len__(self):
-        return self._total
+        return self._war.size
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._war.size
+        (self._pos, self._start) = (max(0, offset), None)
 
-    def read(self, size):
+    def read(self, size = -1):
+        now = time.time()
+        if self._start is None:
+            self._start = now
+        scheduler = self._war.scheduler
+        chunksize = self.chunksize
+        if scheduler is not None:
+            chunksize = scheduler.chunksize(chunksize)
+        n = self._war.size - self._pos
+        if size >= 0:
+            n = min(n, max(size, chunksize))
         if self._callback != None:
-            self._callback(position=self.tell(), total=self._total, blocksize=size,
-                           filename=self._path, **self._args)
-        data = file.read(self, size)
+            elapsed = now - self._start
+            stats = {}
+            if scheduler is not None:
+                (stats['total_rate'], stats['eta']) = scheduler.progress()
+            stats.update(self._args)
+            self._callback(position=self._pos, total=self._war.size,
+                           blocksize=n, filename=self._war.name,
+                           elapsed=elapsed,
+                           rate=self._pos / elapsed if elapsed > 0 else 0.0,
+                           **stats)
+        if scheduler is not None and n > 0:
+            scheduler.throttle(n)
+        data = self._war.view(self._pos, n)
+        self._pos += n
         return data
 
+    def close(self):
+        pass
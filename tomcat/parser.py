@@ -1,209 +1,253 @@
 #!/usr/bin/env python
 #
-# Yapps2 is required to re-generate parser code
-# http://theory.stanford.edu/~amitp/yapps/
-#
 # Antti Andreimann Fri Mar 22 2013
 
 '''
 A Module for parsing textual output produced by Tomcat 7 JMX Proxy Servlet
 http://tomcat.apache.org/tomcat-7.0-doc/manager-howto.html#Using_the_JMX_Proxy_Servlet
 Last version tested: 7.0.35
+
+The output format is line oriented, so the parser works one line at a
+time instead of one character at a time:
+
+    search_results: "OK - ...\\n+" ( bean )* END
+    bean:           "Name: " BEAN_ID "\\n" ( ID ": " propval )* "\\n"
+    propval:        value "\\n" | ARY_START ( "\\t" value "\\n" )*
+    value:          "" | composite | literal
+    composite:      CMP_START ID '=' kvvalue ( ", " ID '=' kvvalue )* "})"
+    get_results:    "OK - Attribute ... = " propval END
+    invoke_results: "OK - Operation ... without return value\\n" END
+                  | "OK - Operation ... returned:\\n"
+                    ( value "\\n" | ( "  " value "\\n" )+ ) END
 '''
 
-from string import *
-import re
-from yappsrt import *
-
-class JMXProxyOutputParserScanner(Scanner):
-    patterns = [
-        ('"  "', re.compile('  ')),
-        ('"OK - Operation .*? returned:\\n"', re.compile('OK - Operation .*? returned:\n')),
-        ('"OK - Operation .*? without return value\\n"', re.compile('OK - Operation .*? without return value\n')),
-        ('"OK - Attribute .*? = "', re.compile('OK - Attribute .*? = ')),
-        ("'='", re.compile('=')),
-        ('", "', re.compile(', ')),
-        ('"\\t"', re.compile('\t')),
-        ('""', re.compile('')),
-        ('": "', re.compile(': ')),
-        ('"\\n"', re.compile('\n')),
-        ('"Name: "', re.compile('Name: ')),
-        ('"OK - .*?\\n+"', re.compile('OK - .*?\n+')),
-        ('END', re.compile('$')),
-        ('ARY_START', re.compile('Array\\[.+?\\] of length [0-9]+\n')),
-        ('CMP_START', re.compile('javax.management.openmbean.CompositeDataSupport\\(compositeType=.+?,contents={')),
-        ('CMP_END', re.compile('}\\)')),
-        ('BEAN_ID', re.compile('[^\n]+')),
-        ('ID', re.compile('\\w+')),
-        ('CHAR', re.compile('[^\n]')),
-    ]
-    def __init__(self, str):
-        Scanner.__init__(self,None,[],str)
-
-class JMXProxyOutputParser(Parser):
-    def search_results(self):
-        self._scan('"OK - .*?\\n+"')
-        rv = {}
-        while self._peek('END', '"Name: "') == '"Name: "':
-            bean = self.bean()
-            rv.update(bean)
-        END = self._scan('END')
-        return rv
+import re, collections
+from cStringIO import StringIO
+from error import TomcatError
 
-    def bean(self):
-        self._scan('"Name: "')
-        BEAN_ID = self._scan('BEAN_ID')
-        self._scan('"\\n"')
-        o = {}
-        while self._peek('"\\n"', 'ID') == 'ID':
-            property = self.property()
-            o.update(property)
-        self._scan('"\\n"')
-        return { BEAN_ID: o }
-
-    def property(self):
-        ID = self._scan('ID')
-        self._scan('": "')
-        propval = self.propval()
-        return { ID: propval }
-
-    def value(self):
-        _token_ = self._peek('""', 'CHAR', 'CMP_START')
-        if _token_ == '""':
-            self._scan('""')
+_SEARCH_HEADER = re.compile('OK - .*?\n')
+_GET_HEADER = re.compile('OK - Attribute .*? = ')
+_INVOKE_VOID = re.compile('OK - Operation .*? without return value\n')
+_INVOKE_VALUE = re.compile('OK - Operation .*? returned:\n')
+
+_PROPERTY = re.compile('(\\w+): ')
+_ARY_START = re.compile('Array\\[.+?\\] of length [0-9]+\n')
+_CMP_START = re.compile('javax.management.openmbean.CompositeDataSupport\\(compositeType=(.+?),contents={')
+_KEY = re.compile('(\\w+)=')
+_KVLITERAL = re.compile('.+?(?=, |}\\))')
+_TYPE_PARENS = re.compile('[()]')
+_ITEM = re.compile('itemName=(\\w+),itemType=(.*)\\Z')
+_SIMPLE_TYPE = re.compile('javax.management.openmbean.SimpleType\\(name=([\\w.]+)\\)\\Z')
+
+class JMXProxyOutputParser:
+    '''
+    Parses JMX Proxy output from an iterable of newline terminated lines.
+    If attributes is given, bean properties not listed there are skipped
+    without being decoded.
+    '''
+    def __init__(self, lines, attributes=None):
+        self._lines = iter(lines)
+        self._attributes = None if attributes is None else frozenset(attributes)
+        self._pushback = None
+        self._lineno = 0
+
+    def _next(self):
+        if self._pushback is not None:
+            line, self._pushback = self._pushback, None
+        else:
+            line = next(self._lines, None)
+        self._lineno += 1
+        return line
+
+    def _push(self, line):
+        self._pushback = line
+        self._lineno -= 1
+
+    def _error(self, msg, line=None):
+        if line is not None:
+            msg = '{0}: {1!r}'.format(msg, line[:80])
+        raise TomcatError('Unable to parse JMX proxy output on line {0}: {1}'
+                          .format(self._lineno, msg))
+
+    def _header(self, *patterns):
+        line = self._next()
+        if line is not None:
+            for p in patterns:
+                m = p.match(line)
+                if m:
+                    return (p, line, m.end())
+        self._error('Unexpected response header', line)
+
+    def _end(self):
+        line = self._next()
+        if line is None or (line == '\n' and self._next() is None):
+            return
+        self._error('Expected end of output', line)
+
+    def _value(self, s):
+        if not s:
             return None
-        elif _token_ == 'CHAR':
-            literal = self.literal()
-            return literal
-        else:# == 'CMP_START'
-            composite = self.composite()
-            return composite
-
-    def propval(self):
-        _token_ = self._peek('""', 'CHAR', 'CMP_START', 'ARY_START')
-        if _token_ != 'ARY_START':
-            value = self.value()
-            self._scan('"\\n"')
-            return value
-        else:# == 'ARY_START'
-            array = self.array()
-            return array
-
-    def literal(self):
-        s = ""
-        while 1:
-            CHAR = self._scan('CHAR')
-            s += CHAR
-            if self._peek('CHAR', '"\\n"') != 'CHAR': break
+        if s[0] == 'j':
+            m = _CMP_START.match(s)
+            if m:
+                (c, pos) = self._composite(s, m)
+                if pos != len(s):
+                    self._error('Unexpected data after composite', s[pos:])
+                return c
         return convert_from_str(s)
 
-    def array(self):
-        ARY_START = self._scan('ARY_START')
-        a = []
-        while self._peek('"\\t"', 'END', '"\\n"', 'ID') == '"\\t"':
-            self._scan('"\\t"')
-            value = self.value()
-            self._scan('"\\n"')
-            a.append(value)
-        return a
-
-    def composite(self):
-        CMP_START = self._scan('CMP_START')
+    def _composite(self, s, header):
         c = {}
-        keyvalue = self.keyvalue()
-        c.update(keyvalue)
-        while self._peek('", "', 'CMP_END') == '", "':
-            self._scan('", "')
-            keyvalue = self.keyvalue()
-            c.update(keyvalue)
-        CMP_END = self._scan('CMP_END')
-        return c
-
-    def keyvalue(self):
-        ID = self._scan('ID')
-        self._scan("'='")
-        kvvalue = self.kvvalue()
-        return { ID: kvvalue }
-
-    def kvvalue(self):
-        _token_ = self._peek('""', 'CMP_START', 'CHAR')
-        if _token_ == '""':
-            self._scan('""')
-            return None
-        elif _token_ == 'CHAR':
-            kvliteral = self.kvliteral()
-            return kvliteral
-        else:# == 'CMP_START'
-            composite = self.composite()
-            return composite
-
-    def kvliteral(self):
-        s = ""
-        while 1:
-            CHAR = self._scan('CHAR')
-            s += CHAR
-            if self._peek('CHAR', '", "', 'CMP_END') != 'CHAR': break
-        return convert_from_str(s)
+        end = len(s)
+        pos = header.end()
+        types = composite_type(header.group(1))
+        while True:
+            m = _KEY.match(s, pos)
+            if m is None:
+                self._error('Expected a composite key', s[pos:])
+            key = m.group(1)
+            pos = m.end()
+            if pos >= end:
+                value = None
+            else:
+                m = _CMP_START.match(s, pos) if s[pos] == 'j' else None
+                if m:
+                    (value, pos) = self._composite(s, m)
+                else:
+                    m = _KVLITERAL.match(s, pos)
+                    if m is None:
+                        self._error('Unterminated composite value', s[pos:])
+                    value = types.get(key, convert_from_str)(m.group())
+                    pos = m.end()
+            c[key] = value
+            if s.startswith(', ', pos):
+                pos += 2
+            elif s.startswith('})', pos):
+                return (c, pos + 2)
+            else:
+                self._error('Expected a composite separator', s[pos:])
 
-    def get_results(self):
-        self._scan('"OK - Attribute .*? = "')
-        propval = self.propval()
-        END = self._scan('END')
-        return propval
+    def _array(self, skip=False):
+        a = []
+        while True:
+            line = self._next()
+            if line is None or not line.startswith('\t'):
+                self._push(line)
+                return a
+            if not line.endswith('\n'):
+                self._error('Unterminated array element', line)
+            if not skip:
+                a.append(self._value(line[1:-1]))
 
-    def invoke_results(self):
-        _token_ = self._peek('"OK - Operation .*? without return value\\n"', '"OK - Operation .*? returned:\\n"')
-        if _token_ == '"OK - Operation .*? without return value\\n"':
-            invoke_no_value = self.invoke_no_value()
-        else:# == '"OK - Operation .*? returned:\\n"'
-            invoke_value = self.invoke_value()
-            return invoke_value
-
-    def invoke_no_value(self):
-        self._scan('"OK - Operation .*? without return value\\n"')
-        END = self._scan('END')
-
-    def invoke_value(self):
-        self._scan('"OK - Operation .*? returned:\\n"')
-        rv = None
-        nvk_val = self.nvk_val()
-        rv = nvk_val
-        END = self._scan('END')
-        return rv
+    def _is_array(self, line, pos):
+        if not line.startswith('Array[', pos):
+            return False
+        m = _ARY_START.match(line, pos)
+        return m is not None and m.end() == len(line)
 
-    def nvk_val(self):
-        _token_ = self._peek('""', 'CHAR', 'CMP_START', '"  "')
-        if _token_ != '"  "':
-            value = self.value()
-            self._scan('"\\n"')
-            return value
-        else:# == '"  "'
-            nvk_arr = self.nvk_arr()
-            return nvk_arr
-
-    def nvk_arr(self):
-        rv = []
-        while 1:
-            self._scan('"  "')
-            value = self.value()
-            self._scan('"\\n"')
-            rv.append(value)
-            if self._peek('"  "', 'END') != '"  "': break
-        return rv
+    def _propval(self, line, pos):
+        if not line.endswith('\n'):
+            self._error('Unterminated value', line)
+        if self._is_array(line, pos):
+            return self._array()
+        return self._value(line[pos:-1])
 
+    def _skip_propval(self, line, pos):
+        if not line.endswith('\n'):
+            self._error('Unterminated value', line)
+        if self._is_array(line, pos):
+            self._array(skip=True)
 
-def parse(rule, text):
-    P = JMXProxyOutputParser(JMXProxyOutputParserScanner(text))
-    return wrap_error_reporter(P, rule)
+    def _bean(self, name):
+        o = {}
+        attributes = self._attributes
+        while True:
+            line = self._next()
+            if line == '\n':
+                return (name, o)
+            m = _PROPERTY.match(line) if line is not None else None
+            if m is None:
+                self._error('Expected a property', line)
+            key = m.group(1)
+            if attributes is None or key in attributes:
+                o[key] = self._propval(line, m.end())
+            else:
+                self._skip_propval(line, m.end())
 
+    def iter_beans(self):
+        '''
+        Yield (object name, attributes) tuples of a search result one
+        bean at a time
+        '''
+        self._header(_SEARCH_HEADER)
+        line = self._next()
+        while line == '\n':
+            line = self._next()
+        while line is not None:
+            if line == '\n':
+                self._push(line)
+                break
+            if not (line.startswith('Name: ') and line.endswith('\n')
+                    and len(line) > 7):
+                self._error('Expected a bean name', line)
+            yield self._bean(line[6:-1])
+            line = self._next()
+        self._end()
 
+    def search_results(self):
+        return dict(self.iter_beans())
 
+    def get_results(self):
+        (p, line, pos) = self._header(_GET_HEADER)
+        rv = self._propval(line, pos)
+        self._end()
+        return rv
+
+    def invoke_results(self):
+        (p, line, pos) = self._header(_INVOKE_VOID, _INVOKE_VALUE)
+        if p is _INVOKE_VOID:
+            self._end()
+            return None
+        line = self._next()
+        if line is not None and line.startswith('  '):
+            rv = []
+            while line is not None and line.startswith('  '):
+                if not line.endswith('\n'):
+                    self._error('Unterminated array element', line)
+                rv.append(self._value(line[2:-1]))
+                line = self._next()
+            self._push(line)
+        else:
+            if line is None or not line.endswith('\n'):
+                self._error('Unterminated value', line)
+            rv = self._value(line[:-1])
+        self._end()
+        return rv
+
+def parse(rule, text, attributes=None):
+    P = JMXProxyOutputParser(StringIO(text), attributes)
+    return getattr(P, rule)()
+
+def iter_search_results(lines, attributes=None):
+    '''
+    Incrementally parse search results from an iterable of lines, yielding
+    (object name, attributes) tuples as soon as each bean is complete
+    '''
+    return JMXProxyOutputParser(lines, attributes).iter_beans()
+
+# int() and float() fail on anything not starting with one of these
+_NUMBER_START = frozenset('0123456789+-. \t\n\r\x0b\x0cnNiI')
 
 def convert_from_str(s):
-    try:
-        return to_boolean(s)
-    except ValueError:
-        pass
+    if len(s) in (4, 5):
+        l = s.lower()
+        if l == 'true':
+            return True
+        if l == 'false':
+            return False
+
+    if not s or s[0] not in _NUMBER_START:
+        return s
 
     try:
         return int(s)
@@ -224,3 +268,160 @@ def to_boolean(s):
         return False
 
     raise ValueError('Not a boolean: %s' % s)
+
+# Decoded composite types keyed by their compositeType header
+_composite_types = {}
+
+def composite_type(header):
+    '''
+    Return a dict of item decoders for a compositeType header, e.g.
+    javax.management.openmbean.CompositeType(name=...,items=((itemName=used,
+    itemType=javax.management.openmbean.SimpleType(name=java.lang.Long)),...))
+    Only SimpleType items get a decoder, anything else is left to
+    convert_from_str. Each distinct header is analysed only once.
+    '''
+    try:
+        return _composite_types[header]
+    except KeyError:
+        pass
+
+    types = {}
+    start = header.find(',items=(')
+    if start >= 0:
+        depth = 0
+        for m in _TYPE_PARENS.finditer(header, start + len(',items=(')):
+            if m.group() == '(':
+                if depth == 0:
+                    item_start = m.end()
+                depth += 1
+            elif depth == 0:
+                break
+            else:
+                depth -= 1
+                if depth == 0:
+                    item = _ITEM.match(header, item_start, m.start())
+                    t = _SIMPLE_TYPE.match(item.group(2)) if item else None
+                    if t and t.group(1) in _simple_types:
+                        types[item.group(1)] = _simple_types[t.group(1)]
+
+    _composite_types[header] = types
+    return types
+
+def _typed(convert):
+    def decode(s):
+        try:
+            return convert(s)
+        except ValueError:
+            # e.g. 'null'
+            return convert_from_str(s)
+    return decode
+
+def _as_is(s):
+    return s
+
+_simple_types = {
+    'java.lang.Boolean'   : _typed(to_boolean),
+    'java.lang.Byte'      : _typed(int),
+    'java.lang.Short'     : _typed(int),
+    'java.lang.Integer'   : _typed(int),
+    'java.lang.Long'      : _typed(int),
+    'java.math.BigInteger': _typed(int),
+    'java.lang.Float'     : _typed(float),
+    'java.lang.Double'    : _typed(float),
+    'java.math.BigDecimal': _typed(float),
+    'java.lang.String'    : _as_is,
+    'java.lang.Character' : _as_is,
+    'java.util.Date'      : _as_is,
+    'javax.management.ObjectName': _as_is,
+}
+
+class CompactBean(object):
+    '''
+    A read-only, memory efficient mapping of bean attributes.
+    Beans with the same set of attribute names share one (keys, index)
+    schema and store their values in a tuple.
+    '''
+    __slots__ = ('_keys', '_index', '_values')
+
+    def __init__(self, schema, values):
+        (self._keys, self._index) = schema
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else self._values[i]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iterkeys(self):
+        return iter(self._keys)
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def iteritems(self):
+        return iter(zip(self._keys, self._values))
+
+    def __eq__(self, other):
+        if isinstance(other, collections.Mapping):
+            return dict(self.iteritems()) == dict(other.iteritems())
+        return NotImplemented
+
+    def __ne__(self, other):
+        rv = self.__eq__(other)
+        return rv if rv is NotImplemented else not rv
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+collections.Mapping.register(CompactBean)
+
+# Shared schemas of compact beans keyed by their attribute names
+_compact_schemas = {}
+
+# Only strings up to this length are interned, longer values are very
+# unlikely to repeat across beans
+_INTERN_MAX_LEN = 64
+
+def _compact_value(v):
+    if isinstance(v, str):
+        return intern(v) if len(v) <= _INTERN_MAX_LEN else v
+    if isinstance(v, dict):
+        return compact(v)
+    if isinstance(v, list):
+        return map(_compact_value, v)
+    return v
+
+def compact(attrs):
+    '''
+    Convert a dict of bean attributes to a CompactBean, interning
+    attribute names and short string values
+    '''
+    keys = tuple(sorted(attrs))
+    try:
+        schema = _compact_schemas[keys]
+    except KeyError:
+        shared = tuple(intern(k) for k in keys)
+        schema = (shared, dict((k, i) for i, k in enumerate(shared)))
+        schema = _compact_schemas.setdefault(keys, schema)
+    return CompactBean(schema, tuple(_compact_value(attrs[k]) for k in keys))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import time, random
+
+class Poller:
+    '''
+    Polls until a condition holds or a timeout passes. The first attempt
+    is made right away, the interval between attempts starts short and
+    grows by backoff (with some jitter, so that nodes polled together
+    drift apart) up to max_interval. The last attempt is made at the
+    deadline. Call reset() when a poll shows progress to go back to the
+    initial interval.
+
+    >>> Poller(600).wait(lambda: t.server_status() == 'STARTED')
+    True
+    >>> p = Poller(30, max_interval=2)
+    >>> for attempt in p:
+    ...     if check():
+    ...         break
+    '''
+    initial_interval = 0.2
+    backoff = 1.5
+    max_interval = 5
+    # Fraction of the interval randomly added or removed
+    jitter = 0.2
+
+    def __init__(self, timeout, **opts):
+        self.timeout = timeout
+        for k, v in opts.items():
+            if v is not None:
+                setattr(self, k, v)
+        self.attempts = 0
+        self.interval = self.initial_interval
+        self.end_time = None
+
+    def remaining(self):
+        '''
+        Seconds left until the deadline
+        '''
+        if self.end_time is None:
+            return self.timeout
+        return max(self.end_time - time.time(), 0)
+
+    def reset(self):
+        self.interval = self.initial_interval
+
+    def next_interval(self):
+        '''
+        Return the time to sleep before the next attempt and back off
+        '''
+        jitter = random.uniform(-self.jitter, self.jitter)
+        rv = min(self.interval * (1 + jitter), self.max_interval,
+                 self.remaining())
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+        return rv
+
+    def __iter__(self):
+        self.end_time = time.time() + self.timeout
+        self.attempts = 0
+        self.reset()
+        while True:
+            self.attempts += 1
+            yield self.attempts
+            if self.remaining() <= 0:
+                return
+            time.sleep(self.next_interval())
+
+    def wait(self, predicate):
+        '''
+        Return True as soon as predicate() does, False if it is still
+        false at the deadline
+        '''
+        for attempt in self:
+            if predicate():
+                return True
+        return False
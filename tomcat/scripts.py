@@ -1,13 +1,14 @@
 #!/usr/bin/env python
 
-import logging
+import logging, os, re
 from optparse import OptionParser, OptionGroup
 from . import Tomcat, TomcatError, TomcatCluster
 from deployer import ClusterDeployer, parse_warfiles
 
 VERSION = "1.0"
 
-conn_options = [ 'host', 'port', 'user', 'passwd' ]
+conn_options = [ 'host', 'port', 'user', 'passwd', 'topology_cache',
+                 'digest_index' ]
 
 def setup_logging(level, module='pytomcat',
                   fmt='%(asctime)s %(levelname)s %(message)s'):
@@ -32,6 +33,15 @@ def create_option_parser(usage, epilog=None):
                      default='admin', dest='user')
     group.add_option("-p", "--password", help="Tomcat server password",
                      default='admin', dest='passwd')
+    group.add_option("--topology-cache", metavar='FILE', dest='topology_cache',
+                     default=os.path.expanduser('~/.pytomcat-topology'),
+                     help="File to cache discovered cluster members in, "
+                          "an empty string disables caching (default: %default)")
+    group.add_option("--digest-index", metavar='FILE', dest='digest_index',
+                     default=os.path.expanduser('~/.pytomcat-digests'),
+                     help="File to record the digests of deployed WARs in, "
+                          "nodes already running a WAR are not deployed to "
+                          "again; an empty string disables it (default: %default)")
     group.add_option("--loglevel", help="Log level ({0})".format(', '.join(err_choices)),
                      type="string", action="callback", metavar='LEVEL',
                      callback=lambda a, b, v, o: setup_logging(v))
@@ -45,7 +55,10 @@ def create_option_parser(usage, epilog=None):
 def add_restart_options(parser):
     parser.add_option("--restart-fraction", default=0.33, type="float", dest="restart_fraction",
                       help="Fraction of the cluster nodes rebooted at the same time (e.g. 0.33)")
-    return [ 'restart_fraction' ]
+    parser.add_option("--restart-min-capacity", type="float", dest="restart_min_capacity",
+                      help="Fraction of the cluster nodes kept in rotation during the restart "
+                           "(default: all but the ones rebooted at the same time)")
+    return [ 'restart_fraction', 'restart_min_capacity' ]
 
 def extract_options(keys, opts):
     values = map(lambda x: getattr(opts, x), keys)
@@ -57,7 +70,8 @@ def list_main(argv):
     parser.add_option("--latest-only", action="store_true", dest="latest", 
                       default="False", help="Return the most recent version number for the webapps on the server")
     (opts, args) = parser.parse_args(argv)
-    c = TomcatCluster(opts.host, opts.user, opts.passwd, opts.port)
+    c = TomcatCluster(opts.host, opts.user, opts.passwd, opts.port,
+                      topology_cache=opts.topology_cache)
     fmt = '{0:<25} {1:<15} {2:<10} {3:<12} {4:<5} {5:>8}'
     nmemb = len(c.members)
     print '\n', fmt.format('Context', 'Path', 'State', 'Version', 'Cohrn', 'Nodes')
@@ -66,6 +80,30 @@ def list_main(argv):
             k, a['path'], a['stateName'], a['webappVersion'], str(a['coherent']),
             '{0} / {1}'.format(len(a['presentOn']), nmemb) )
 
+def stats_main(argv):
+    usage = 'usage: %prog stats [options]'
+    parser = create_option_parser(usage)
+    parser.add_option("--interval", default=5, type="float", dest="interval",
+                      help="Seconds between the two samples of the request counters")
+    (opts, args) = parser.parse_args(argv)
+    c = TomcatCluster(opts.host, opts.user, opts.passwd, opts.port,
+                      topology_cache=opts.topology_cache)
+    rv = c.request_stats(opts.interval)
+    fmt = '{0:<25} {1:<18} {2:>9} {3:>11} {4:>8} {5:>10} {6:>10}'
+    print '\n', fmt.format('Node', 'Connector', 'Req/s', 'Latency ms',
+                           'Errors', 'Sent KB/s', 'Recv KB/s')
+    def row(node, connector, v):
+        print fmt.format(node, connector, '{0:.1f}'.format(v['requestsPerSecond']),
+            '{0:.1f}'.format(v['meanLatency']), '{0:.2%}'.format(v['errorRate']),
+            '{0:.1f}'.format(v['bytesSentPerSecond'] / 1024),
+            '{0:.1f}'.format(v['bytesReceivedPerSecond'] / 1024))
+    for node, stats in sorted(rv['nodes'].items()):
+        for connector, v in sorted(stats['connectors'].items()):
+            row(node, connector + (' (reset)' if v['reset'] else ''), v)
+    row('Cluster', '', rv['total'])
+    for node in rv['failed']:
+        print '{0:<25} unavailable'.format(node)
+
 def deploy_main(argv):
     '''
     Deploy a webapp
@@ -82,14 +120,43 @@ def deploy_main(argv):
                       help="Do not trigger GC on server(s) to reclaim memory")
     parser.add_option("--auto-restart", action="store_true", dest="auto_restart",
                       help="Automatically restart application server(s) on low memory")
+    parser.add_option("--no-validate", action="store_false", dest="validate_wars",
+                      default=True, help="Do not check the WAR files before deploying")
+    parser.add_option("--require-descriptor", action="store_true",
+                      dest="require_descriptor", default=False,
+                      help="Refuse WAR files without WEB-INF/web.xml or "
+                           "annotated servlets, filters or listeners")
+    parser.add_option("--max-deploys", type="int", dest="max_deploys",
+                      help="Maximum number of nodes to deploy to at a time")
+    parser.add_option("--upload-bandwidth", type="float", dest="upload_bandwidth",
+                      metavar='MB/S', help="Total upload bandwidth in MB/s")
+    parser.add_option("--max-uploads", type="int", dest="max_uploads",
+                      help="Maximum number of nodes to upload to at a time")
+    parser.add_option("--upload-location", metavar='REGEX', dest="upload_location",
+                      help="Regular expression matching the rack or datacenter "
+                           "in a node name (the first group if any), uploads "
+                           "take turns between locations")
+    parser.add_option("--upload-grouped", action="store_true", dest="upload_grouped",
+                      default=False, help="Upload to one location at a time")
     restart_options = add_restart_options(parser)
     deployer_options = restart_options + [
         'kill_sessions', 'check_memory', 'required_memory', 'auto_gc',
-        'auto_restart' ]
+        'auto_restart', 'validate_wars', 'require_descriptor', 'max_deploys',
+        'upload_bandwidth', 'max_uploads', 'upload_location', 'upload_grouped' ]
 
     (opts, args) = parser.parse_args(argv)
+    if opts.upload_bandwidth:
+        opts.upload_bandwidth = int(opts.upload_bandwidth * 1048576)
+    if opts.upload_location:
+        regex = re.compile(opts.upload_location)
+        def location(host):
+            m = regex.search(host)
+            return m and (m.group(1) if regex.groups else m.group(0))
+        opts.upload_location = location
+    # check the WAR files before connecting to the cluster
+    apps = parse_warfiles(args, opts.validate_wars, opts.require_descriptor)
     d = ClusterDeployer(**extract_options(conn_options + deployer_options, opts))
-    d.deploy(parse_warfiles(args))
+    d.deploy(apps)
 
 def undeploy_main(argv):
     '''
@@ -134,6 +201,7 @@ def tool_main():
               'undeploy' : undeploy_main,
               'restart'  : restart_main,
               'list'     : list_main,
+              'stats'    : stats_main,
               'rollback' : rollback_main }
 
     usage = 'usage: %prog COMMAND [options] [args]'
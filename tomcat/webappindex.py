@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+class ClusterWebappIndex:
+    '''
+    A cluster-wide view of webapps keyed by context name, kept up to date
+    with the webapp lists of individual nodes (see Tomcat.list_webapps).
+    Every update only applies the differences to what the node reported
+    before, and presence, coherence and latest version questions are
+    answered without looking at the other nodes.
+
+    >>> idx = ClusterWebappIndex(c.members.keys())
+    >>> c.update_webapp_index(idx, contexts=[ '/app##002' ])
+    >>> idx.is_coherent('/app##002'), idx.state('/app##002')
+    (True, 'STARTED')
+    '''
+    keys = ( 'stateName', 'path', 'webappVersion' )
+
+    def __init__(self, hosts=()):
+        self.hosts = set(hosts)
+        # host -> { context: (stateName, path, webappVersion) }
+        self._nodes = {}
+        # context -> (set of hosts, [ { value: number of hosts } per key ])
+        self._contexts = {}
+        # path reported by any node -> { context: number of hosts }
+        self._paths = {}
+
+    def _add(self, host, ctx, values):
+        entry = self._contexts.get(ctx)
+        if entry is None:
+            entry = self._contexts[ctx] = (set(), [ {} for k in self.keys ])
+        entry[0].add(host)
+        for counts, v in zip(entry[1], values):
+            counts[v] = counts.get(v, 0) + 1
+        ctxs = self._paths.setdefault(values[1], {})
+        ctxs[ctx] = ctxs.get(ctx, 0) + 1
+
+    def _remove(self, host, ctx, values):
+        (present, counts) = self._contexts[ctx]
+        present.discard(host)
+        if not present:
+            del self._contexts[ctx]
+        else:
+            for c, v in zip(counts, values):
+                c[v] -= 1
+                if c[v] == 0:
+                    del c[v]
+        ctxs = self._paths[values[1]]
+        ctxs[ctx] -= 1
+        if ctxs[ctx] == 0:
+            del ctxs[ctx]
+            if not ctxs:
+                del self._paths[values[1]]
+
+    def update(self, host, webapps, scope=None):
+        '''
+        Apply the webapps reported by a node. scope limits the update to
+        the contexts for which scope(context, path) is true (i.e. the ones
+        the query could have returned), other contexts of the node are
+        left alone. Returns the number of contexts that changed.
+        '''
+        self.hosts.add(host)
+        node = self._nodes.setdefault(host, {})
+        changed = 0
+        for ctx, old in node.items():
+            if ctx in webapps or (scope is not None and not scope(ctx, old[1])):
+                continue
+            self._remove(host, ctx, old)
+            del node[ctx]
+            changed += 1
+        for ctx, v in webapps.iteritems():
+            values = tuple(v[k] for k in self.keys)
+            old = node.get(ctx)
+            if old == values:
+                continue
+            if old is not None:
+                self._remove(host, ctx, old)
+            self._add(host, ctx, values)
+            node[ctx] = values
+            changed += 1
+        return changed
+
+    def remove_node(self, host):
+        for ctx, values in self._nodes.pop(host, {}).items():
+            self._remove(host, ctx, values)
+        self.hosts.discard(host)
+
+    def __contains__(self, ctx):
+        return ctx in self._contexts
+
+    def contexts(self, path=None):
+        '''
+        Return the contexts present on any node, or the ones that any node
+        reports to be serving path
+        '''
+        if path is None:
+            return self._contexts.keys()
+        return self._paths.get(path, {}).keys()
+
+    def paths(self):
+        return self._paths.keys()
+
+    def present_on(self, ctx):
+        return sorted(self._contexts[ctx][0]) if ctx in self._contexts else []
+
+    def is_present(self, ctx, host=None):
+        '''
+        Is ctx deployed to host, or to every node if host is not given
+        '''
+        if not ctx in self._contexts:
+            return False
+        if host is not None:
+            return host in self._contexts[ctx][0]
+        return len(self._contexts[ctx][0]) == len(self.hosts)
+
+    def _value(self, ctx, key):
+        counts = self._contexts[ctx][1][self.keys.index(key)]
+        return counts.keys()[0] if len(counts) == 1 else None
+
+    def is_coherent(self, ctx):
+        '''
+        Is ctx present on all nodes with the same state, path and version
+        '''
+        return (self.is_present(ctx) and
+                all(len(c) == 1 for c in self._contexts[ctx][1]))
+
+    def state(self, ctx):
+        '''
+        Return the stateName of ctx if all nodes agree on it, else None
+        '''
+        return self._value(ctx, 'stateName') if ctx in self._contexts else None
+
+    def latest(self, path):
+        '''
+        Return the context with the highest version serving path (Tomcat
+        compares versions as strings, and so does this)
+        '''
+        ctxs = self._paths.get(path)
+        return max(ctxs) if ctxs else None
+
+    def status(self, ctx):
+        '''
+        Return the status of ctx in the format of TomcatCluster.webapp_status
+        '''
+        (present, counts) = self._contexts[ctx]
+        rv = { 'presentOn': list(present),
+               'coherent': self.is_coherent(ctx),
+               'clusterDetails': dict((k, {}) for k in self.keys) }
+        for k, c in zip(self.keys, counts):
+            rv[k] = c.keys()[0] if len(c) == 1 else None
+        for host in present:
+            for k, v in zip(self.keys, self._nodes[host][ctx]):
+                rv['clusterDetails'][k][host] = v
+        return rv
+
+    def webapp_status(self, contexts=None):
+        if contexts is None:
+            contexts = self._contexts.keys()
+        return dict((ctx, self.status(ctx)) for ctx in contexts
+                    if ctx in self._contexts)